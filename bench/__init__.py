@@ -0,0 +1,13 @@
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Benchmarks for thirtyboxes.py.
+
+Run a benchmark from the top-level source directory, e.g.:
+
+    python bench/bench_records.py
+
+bench_api.py is the end-to-end suite: it runs `ThirtyBoxes' and
+`RawThirtyBoxes' against a local mock server (mock_server.py) serving
+synthetic responses (fixtures.py).
+"""
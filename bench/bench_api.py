@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Benchmark `ThirtyBoxes' and `RawThirtyBoxes' against the local mock
+30boxes server (bench/mock_server.py).
+
+    usage: python bench/bench_api.py [OPTIONS] [SCENARIOS...]
+
+For each scenario this reports request throughput, p50/p99 latency,
+parse throughput (events/sec, for events scenarios) and peak memory.
+Each scenario is run in a new process (so peak memory is its own) and
+the mock server runs in another.
+
+Use `--json FILE' to save the results and `--compare FILE' to compare
+against saved results: the exit status is non-zero if any metric is
+worse by more than `--tolerance' percent.
+"""
+
+import os
+import sys
+import time
+import datetime
+import threading
+import subprocess
+import optparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import resource
+except ImportError:
+    resource = None # no peak memory on Windows
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top_dir)
+
+
+_START = datetime.date(2009, 1, 1)
+_END = datetime.date(2009, 4, 1)
+
+# (name, API class name, function of (api, i) making the i'th call,
+#  whether the call returns a parsed event list)
+SCENARIOS = [
+    ("raw_ping", "RawThirtyBoxes", lambda api, i: api.test_Ping(), False),
+    ("ping", "ThirtyBoxes", lambda api, i: api.ping(), False),
+    ("raw_find_user", "RawThirtyBoxes",
+     lambda api, i: api.user_FindById(i), False),
+    ("find_user", "ThirtyBoxes", lambda api, i: api.find_user(i), False),
+    ("find_users", "ThirtyBoxes",
+     lambda api, i: api.find_users(range(i * 20, i * 20 + 20)), False),
+    ("all_user_info", "ThirtyBoxes",
+     lambda api, i: api.all_user_info(), False),
+    ("raw_events", "RawThirtyBoxes",
+     lambda api, i: api.events_Get(_START, _END), False),
+    ("events", "ThirtyBoxes", lambda api, i: api.events(_START, _END), True),
+    ("search", "ThirtyBoxes", lambda api, i: api.search("bike"), True),
+    ("tag_search", "ThirtyBoxes",
+     lambda api, i: api.tag_search("work"), True),
+]
+
+# metric -> True if higher is better
+METRICS = [
+    ("req_per_sec", True),
+    ("p50_ms", False),
+    ("p99_ms", False),
+    ("events_per_sec", True),
+    ("peak_rss_mb", False),
+]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+def run_scenario(name, url, num_requests, concurrency):
+    """Run the given scenario in this process and return its metrics."""
+    import thirtyboxes
+    thirtyboxes.API_URL = url
+    api_class, call, returns_events = [s[1:] for s in SCENARIOS
+                                       if s[0] == name][0]
+    api = getattr(thirtyboxes, api_class)("bench-key", "bench-token")
+
+    call(api, 0) # warm up: connect and fill the server's cache
+    latencies = []
+    num_events = [0]
+    counter = iter(xrange(1, num_requests + 1))
+    lock = threading.Lock()
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                i = next(counter, None)
+            finally:
+                lock.release()
+            if i is None:
+                break
+            start = time.time()
+            result = call(api, i)
+            latencies.append(time.time() - start)
+            if returns_events:
+                lock.acquire()
+                try:
+                    num_events[0] += len(result["events"])
+                finally:
+                    lock.release()
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    metrics = {
+        "requests": len(latencies),
+        "seconds": elapsed,
+        "req_per_sec": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+    if returns_events:
+        metrics["events_per_sec"] = num_events[0] / elapsed
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak /= 1024 # bytes rather than KB
+        metrics["peak_rss_mb"] = peak / 1024.0
+    return metrics
+
+def start_mock_server(opts):
+    argv = [sys.executable, os.path.join(top_dir, "bench", "mock_server.py"),
+            "--num-events", str(opts.num_events),
+            "--notes-size", str(opts.notes_size),
+            "--latency", str(opts.latency)]
+    if opts.gzip:
+        argv.append("--gzip")
+    server = subprocess.Popen(argv, stdout=subprocess.PIPE)
+    line = server.stdout.readline()
+    assert line.startswith("serving on "), line
+    return server, line.split()[-1]
+
+def run_child(name, url, opts):
+    argv = [sys.executable, os.path.abspath(__file__), "--child", name,
+            "--url", url, "-r", str(opts.requests),
+            "-c", str(opts.concurrency)]
+    output = subprocess.Popen(argv, stdout=subprocess.PIPE).communicate()[0]
+    return json.loads(output.splitlines()[-1])
+
+def format_metrics(metrics):
+    parts = ["%7.1f req/s" % metrics["req_per_sec"],
+             "p50 %7.2fms" % metrics["p50_ms"],
+             "p99 %7.2fms" % metrics["p99_ms"]]
+    if "events_per_sec" in metrics:
+        parts.append("%8.0f events/s" % metrics["events_per_sec"])
+    if "peak_rss_mb" in metrics:
+        parts.append("peak %6.1fMB" % metrics["peak_rss_mb"])
+    return ", ".join(parts)
+
+def compare(results, baseline, tolerance):
+    """Print how `results' compare with `baseline' and return the list of
+    regressions (worse by more than `tolerance' percent).
+    """
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = baseline[name].get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = 100.0 * (new - old) / old
+            worse = higher_is_better and -change or change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions.append((name, metric))
+            print "%-14s %-15s %10.2f -> %10.2f (%+6.1f%%)%s" % (
+                name, metric, old, new, change, flag)
+    return regressions
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [OPTIONS] [SCENARIOS...]",
+        description="Scenarios: " + ", ".join(s[0] for s in SCENARIOS))
+    parser.add_option("-n", "--num-events", type="int", default=1000,
+        help="events in each events response, 10 to 100000 (default: 1000)")
+    parser.add_option("--notes-size", type="int", default=40,
+        help="approximate size of each event's notes (default: 40)")
+    parser.add_option("--latency", type="float", default=0.0,
+        help="server latency per request in seconds (default: 0)")
+    parser.add_option("--gzip", action="store_true", default=False,
+        help="have the server gzip responses")
+    parser.add_option("-r", "--requests", type="int", default=200,
+        help="requests per scenario (default: 200)")
+    parser.add_option("-c", "--concurrency", type="int", default=1,
+        help="concurrent client threads (default: 1)")
+    parser.add_option("--json", metavar="FILE",
+        help="write the results as JSON to FILE")
+    parser.add_option("--compare", metavar="FILE",
+        help="compare with the results in FILE (from --json)")
+    parser.add_option("--tolerance", type="float", default=10.0,
+        help="percent a metric may worsen in --compare (default: 10)")
+    parser.add_option("--child", help=optparse.SUPPRESS_HELP)
+    parser.add_option("--url", help=optparse.SUPPRESS_HELP)
+    opts, names = parser.parse_args(argv[1:])
+
+    if opts.child:
+        metrics = run_scenario(opts.child, opts.url, opts.requests,
+                               opts.concurrency)
+        print json.dumps(metrics)
+        return
+
+    all_names = [s[0] for s in SCENARIOS]
+    for name in names:
+        if name not in all_names:
+            parser.error("unknown scenario: %r" % name)
+    names = names or all_names
+
+    server, url = start_mock_server(opts)
+    try:
+        print "%d events/response, %d requests, concurrency %d" % (
+            opts.num_events, opts.requests, opts.concurrency)
+        results = {}
+        for name in names:
+            results[name] = run_child(name, url, opts)
+            print "%-14s %s" % (name, format_metrics(results[name]))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if opts.json:
+        options = dict((key, getattr(opts, key)) for key in
+            ("num_events", "notes_size", "latency", "gzip", "requests",
+             "concurrency"))
+        f = open(opts.json, 'w')
+        try:
+            json.dump({"python": sys.version.split()[0],
+                       "options": options, "results": results},
+                      f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if opts.compare:
+        f = open(opts.compare)
+        try:
+            baseline = json.load(f)["results"]
+        finally:
+            f.close()
+        print
+        if compare(results, baseline, opts.tolerance):
+            return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Compare the latency of API calls with and without hedged requests
+(`HedgePolicy') against a mock server where a few responses are slow.
+
+    usage: python bench/bench_hedge.py [CALLS [SLOW_FRACTION]]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thirtyboxes
+from bench.mock_server import MockServer
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+def run(tb, num_calls):
+    """Make "num_calls" `find_user()' calls and return their sorted
+    latencies.
+    """
+    latencies = []
+    for i in range(num_calls):
+        start = time.time()
+        tb.find_user(i)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return latencies
+
+def main(argv):
+    num_calls = len(argv) > 1 and int(argv[1]) or 500
+    slow_fraction = len(argv) > 2 and float(argv[2]) or 0.02
+    server = MockServer(latency=0.005, slow_fraction=slow_fraction,
+                        slow_latency=0.2)
+    server.start()
+    thirtyboxes.API_URL = server.url
+    pool = thirtyboxes.ConnectionPool()
+    try:
+        print "%d calls, %d%% of responses slow" % (
+            num_calls, slow_fraction * 100)
+        for name, hedge in [("no hedging", None),
+                            ("hedging", thirtyboxes.HedgePolicy())]:
+            tb = thirtyboxes.ThirtyBoxes("bench-key", "bench-token",
+                                         pool=pool, hedge=hedge)
+            stats = thirtyboxes.StatsCollector()
+            tb.add_observer(stats)
+            latencies = run(tb, num_calls)
+            print "%-10s: p50 %6.1fms, p99 %6.1fms, max %6.1fms, " \
+                  "%d hedged" % (name,
+                percentile(latencies, 0.50) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                latencies[-1] * 1000,
+                stats.methods["user.FindById"]["hedged"])
+    finally:
+        pool.close()
+        server.stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
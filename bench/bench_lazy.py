@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Compare parsing events responses and then reading a few fields (id,
+summary and start, as most consumers do) or all fields, with dicts,
+`Event' records and `LazyEvent' records (`ThirtyBoxes(..., lazy=True)').
+
+    usage: python bench/bench_lazy.py [NUM_EVENTS]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thirtyboxes
+from bench import fixtures
+
+
+def read_few(events):
+    return [(event["id"], event["summary"], event["start"])
+            for event in events]
+
+def read_all(events):
+    return [event.items() for event in events]
+
+def main(argv):
+    num_events = len(argv) > 1 and int(argv[1]) or 10000
+    xml = fixtures.events_xml(num_events, notes_size=200)
+    print "%d events (%d bytes of XML)" % (num_events, len(xml))
+    kinds = [("dicts", thirtyboxes._events_unmarshallers),
+             ("records", thirtyboxes._record_events_unmarshallers),
+             ("lazy", thirtyboxes._lazy_events_unmarshallers)]
+    best = {}
+    # Interleave the runs and keep the best of each, to reduce noise.
+    for i in range(5):
+        for name, unmarshallers in kinds:
+            for read in (read_few, read_all):
+                start = time.time()
+                read(thirtyboxes._parse_response("events", xml,
+                                                 unmarshallers)["events"])
+                elapsed = time.time() - start
+                key = (name, read)
+                best[key] = min(best.get(key, elapsed), elapsed)
+    for name, unmarshallers in kinds:
+        print "%-7s: %.3fs reading id/summary/start, %.3fs reading all" % (
+            name, best[name, read_few], best[name, read_all])
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Compare fanning out API calls from many threads with and without a
+`RateLimiter' against a mock server that can only handle a few requests
+at once (others get a 503, as from an overloaded server).
+
+    usage: python bench/bench_limiter.py [THREADS [CAPACITY [SECONDS]]]
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thirtyboxes
+from bench.mock_server import MockServer
+
+
+def run(tb, num_threads, seconds):
+    """Call `tb.ping()' from "num_threads" threads for "seconds" and
+    return the numbers of successful and failed calls.
+    """
+    counts = {"ok": 0, "failed": 0}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+    def worker():
+        while time.time() < deadline:
+            try:
+                tb.ping()
+            except thirtyboxes.ThirtyBoxesError:
+                raise
+            except Exception:
+                outcome = "failed"
+            else:
+                outcome = "ok"
+            lock.acquire()
+            try:
+                counts[outcome] += 1
+            finally:
+                lock.release()
+    threads = [threading.Thread(target=worker) for i in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts["ok"], counts["failed"]
+
+def main(argv):
+    num_threads = len(argv) > 1 and int(argv[1]) or 16
+    capacity = len(argv) > 2 and int(argv[2]) or 4
+    seconds = len(argv) > 3 and float(argv[3]) or 3.0
+    server = MockServer(latency=0.01, capacity=capacity)
+    server.start()
+    thirtyboxes.API_URL = server.url
+    pool = thirtyboxes.ConnectionPool(max_per_host=num_threads)
+    try:
+        print "%d threads, server capacity %d, %.1fs each" % (
+            num_threads, capacity, seconds)
+        for name, limiter in [("no limiter", None),
+                              ("limiter", thirtyboxes.RateLimiter())]:
+            tb = thirtyboxes.ThirtyBoxes("bench-key", "bench-token",
+                                         pool=pool, limiter=limiter)
+            ok, failed = run(tb, num_threads, seconds)
+            line = "%-10s: %6.1f ok/s, %6.1f failed/s" % (
+                name, ok / seconds, failed / seconds)
+            if limiter is not None:
+                line += ", concurrency limit %.1f" % limiter.concurrency
+            print line
+    finally:
+        pool.close()
+        server.stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Compare parsing events responses with the compiled expat unmarshaller
+(`_parse_response()') and with ElementTree (`_etree_parse_response()').
+
+    usage: python bench/bench_parse.py [NUM_EVENTS]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thirtyboxes
+from bench import fixtures
+
+
+def best_time(func, repeat=3):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def main(argv):
+    num_events = len(argv) > 1 and int(argv[1]) or 10000
+    xml = fixtures.events_xml(num_events)
+    print "%d events (%d bytes of XML), ElementTree is %s" % (
+        num_events, len(xml), thirtyboxes._etree().__name__)
+    for name, unmarshallers in [
+            ("dicts", thirtyboxes._events_unmarshallers),
+            ("records", thirtyboxes._record_events_unmarshallers)]:
+        compiled = thirtyboxes._parse_response("events", xml, unmarshallers)
+        etree = thirtyboxes._etree_parse_response("events", xml,
+                                                  unmarshallers)
+        assert compiled == etree, "compiled and etree results differ"
+        compiled_time = best_time(lambda: thirtyboxes._parse_response(
+            "events", xml, unmarshallers))
+        etree_time = best_time(lambda: thirtyboxes._etree_parse_response(
+            "events", xml, unmarshallers))
+        print "%-7s: compiled %.3fs, etree %.3fs (%.1fx faster)" % (
+            name, compiled_time, etree_time, etree_time / compiled_time)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Compare the memory used by parsed events as dicts and as `Event'
+records (`ThirtyBoxes(..., records=True)').
+
+    usage: python bench/bench_records.py [NUM_EVENTS]
+"""
+
+import os
+import sys
+import datetime
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thirtyboxes
+from bench import fixtures
+
+
+def deep_sizeof(obj, seen=None):
+    """Return the approximate number of bytes used by `obj' and all the
+    objects it references (each counted once).
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif isinstance(obj, thirtyboxes._Record):
+        for value in obj.values():
+            size += deep_sizeof(value, seen)
+    return size
+
+def measure(xml, unmarshallers):
+    start = time.time()
+    event_list = thirtyboxes._parse_response("events", xml, unmarshallers)
+    elapsed = time.time() - start
+    return deep_sizeof(event_list["events"]), elapsed
+
+def main(argv):
+    num_events = len(argv) > 1 and int(argv[1]) or 100000
+    xml = fixtures.events_xml(num_events)
+    print "%d events (%d bytes of XML)" % (num_events, len(xml))
+    dict_size, dict_time = measure(xml, thirtyboxes._events_unmarshallers)
+    record_size, record_time = measure(
+        xml, thirtyboxes._record_events_unmarshallers)
+    print "dicts   : %6.1f MB (%4d bytes/event), parsed in %.2fs" % (
+        dict_size / 1e6, dict_size // num_events, dict_time)
+    print "records : %6.1f MB (%4d bytes/event), parsed in %.2fs" % (
+        record_size / 1e6, record_size // num_events, record_time)
+    print "records use %.0f%% less memory" % (
+        100.0 * (dict_size - record_size) / dict_size)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Measure startup time: `import thirtyboxes' and `thirtyboxes.py ping'
+against the mock server, each in a new Python process. Exits non-zero if
+either takes longer than the budget, to catch startup regressions.
+
+    usage: python bench/bench_startup.py [BUDGET_MS]
+
+The default budget is 50ms. The ping benchmark is skipped if cmdln.py
+(required by the command-line interface) isn't installed.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.mock_server import MockServer
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+thirtyboxes_py = os.path.join(top_dir, "thirtyboxes.py")
+
+
+def best_time_ms(argv, env, repeat=10):
+    """Return the best wall clock time (in ms) of running the given
+    command `repeat' times.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call(argv, env=env, cwd=top_dir,
+                              stdout=open(os.devnull, 'w'))
+        times.append(time.time() - start)
+    return min(times) * 1000
+
+def have_cmdln(env):
+    return subprocess.call([sys.executable, "-c", "import cmdln"], env=env,
+                           stderr=open(os.devnull, 'w')) == 0
+
+def main(argv):
+    budget_ms = len(argv) > 1 and float(argv[1]) or 50.0
+    env = dict(os.environ)
+    # Measure with thirtyboxes.pyc, as it is when installed.
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    subprocess.check_call([sys.executable, "-c", "import thirtyboxes"],
+                          env=env, cwd=top_dir)
+
+    results = []
+    python_ms = best_time_ms([sys.executable, "-c", "pass"], env)
+    print "python startup        : %5.1fms" % python_ms
+    import_ms = best_time_ms([sys.executable, "-c", "import thirtyboxes"],
+                             env)
+    print "import thirtyboxes    : %5.1fms (%.1fms over python startup)" % (
+        import_ms, import_ms - python_ms)
+    results.append(("import thirtyboxes", import_ms))
+
+    if have_cmdln(env):
+        server = MockServer()
+        server.start()
+        try:
+            ping_env = dict(env, THIRTYBOXES_API_URL=server.url)
+            ping_ms = best_time_ms([sys.executable, thirtyboxes_py,
+                                    "-k", "bench", "ping"], ping_env)
+        finally:
+            server.stop()
+        print "thirtyboxes.py ping   : %5.1fms" % ping_ms
+        results.append(("thirtyboxes.py ping", ping_ms))
+    else:
+        print "thirtyboxes.py ping   : skipped (cmdln.py is not installed)"
+
+    over = [name for name, ms in results if ms > budget_ms]
+    if over:
+        print "over the %.0fms budget: %s" % (budget_ms, ', '.join(over))
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
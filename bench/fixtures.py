@@ -0,0 +1,94 @@
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Synthetic 30boxes API XML responses for benchmarks."""
+
+import datetime
+import random
+from xml.sax.saxutils import escape
+
+
+_TAGS = ["work", "personal", "travel", "oncall", "family", "bike", "music",
+         "health", "finance", "school"]
+_WORDS = ["meeting", "lunch", "call", "review", "dentist", "flight",
+          "dinner", "standup", "planning", "bike", "ride", "concert",
+          "party", "weekly", "project", "deadline", "trip", "gym"]
+
+def _event_xml(rand, id, start, notes_size):
+    all_day = rand.random() < 0.3
+    if all_day:
+        start_str = end_str = start.strftime("%Y-%m-%d")
+    else:
+        start = start.replace(hour=rand.randrange(7, 20),
+                              minute=rand.choice([0, 15, 30, 45]))
+        end = start + datetime.timedelta(minutes=rand.choice([30, 60, 90]))
+        start_str = start.strftime("%Y-%m-%d %H:%M:%S")
+        end_str = end.strftime("%Y-%m-%d %H:%M:%S")
+    repeat = rand.random() < 0.1
+    summary = ' '.join(rand.sample(_WORDS, rand.randrange(1, 4)))
+    notes_words = [rand.choice(_WORDS) for i in range(notes_size // 8)]
+    notes = "<br/>".join(escape(' '.join(notes_words[i:i+8]))
+                         for i in range(0, len(notes_words), 8))
+    tags = ' '.join(rand.sample(_TAGS, rand.randrange(0, 3)))
+    return ("<event>"
+            "<allDayEvent>%d</allDayEvent>"
+            "<repeatEndDate>0000-00-00</repeatEndDate>"
+            "<repeatType>%s</repeatType>"
+            "<repeatSkipDates/>"
+            "<repeatICal/>"
+            "<reminder>-1</reminder>"
+            "<externalUID/>"
+            "<lastUpdate>2009-01-01 12:00:00</lastUpdate>"
+            "<start>%s</start>"
+            "<end>%s</end>"
+            "<summary>%s</summary>"
+            "<notes>%s</notes>"
+            "<id>%d</id>"
+            "<invitation><isInvitation>0</isInvitation></invitation>"
+            "<tags>%s</tags>"
+            "<privacy>%s</privacy>"
+            "</event>"
+            % (all_day, repeat and "weekly" or "no", start_str, end_str,
+               escape(summary), notes, id, tags,
+               rand.random() < 0.8 and "shared" or "private"))
+
+def events_xml(num_events, start=datetime.date(2009, 1, 1), days=180,
+               notes_size=40, seed=0, head=None):
+    """Return an events.Get response with `num_events' events spread
+    over `days' days from `start'. `notes_size' is the approximate size
+    of each event's notes.
+    """
+    rand = random.Random(seed)
+    start_dt = datetime.datetime(start.year, start.month, start.day)
+    events = []
+    for i in range(num_events):
+        day = start_dt + datetime.timedelta(days=(i * days) // max(num_events, 1))
+        events.append(_event_xml(rand, 100000 + i, day, notes_size))
+    if head is None:
+        end = start + datetime.timedelta(days=days)
+        head = ("<userId>1234</userId><listStart>%s</listStart>"
+                "<listEnd>%s</listEnd>" % (start, end))
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<rsp stat="ok"><eventList>%s%s</eventList></rsp>'
+            % (head, ''.join(events)))
+
+def user_xml(id=1234):
+    return ('<?xml version="1.0" encoding="utf-8"?><rsp stat="ok"><user>'
+            '<id>%d</id><firstName>Joe</firstName><lastName>Blow</lastName>'
+            '<avatar>http://30boxes.com/avatar/%d.jpg</avatar>'
+            '<createDate>2006-01-02</createDate><startDay>0</startDay>'
+            '<use24HourClock>0</use24HourClock>'
+            '<personalSite>http://example.com/</personalSite>'
+            '<feed><name>blog</name><url>http://example.com/feed</url></feed>'
+            '<email><address>joe%d@example.com</address><primary>1</primary>'
+            '</email><IM><type>AIM</type><username>joe%d</username></IM>'
+            '</user></rsp>' % (id, id, id, id))
+
+def ping_xml():
+    return ('<?xml version="1.0" encoding="utf-8"?><rsp stat="ok">'
+            '<ping>pong</ping><msg>API key for user 1234 was verified.</msg>'
+            '</rsp>')
+
+def error_xml(code=2, msg="Invalid request"):
+    return ('<?xml version="1.0" encoding="utf-8"?><rsp stat="fail">'
+            '<err code="%d" msg="%s"/></rsp>' % (code, escape(msg)))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""A local mock of the 30boxes API server for benchmarks.
+
+It serves test.Ping, user.FindById, user.FindByEmail, user.GetAllInfo,
+events.Get, events.Search and events.TagSearch with synthetic responses
+(see fixtures.py). Point thirtyboxes at it by setting
+`thirtyboxes.API_URL' (or the THIRTYBOXES_API_URL environment variable)
+to its `url'.
+
+    usage: python bench/mock_server.py [OPTIONS]
+"""
+
+import os
+import sys
+import time
+import random
+import socket
+import datetime
+import threading
+import urlparse
+import zlib
+import optparse
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench import fixtures
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # Clients dropping (keep-alive) connections is expected.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one write (rather than a write per header,
+    # which stalls on Nagle's algorithm and delayed ACKs).
+    wbufsize = -1
+
+    def do_GET(self):
+        mock = self.server.mock
+        if not mock.enter():
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            query = urlparse.urlsplit(self.path)[3]
+            args = dict(urlparse.parse_qsl(query))
+            method = args.pop("method", None)
+            latency = mock.latency
+            if mock.slow_fraction and random.random() < mock.slow_fraction:
+                latency = mock.slow_latency
+            if latency:
+                time.sleep(latency)
+            gzip = (mock.gzip
+                    and "gzip" in self.headers.get("Accept-Encoding", ""))
+            body = mock.response(method, args, gzip)
+        finally:
+            mock.exit()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        if gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(object):
+    """A mock 30boxes API server run in a background thread.
+
+        >>> server = MockServer(num_events=1000)
+        >>> server.start()
+        >>> thirtyboxes.API_URL = server.url
+        ...
+        >>> server.stop()
+    """
+    def __init__(self, port=0, num_events=100, notes_size=40, latency=0.0,
+                 gzip=False, capacity=None, slow_fraction=0.0,
+                 slow_latency=0.0):
+        """
+            "port" (optional) is the port to listen on. By default a free
+                port is picked.
+            "num_events" (optional) is the number of events in each
+                events.* response. Default 100.
+            "notes_size" (optional) is the approximate size of each
+                event's notes. Default 40.
+            "latency" (optional) is a number of seconds to wait before
+                each response. Default 0.
+            "gzip" (optional) is a boolean indicating that responses
+                should be gzip-compressed for clients that accept it.
+            "capacity" (optional) is the number of requests that can be
+                handled at once: others get a 503 response, as from an
+                overloaded server. By default there is no limit.
+            "slow_fraction" (optional) is the fraction of requests
+                (chosen at random) that wait "slow_latency" seconds
+                instead of "latency", to simulate tail latency.
+                Default 0.
+        """
+        self.num_events = num_events
+        self.notes_size = notes_size
+        self.latency = latency
+        self.gzip = gzip
+        self.capacity = capacity
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.num_active = 0
+        self.num_rejected = 0
+        self.responders = {
+            "test.Ping": lambda args: fixtures.ping_xml(),
+            "user.FindById": lambda args: fixtures.user_xml(int(args["id"])),
+            "user.FindByEmail": lambda args: fixtures.user_xml(),
+            "user.GetAllInfo": lambda args: fixtures.user_xml(),
+            "events.Get": self._events_get,
+            "events.Search": lambda args: self._events(
+                "<userId>1234</userId><search>%s</search>"
+                % escape(args.get("query", ""))),
+            "events.TagSearch": lambda args: self._events(
+                "<userId>1234</userId><tagSearch>%s</tagSearch>"
+                % escape(args.get("tag", ""))),
+        }
+        self._cache = {}  # (method, args, gzip) -> response body
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", port), _Handler)
+        self._server.mock = self
+        self.url = "http://127.0.0.1:%d/api/api.php" % self._server.server_port
+        self._thread = None
+
+    def enter(self):
+        """Start handling a request. Return false if over capacity."""
+        self._lock.acquire()
+        try:
+            if self.capacity is not None and self.num_active >= self.capacity:
+                self.num_rejected += 1
+                return False
+            self.num_active += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def exit(self):
+        self._lock.acquire()
+        try:
+            self.num_active -= 1
+        finally:
+            self._lock.release()
+
+    def response(self, method, args, gzip=False):
+        """Return the response body for the given API call."""
+        key = (method, tuple(sorted(args.items())), gzip)
+        self._lock.acquire()
+        try:
+            if key in self._cache:
+                return self._cache[key]
+        finally:
+            self._lock.release()
+        responder = self.responders.get(method)
+        if responder is None:
+            body = fixtures.error_xml(1, "Unknown method %r" % method)
+        else:
+            body = responder(args)
+        if gzip:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+        self._lock.acquire()
+        try:
+            if len(self._cache) > 100:
+                self._cache.clear()
+            self._cache[key] = body
+        finally:
+            self._lock.release()
+        return body
+
+    def _events_get(self, args):
+        start = _date_from_arg(args.get("start")) or datetime.date.today()
+        end = _date_from_arg(args.get("end")) \
+              or start + datetime.timedelta(days=90)
+        return fixtures.events_xml(self.num_events, start,
+                                   days=max((end - start).days, 1),
+                                   notes_size=self.notes_size)
+
+    def _events(self, head):
+        return fixtures.events_xml(self.num_events,
+                                   notes_size=self.notes_size, head=head)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+
+def _date_from_arg(arg):
+    if not arg:
+        return None
+    return datetime.date(*map(int, arg[:10].split('-')))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [OPTIONS]")
+    parser.add_option("-p", "--port", type="int", default=0,
+        help="port to listen on (default: any free port)")
+    parser.add_option("-n", "--num-events", type="int", default=100,
+        help="number of events in each events.* response (default: 100)")
+    parser.add_option("--notes-size", type="int", default=40,
+        help="approximate size of each event's notes (default: 40)")
+    parser.add_option("--latency", type="float", default=0.0,
+        help="seconds to wait before each response (default: 0)")
+    parser.add_option("--gzip", action="store_true", default=False,
+        help="gzip responses for clients that accept it")
+    parser.add_option("--capacity", type="int",
+        help="requests handled at once, others get a 503 (default: no limit)")
+    parser.add_option("--slow-fraction", type="float", default=0.0,
+        help="fraction of requests that are slow (default: 0)")
+    parser.add_option("--slow-latency", type="float", default=0.0,
+        help="seconds to wait before slow responses (default: 0)")
+    opts, args = parser.parse_args(argv[1:])
+    server = MockServer(opts.port, num_events=opts.num_events,
+                        notes_size=opts.notes_size, latency=opts.latency,
+                        gzip=opts.gzip, capacity=opts.capacity,
+                        slow_fraction=opts.slow_fraction,
+                        slow_latency=opts.slow_latency)
+    print "serving on %s" % server.url
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Stress one `ThirtyBoxes' shared by many threads against the local
+mock server (mock_server.py) and check that nothing goes wrong.
+
+    usage: python bench/stress_threads.py [THREADS [SECONDS]]
+
+The threads make a random mix of calls -- with a cache, an event store,
+indexes, a rate limiter, coalescing and observers all in use -- while
+another thread keeps changing the credentials. Each result is checked,
+as is that every request used a matching API key and auth token. The
+exit status is non-zero if there were any errors.
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import threading
+import traceback
+import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thirtyboxes
+from bench.mock_server import MockServer
+
+
+def _check(condition, what):
+    if not condition:
+        raise AssertionError(what)
+
+def _date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+def _check_events(event_list, start, end):
+    for event in event_list["events"]:
+        _check(start <= _date(event["start"]) <= end,
+               "event %s starts outside %s to %s"
+               % (event["id"], start, end))
+
+def _random_range(rand):
+    start = datetime.date(2009, 1, 1) \
+            + datetime.timedelta(days=rand.randrange(300))
+    return start, start + datetime.timedelta(days=rand.randrange(1, 60))
+
+def call_find_user(tb, rand):
+    id = rand.randrange(1, 50)
+    _check(tb.find_user(id)["id"] == id, "wrong user")
+
+def call_events(tb, rand):
+    start, end = _random_range(rand)
+    _check_events(tb.events(start, end), start, end)
+
+def call_iter_events(tb, rand):
+    start, end = _random_range(rand)
+    events = list(tb.iter_events(start, end))
+    _check_events({"events": events}, start, end)
+
+def call_search(tb, rand):
+    _check("events" in tb.search(rand.choice(["bike", "lunch"])),
+           "no search results")
+
+def call_local_search(tb, rand):
+    for event in tb.search("bike", local=True)["events"]:
+        _check(event["id"] is not None, "bad indexed event")
+
+def call_tag_query(tb, rand):
+    for event in tb.tag_query("work | family")["events"]:
+        _check(event["id"] is not None, "bad tagged event")
+
+def call_ping(tb, rand):
+    _check(tb.ping()["ping"] == "pong", "bad ping")
+
+CALLS = [call_find_user, call_events, call_iter_events, call_search,
+         call_local_search, call_tag_query, call_ping]
+
+
+class Checker(object):
+    """An observer checking that each request used matching credentials
+    (key-N with token-N).
+    """
+    def __init__(self):
+        self.errors = []
+
+    def __call__(self, stats):
+        args = dict(urlparse.parse_qsl(urlparse.urlsplit(stats.url)[3]))
+        token = args.get("authorizedUserToken")
+        if token is not None and \
+           token.split('-')[1] != args["apiKey"].split('-')[1]:
+            self.errors.append("mismatched credentials: %s" % stats.url)
+
+
+def main(argv):
+    num_threads = len(argv) > 1 and int(argv[1]) or 16
+    seconds = len(argv) > 2 and float(argv[2]) or 5.0
+    server = MockServer(num_events=50, latency=0.002)
+    server.start()
+    thirtyboxes.API_URL = server.url
+    pool = thirtyboxes.ConnectionPool(max_per_host=num_threads)
+    tb = thirtyboxes.ThirtyBoxes("key-0", "token-0", pool=pool,
+        cache=thirtyboxes.ResponseCache(),
+        store=thirtyboxes.EventStore(), store_max_age=1,
+        index=thirtyboxes.SearchIndex(), tag_index=thirtyboxes.TagIndex(),
+        limiter=thirtyboxes.RateLimiter(concurrency=num_threads),
+        coalesce=True)
+    stats = thirtyboxes.StatsCollector()
+    checker = Checker()
+    tb.add_observer(stats)
+    tb.add_observer(checker)
+
+    errors = []
+    counts = {}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+    def worker(seed):
+        rand = random.Random(seed)
+        while time.time() < deadline:
+            call = rand.choice(CALLS)
+            try:
+                call(tb, rand)
+            except Exception:
+                errors.append("%s: %s" % (call.__name__,
+                                          traceback.format_exc()))
+            lock.acquire()
+            try:
+                counts[call.__name__] = counts.get(call.__name__, 0) + 1
+            finally:
+                lock.release()
+    def switch_credentials():
+        n = 0
+        while time.time() < deadline:
+            n += 1
+            tb.set_credentials("key-%d" % n, "token-%d" % n)
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(num_threads)]
+    threads.append(threading.Thread(target=switch_credentials))
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+        server.stop()
+
+    print "%d threads for %.1fs: %d calls" % (num_threads, seconds,
+                                               sum(counts.values()))
+    for name, count in sorted(counts.items()):
+        print "    %-18s %d" % (name, count)
+    print stats.report()
+    errors += checker.errors
+    for error in errors[:10]:
+        print "ERROR:", error
+    if errors:
+        print "%d errors" % len(errors)
+        return 1
+    print "no errors"
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,911 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2009 ActiveState Software Inc.
+# License: MIT License (http://www.opensource.org/licenses/mit-license.php)
+
+"""Unit tests for the parts of thirtyboxes.py that don't need the
+server.
+
+    usage: python test/test_thirtyboxes.py [-v]
+"""
+
+import os
+import sys
+import time
+import shutil
+import socket
+import sqlite3
+import datetime
+import threading
+import tempfile
+import unittest
+import urllib2
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thirtyboxes
+from bench import fixtures, mock_server
+
+
+def _event(id, day, tags="", last_update="2009-01-01 00:00:00"):
+    return {"id": id, "start": datetime.datetime(2009, 3, day, 9, 0),
+            "end": None, "tags": tags, "lastUpdate": last_update}
+
+def _event_list(events, user_id):
+    return {"events": events, "userId": user_id}
+
+
+class IntervalSetTestCase(unittest.TestCase):
+    def test_add_merges(self):
+        intervals = thirtyboxes._IntervalSet([(5, 7), (1, 3), (3, 4)])
+        self.assertEqual(list(intervals), [(1, 4), (5, 7)])
+        intervals.add(4, 5)
+        self.assertEqual(list(intervals), [(1, 7)])
+        intervals.add(10, 12)
+        intervals.add(0, 11)
+        self.assertEqual(list(intervals), [(0, 12)])
+
+    def test_add_empty(self):
+        intervals = thirtyboxes._IntervalSet([(3, 3), (5, 4)])
+        self.assertEqual(list(intervals), [])
+
+    def test_gaps(self):
+        intervals = thirtyboxes._IntervalSet([(2, 4), (6, 8)])
+        self.assertEqual(intervals.gaps(0, 10),
+                         [(0, 2), (4, 6), (8, 10)])
+        self.assertEqual(intervals.gaps(2, 8), [(4, 6)])
+        self.assertEqual(intervals.gaps(3, 4), [])
+        self.assertEqual(intervals.gaps(4, 6), [(4, 6)])
+        self.assertEqual(intervals.gaps(8, 9), [(8, 9)])
+        self.assertEqual(thirtyboxes._IntervalSet().gaps(1, 2), [(1, 2)])
+        self.failUnless(intervals.covers(6, 8))
+        self.failIf(intervals.covers(3, 7))
+
+
+class _EventStoreTests(object):
+    """Tests run against each event store class."""
+    def setUp(self):
+        self.store = self.new_store()
+
+    def test_owners_are_partitioned(self):
+        start, end = datetime.date(2009, 3, 1), datetime.date(2009, 3, 31)
+        thirtyboxes._update_store(self.store,
+            _event_list([_event(1, 2, "work"), _event(2, 3)], 11),
+            start, end, "token-a")
+        thirtyboxes._update_store(self.store,
+            _event_list([_event(3, 4, "work")], 22),
+            start, end, "token-b")
+
+        event_list = thirtyboxes._event_list_from_store(self.store, start,
+                                                        end, "token-a")
+        self.assertEqual([e["id"] for e in event_list["events"]], [1, 2])
+        self.assertEqual(event_list["userId"], 11)
+        event_list = thirtyboxes._event_list_from_store(self.store, start,
+                                                        end, "token-b")
+        self.assertEqual([e["id"] for e in event_list["events"]], [3])
+        self.assertEqual(event_list["userId"], 22)
+        self.assertEqual(
+            [e["id"] for e in self.store.events_with_tag("work", "token-b")],
+            [3])
+        self.assertEqual(self.store.get(1, "token-b"), None)
+        self.assertEqual(len(self.store), 3)
+
+    def test_coverage_is_per_owner(self):
+        start, end = datetime.date(2009, 3, 1), datetime.date(2009, 3, 31)
+        thirtyboxes._update_store(self.store, _event_list([_event(1, 2)], 11),
+                                  start, end, "token-a")
+        self.failUnless(self.store.covers(start, end, owner="token-a"))
+        self.failIf(self.store.covers(start, end, owner="token-b"))
+
+    def test_update_only_deletes_own_events(self):
+        start, end = datetime.date(2009, 3, 1), datetime.date(2009, 3, 31)
+        thirtyboxes._update_store(self.store, _event_list([_event(1, 2)], 11),
+                                  start, end, "token-a")
+        thirtyboxes._update_store(self.store, _event_list([_event(1, 2)], 22),
+                                  start, end, "token-b")
+        deleted = thirtyboxes._update_store(self.store, _event_list([], 22),
+                                            start, end, "token-b")
+        self.assertEqual(deleted, [1])
+        self.assertEqual(self.store.get(1, "token-a")["id"], 1)
+        self.assertEqual(self.store.get(1, "token-b"), None)
+
+    def test_upsert_duplicate_ids(self):
+        self.store.upsert([_event(1, 2, "work home"), _event(2, 3),
+                           _event(1, 4, "home", "2009-01-02 00:00:00")])
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(self.store.get(1)["start"].day, 4)
+        self.assertEqual(self.store.last_update(1), "2009-01-02 00:00:00")
+        self.assertEqual(
+            [e["id"] for e in self.store.events_with_tag("home")], [1])
+        self.assertEqual(self.store.events_with_tag("work"), [])
+
+
+class EventStoreTestCase(_EventStoreTests, unittest.TestCase):
+    def new_store(self):
+        return thirtyboxes.EventStore()
+
+class SQLiteEventStoreTestCase(_EventStoreTests, unittest.TestCase):
+    def new_store(self):
+        return thirtyboxes.SQLiteEventStore(":memory:")
+    def tearDown(self):
+        self.store.close()
+
+
+class SQLiteEventStoreFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "events.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_private_file(self):
+        start, end = datetime.date(2009, 3, 1), datetime.date(2009, 3, 31)
+        store = thirtyboxes.SQLiteEventStore(self.path)
+        thirtyboxes._update_store(store, _event_list([_event(1, 2)], 11),
+                                  start, end, "secret-token")
+        store.close()
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+        self.failIf("secret-token" in open(self.path, "rb").read())
+        store = thirtyboxes.SQLiteEventStore(self.path)
+        self.assertEqual(store.get(1, "secret-token")["id"], 1)
+        self.assertEqual(store.get_user_id("secret-token"), 11)
+        self.failUnless(store.covers(start, end, owner="secret-token"))
+        store.close()
+
+    def test_events_round_trip_as_json(self):
+        event = {"id": 1, "summary": u"caf\xe9", "allDayEvent": True,
+                 "start": datetime.date(2009, 3, 2),
+                 "end": datetime.datetime(2009, 3, 2, 10, 30),
+                 "repeatEndDate": None, "tags": "work",
+                 "lastUpdate": "2009-01-01 00:00:00",
+                 "invitation": {"isInvitation": False}}
+        record = thirtyboxes.Event(**dict(event, id=2))
+        store = thirtyboxes.SQLiteEventStore(self.path)
+        store.upsert([event, record])
+        store.close()
+        conn = sqlite3.connect(self.path)
+        for (data,) in conn.execute("SELECT data FROM events"):
+            self.assertEqual(data[:1], "{")
+        conn.close()
+        store = thirtyboxes.SQLiteEventStore(self.path)
+        self.assertEqual(store.get(1), event)
+        self.assertEqual(type(store.get(1)), dict)
+        self.assertEqual(store.get(2), record)
+        self.failUnless(isinstance(store.get(2), thirtyboxes.Event))
+        self.assertEqual(type(store.get(2)["end"]), datetime.datetime)
+        self.assertEqual(type(store.get(2)["start"]), datetime.date)
+        store.close()
+
+    def test_old_schema_is_rebuilt(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript("""
+            CREATE TABLE events (id INTEGER PRIMARY KEY, start_time TEXT,
+                                 end_time TEXT, last_update TEXT, data BLOB);
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            INSERT INTO events VALUES (1, '2009-03-02', NULL, NULL, 'x');
+        """)
+        conn.commit()
+        conn.close()
+        store = thirtyboxes.SQLiteEventStore(self.path)
+        self.assertEqual(len(store), 0)
+        store.upsert([_event(2, 3)], "token")
+        self.assertEqual(store.get(2, "token")["id"], 2)
+        store.close()
+
+    def test_newer_schema_is_refused(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA user_version = 1000")
+        conn.close()
+        self.assertRaises(thirtyboxes.ThirtyBoxesError,
+                          thirtyboxes.SQLiteEventStore, self.path)
+
+
+class _RedirectingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    redirects = {"/a": "/b", "/b": "http://%(host)s/c", "/loop": "/loop"}
+
+    def do_GET(self):
+        location = self.redirects.get(self.path)
+        if location is None:
+            self.send_response(200)
+            body = "at %s" % self.path
+        else:
+            self.send_response(302)
+            self.send_header("Location", location % {
+                "host": "%s:%d" % self.server.server_address})
+            body = ""
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                _RedirectingHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+        self.pool = thirtyboxes.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_redirects(self):
+        self.assertEqual(self.pool.request(self.url + "/a"), "at /c")
+
+    def test_redirect_loop(self):
+        try:
+            self.pool.request(self.url + "/loop")
+        except urllib2.HTTPError, ex:
+            self.assertEqual(ex.code, 302)
+        else:
+            self.fail("redirect loop not stopped")
+
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = thirtyboxes.DiskCache(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put_get(self):
+        self.cache.put("user.FindById", "key", "<rsp/>")
+        self.assertEqual(self.cache.get("user.FindById", "key"), "<rsp/>")
+        self.assertEqual(self.cache.get("user.FindById", "other"), None)
+
+    def test_failed_put_leaves_no_tmp_file(self):
+        # A directory in the way makes the rename fail.
+        os.mkdir(self.cache._path_from_key("key"))
+        self.cache.put("user.FindById", "key", "<rsp/>")
+        self.assertEqual([name for name in os.listdir(self.dir)
+                          if name.endswith(".tmp")], [])
+
+
+class ParseResponseTestCase(unittest.TestCase):
+    """The compiled expat parser must give the same values (and errors)
+    as the ElementTree one.
+    """
+    # Non-ASCII text, entities, notes with line breaks, empty elements.
+    extra_event_xml = (
+        "<event><allDayEvent>0</allDayEvent>"
+        "<repeatEndDate>2009-06-30</repeatEndDate>"
+        "<repeatType>weekly</repeatType>"
+        "<repeatSkipDates>2009-03-17,2009-03-24</repeatSkipDates>"
+        "<repeatICal/><reminder>15</reminder><externalUID/>"
+        "<lastUpdate>2009-03-01 08:30:00</lastUpdate>"
+        "<start>2009-03-03 18:00:00</start><end>2009-03-03 19:00:00</end>"
+        "<summary>Caf\xc3\xa9 &amp; cr\xc3\xaapes</summary>"
+        "<notes>first line<br/>second &lt;line&gt;<br/></notes>"
+        "<id>42</id><invitation><isInvitation>1</isInvitation>"
+        "</invitation><tags>food caf\xc3\xa9</tags>"
+        "<privacy>private</privacy></event>")
+
+    def _events_xml(self):
+        xml = fixtures.events_xml(30, notes_size=80)
+        return xml.replace("</eventList>",
+                           self.extra_event_xml + "</eventList>")
+
+    def _assertSameParse(self, what, xml, unmarshallers):
+        compiled = thirtyboxes._parse_response(what, xml, unmarshallers)
+        etree = thirtyboxes._etree_parse_response(what, xml, unmarshallers)
+        self.assertEqual(compiled, etree)
+        return compiled
+
+    def test_events(self):
+        xml = self._events_xml()
+        for unmarshallers in (thirtyboxes._events_unmarshallers,
+                              thirtyboxes._record_events_unmarshallers,
+                              thirtyboxes._lazy_events_unmarshallers):
+            event_list = self._assertSameParse("events", xml, unmarshallers)
+            self.assertEqual(len(event_list["events"]), 31)
+            event = event_list["events"][-1]
+            self.assertEqual(event["summary"], u"Caf\xe9 & cr\xeapes")
+            self.assertEqual(event["start"],
+                             datetime.datetime(2009, 3, 3, 18, 0))
+
+    def test_iter_events(self):
+        xml = self._events_xml()
+        unmarshallers = thirtyboxes._events_unmarshallers
+        self.assertEqual(
+            list(thirtyboxes._iter_events_from_response(xml, unmarshallers)),
+            list(thirtyboxes._etree_iter_events_from_response(
+                xml, unmarshallers)))
+
+    def test_user(self):
+        for unmarshallers in (thirtyboxes._user_unmarshallers,
+                              thirtyboxes._record_user_unmarshallers):
+            user = self._assertSameParse("user", fixtures.user_xml(1234),
+                                         unmarshallers)
+            self.assertEqual(user["id"], 1234)
+
+    def test_errors(self):
+        xml = fixtures.error_xml(3, "Bad <token>")
+        errors = []
+        for parse in (thirtyboxes._parse_response,
+                      thirtyboxes._etree_parse_response):
+            try:
+                parse("user", xml, thirtyboxes._user_unmarshallers)
+            except thirtyboxes.ThirtyBoxesAPIError, ex:
+                errors.append(str(ex))
+            else:
+                self.fail("no error raised")
+        self.assertEqual(errors[0], errors[1])
+
+    def test_bad_datetime(self):
+        xml = self._events_xml().replace("2009-03-03 18:00:00",
+                                         "2009-13-03 18:00:00")
+        errors = []
+        for parse in (thirtyboxes._parse_response,
+                      thirtyboxes._etree_parse_response):
+            try:
+                parse("events", xml, thirtyboxes._events_unmarshallers)
+            except thirtyboxes.ThirtyBoxesError, ex:
+                errors.append(str(ex))
+            else:
+                self.fail("no error raised")
+        self.assertEqual(errors[0], errors[1])
+
+
+class DatetimeParseTestCase(unittest.TestCase):
+    """The fast date(time) parsing must give the same values and errors
+    as `_parse_datetime_str()'.
+    """
+    good = ["2009-03-14", "2009-03-14 09:26:53", "0000-00-00",
+            "2009-3-4", "2009-03-14 9:26:53", "2009-03-14  09:26:53",
+            "2009-03-14 09:26"]
+    bad = ["", "2009", "2009-13-01", "2009-02-30", "2009-03-14 25:00:00",
+           "2009-03-1x", "20090314", "2009/03/14",
+           "2009-03-14T09:26:53", "2009-03-14 09:26:53.5", None, 20090314]
+
+    def _result(self, func, datetime_str):
+        try:
+            return func(datetime_str, "test")
+        except thirtyboxes.ThirtyBoxesError, ex:
+            return str(ex)
+        except Exception, ex:
+            return type(ex)
+
+    def test_same_as_slow_parser(self):
+        slow = thirtyboxes._parse_datetime_str
+        for datetime_str in self.good + self.bad:
+            expected = self._result(slow, datetime_str)
+            # Twice: the second may come from the memo.
+            for i in range(2):
+                self.assertEqual(
+                    self._result(thirtyboxes._datetime_from_datetime_str,
+                                 datetime_str), expected, datetime_str)
+                self.assertEqual(
+                    self._result(lambda s, purpose:
+                        thirtyboxes._datetimes_from_datetime_strs(
+                            [s], purpose)[0], datetime_str),
+                    expected, datetime_str)
+
+    def test_bad_strings_raise(self):
+        for datetime_str in self.bad:
+            self.assertRaises(thirtyboxes.ThirtyBoxesError,
+                thirtyboxes._datetime_from_datetime_str, datetime_str)
+
+
+class MergeEventListsTestCase(unittest.TestCase):
+    def test_merge(self):
+        d = datetime.datetime
+        first = {"listStart": d(2009, 3, 1), "listEnd": d(2009, 3, 10),
+                 "userId": 1,
+                 "events": [{"id": 1, "start": d(2009, 3, 9, 9)},
+                            {"id": 2, "start": None},
+                            {"id": 1, "start": d(2009, 3, 2, 9)}]}
+        # Overlapping windows repeat an occurrence.
+        second = {"listStart": d(2009, 3, 9), "listEnd": d(2009, 3, 20),
+                  "userId": 1,
+                  "events": [{"id": 1, "start": d(2009, 3, 9, 9)},
+                             {"id": 1, "start": d(2009, 3, 16, 9)},
+                             {"id": 3, "start": datetime.date(2009, 3, 5)}]}
+        merged = thirtyboxes._merge_event_lists([first, second])
+        self.assertEqual([(e["id"], e["start"]) for e in merged["events"]],
+                         [(1, d(2009, 3, 2, 9)),
+                          (3, datetime.date(2009, 3, 5)),
+                          (1, d(2009, 3, 9, 9)), (1, d(2009, 3, 16, 9)),
+                          (2, None)])
+        self.assertEqual((merged["listStart"], merged["listEnd"]),
+                         (d(2009, 3, 1), d(2009, 3, 20)))
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = thirtyboxes.SearchIndex([
+            dict(_event(1, 2, "work"), summary="Bike ride",
+                 notes="along the river"),
+            dict(_event(2, 3, "bike"), summary="Lunch with Joe",
+                 notes=None),
+            dict(_event(3, 4), summary="Dentist", notes="bring the bike"),
+            dict(_event(4, 5), summary="Biking club", notes=None),
+        ])
+
+    def ids(self, query, **kwargs):
+        return [e["id"] for e in self.index.search(query, **kwargs)]
+
+    def test_ranking(self):
+        # summary matches rank above tags above notes
+        self.assertEqual(self.ids("bike"), [1, 2, 3])
+        self.assertEqual(self.ids("BIKE"), [1, 2, 3])
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(self.ids("bike river"), [1])
+        self.assertEqual(self.ids("bike nosuchword"), [])
+        self.assertEqual(self.ids(""), [])
+        self.assertEqual(self.ids("!!"), [])
+
+    def test_prefix(self):
+        self.assertEqual(sorted(self.ids("bik*")), [1, 2, 3, 4])
+        self.assertEqual(self.ids("den*"), [3])
+        self.assertEqual(self.ids("zzz*"), [])
+
+    def test_date_restriction_and_limit(self):
+        self.assertEqual(self.ids("bike", start=datetime.date(2009, 3, 3)),
+                         [2, 3])
+        self.assertEqual(self.ids("bike", end=datetime.date(2009, 3, 3)),
+                         [1, 2])
+        self.assertEqual(self.ids("bike", start=datetime.date(2009, 3, 3),
+                                  end=datetime.date(2009, 3, 3)), [2])
+        self.assertEqual(self.ids("bike", limit=2), [1, 2])
+
+    def test_update_and_remove(self):
+        self.index.update([dict(_event(1, 2), summary="Swim", notes=None)])
+        self.assertEqual(self.ids("bike"), [2, 3])
+        self.assertEqual(self.ids("swim"), [1])
+        self.assertEqual(self.ids("sw*"), [1])
+        self.index.remove([1, 2, 99])
+        self.assertEqual(self.ids("bike"), [3])
+        self.assertEqual(self.ids("swim"), [])
+        self.assertEqual(self.ids("sw*"), [])
+        self.assertEqual(len(self.index), 2)
+
+    def test_local_search(self):
+        tb = thirtyboxes.ThirtyBoxes("key", "token", index=self.index)
+        self.assertEqual(tb.search("bike", local=True)["events"], [])
+        tb._indexer()(_event_list(
+            [dict(_event(5, 6), summary="Bike repair", notes=None)], 11))
+        result = tb.search("bike", local=True)
+        self.assertEqual([e["id"] for e in result["events"]], [5])
+        self.assertEqual(result["userId"], 11)
+        self.assertEqual(result["search"], "bike")
+        self.assertRaises(thirtyboxes.ThirtyBoxesError,
+                          thirtyboxes.ThirtyBoxes("key", "token").search,
+                          "bike", local=True)
+
+
+class IndexOwnerTestCase(unittest.TestCase):
+    """Indexing of fetched events by a `ThirtyBoxes' with a
+    `SearchIndex'.
+    """
+    def setUp(self):
+        self.index = thirtyboxes.SearchIndex()
+        self.tb = thirtyboxes.ThirtyBoxes("key", "token-a", index=self.index)
+
+    def _fetched(self, events, user_id, refetched=True):
+        event_list = _event_list(events, user_id)
+        event_list["listStart"] = datetime.date(2009, 3, 1)
+        event_list["listEnd"] = datetime.date(2009, 3, 10)
+        self.tb._indexer(refetched)(event_list)
+
+    def _search(self, query):
+        return [e["id"] for e in self.tb.search(query, local=True)["events"]]
+
+    def test_owners_are_partitioned(self):
+        self._fetched([_event(1, 2, "lunch")], 11)
+        self.tb.set_credentials("key", "token-b")
+        self.assertEqual(self._search("lunch"), [])
+        self._fetched([_event(2, 3, "lunch")], 22)
+        self.assertEqual(self._search("lunch"), [2])
+        self.assertEqual(self.tb.search("lunch", local=True)["userId"], 22)
+        self.tb.set_credentials("key", "token-a")
+        self.assertEqual(self._search("lunch"), [1])
+        self.assertEqual(self.tb.search("lunch", local=True)["userId"], 11)
+        self.assertEqual(len(self.index), 2)
+
+    def test_refetch_drops_deleted_events(self):
+        self._fetched([_event(1, 2, "lunch"), _event(2, 3, "lunch"),
+                       _event(3, 20, "lunch")], 11)
+        self._fetched([_event(2, 3, "lunch")], 11)
+        # Event 3 is outside the refetched range.
+        self.assertEqual(sorted(self._search("lunch")), [2, 3])
+
+    def test_search_results_keep_other_events(self):
+        self._fetched([_event(1, 2, "lunch"), _event(2, 3, "lunch")], 11)
+        self._fetched([_event(2, 3, "lunch")], 11, refetched=False)
+        self.assertEqual(sorted(self._search("lunch")), [1, 2])
+
+
+class TagIndexTestCase(unittest.TestCase):
+    def test_query(self):
+        events = [_event(id, id % 28 + 1, id % 3 and "a" or "a b")
+                  for id in range(200)]
+        index = thirtyboxes.TagIndex(events)
+        index.remove(range(0, 200, 2))
+        def ids(query):
+            return sorted(e["id"] for e in index.query(query))
+        self.assertEqual(ids("a"), range(1, 200, 2))
+        self.assertEqual(ids("b"), range(3, 200, 6))
+        self.assertEqual(ids("a & !b"),
+                         [id for id in range(1, 200, 2) if id % 3])
+        self.assertEqual(ids("nosuchtag"), [])
+
+
+class TagQueryTestCase(unittest.TestCase):
+    """`ThirtyBoxes.tag_query()' with a `TagIndex'."""
+    def setUp(self):
+        self.index = thirtyboxes.TagIndex()
+        self.tb = thirtyboxes.ThirtyBoxes("key", "token-a",
+                                          tag_index=self.index)
+        self.tag_searches = []
+        self.events_with_tag = {}
+        def tag_search(tag, owner):
+            self.tag_searches.append((tag, owner))
+            events = self.events_with_tag.get((tag, owner), [])
+            self.tb._indexer(owner=owner)(_event_list(events, 11))
+        self.tb._tag_search = tag_search
+
+    def ids(self, query):
+        return [e["id"] for e in self.tb.tag_query(query)["events"]]
+
+    def test_fetched_events_dont_complete_a_tag(self):
+        self.tb._indexer()(_event_list([_event(1, 2, "work")], 11))
+        self.events_with_tag[("work", "token-a")] = [_event(1, 2, "work"),
+                                                     _event(2, 20, "work")]
+        self.failIf(self.index.is_searched("work", "token-a"))
+        self.assertEqual(self.ids("work"), [1, 2])
+        self.assertEqual(self.tag_searches, [("work", "token-a")])
+        self.failUnless(self.index.is_searched("work", "token-a"))
+        self.assertEqual(self.ids("work"), [1, 2])
+        self.assertEqual(len(self.tag_searches), 1)
+
+    def test_owners_are_partitioned(self):
+        self.events_with_tag[("work", "token-a")] = [_event(1, 2, "work")]
+        self.events_with_tag[("work", "token-b")] = [_event(2, 3, "work")]
+        self.assertEqual(self.ids("work"), [1])
+        self.tb.set_credentials("key", "token-b")
+        self.failIf(self.index.is_searched("work", "token-b"))
+        self.assertEqual(self.ids("work"), [2])
+        self.assertEqual(self.ids("!work"), [])
+        self.assertEqual(self.tag_searches,
+                         [("work", "token-a"), ("work", "token-b")])
+
+
+class ParseTagQueryTestCase(unittest.TestCase):
+    def assertParses(self, query, tree):
+        self.assertEqual(thirtyboxes._parse_tag_query(query), tree)
+
+    def test_tag(self):
+        self.assertParses("work", ("tag", "work"))
+        self.assertParses("  work  ", ("tag", "work"))
+
+    def test_precedence(self):
+        self.assertParses("a | b & c",
+            ("or", ("tag", "a"), ("and", ("tag", "b"), ("tag", "c"))))
+        self.assertParses("a & b | c",
+            ("or", ("and", ("tag", "a"), ("tag", "b")), ("tag", "c")))
+        self.assertParses("(a | b) & c",
+            ("and", ("or", ("tag", "a"), ("tag", "b")), ("tag", "c")))
+        self.assertParses("!a & b",
+            ("and", ("not", ("tag", "a")), ("tag", "b")))
+        self.assertParses("!!a", ("not", ("not", ("tag", "a"))))
+
+    def test_implicit_and(self):
+        self.assertParses("a b", ("and", ("tag", "a"), ("tag", "b")))
+        self.assertParses("a !b|c",
+            ("or", ("and", ("tag", "a"), ("not", ("tag", "b"))),
+             ("tag", "c")))
+
+    def test_left_associative(self):
+        self.assertParses("a | b | c",
+            ("or", ("or", ("tag", "a"), ("tag", "b")), ("tag", "c")))
+
+    def test_errors(self):
+        for query in ["", "a |", "(a", "a)", "a & & b", "!", "| a"]:
+            self.assertRaises(thirtyboxes.ThirtyBoxesError,
+                              thirtyboxes._parse_tag_query, query)
+
+
+class HedgePolicyTestCase(unittest.TestCase):
+    def test_delay(self):
+        policy = thirtyboxes.HedgePolicy(percentile=0.5, min_samples=3)
+        self.assertEqual(policy.delay("user.FindById"), None)
+        for latency in (0.3, 0.1, 0.2):
+            policy.add("user.FindById", latency)
+        self.assertEqual(policy.delay("user.FindById"), 0.2)
+        self.assertEqual(policy.delay("test.Ping"), None)
+
+    def test_budget(self):
+        policy = thirtyboxes.HedgePolicy(budget=0.1, window=50)
+        # Every call wants a hedge, as when the server has slowed down.
+        hedges = 0
+        for i in range(1000):
+            policy.delay("user.FindById")
+            if policy.allow_hedge():
+                hedges += 1
+        self.failUnless(95 <= hedges <= 100, hedges)
+
+    def test_budget_burst(self):
+        policy = thirtyboxes.HedgePolicy(budget=0.1, window=50)
+        for i in range(1000):
+            policy.delay("user.FindById")
+        hedges = 0
+        while policy.allow_hedge():
+            hedges += 1
+        self.assertEqual(hedges, 5)
+
+
+class TwoTokenTestCase(unittest.TestCase):
+    """Two clients for different accounts sharing one event store."""
+    def _client(self, store, token, events, user_id):
+        tb = thirtyboxes.ThirtyBoxes("key", token, store=store)
+        tb._fetch_events = lambda start, end: _event_list(events, user_id)
+        return tb
+
+    def test_shared_store(self):
+        store = thirtyboxes.EventStore()
+        tb_a = self._client(store, "token-a", [_event(1, 2)], 11)
+        tb_b = self._client(store, "token-b", [_event(2, 3)], 22)
+        start, end = datetime.date(2009, 3, 1), datetime.date(2009, 3, 31)
+        self.assertEqual([e["id"] for e in tb_a.events(start, end)["events"]],
+                         [1])
+        event_list = tb_b.events(start, end)
+        self.assertEqual([e["id"] for e in event_list["events"]], [2])
+        self.assertEqual(event_list["userId"], 22)
+
+
+class RecordTestCase(unittest.TestCase):
+    def test_unhashable(self):
+        event = thirtyboxes.Event(id=1, summary="lunch")
+        self.assertEqual(event, {"id": 1, "summary": "lunch"})
+        self.assertRaises(TypeError, hash, event)
+
+    def test_tags_not_interned(self):
+        self.assertFalse("tags" in thirtyboxes.Event._interned_fields)
+
+    def test_intern_bounded(self):
+        orig = thirtyboxes._interned_strings.copy()
+        try:
+            for i in range(thirtyboxes._MAX_INTERNED_STRINGS + 10):
+                thirtyboxes._intern("value %d" % i)
+            self.assertEqual(len(thirtyboxes._interned_strings),
+                             thirtyboxes._MAX_INTERNED_STRINGS)
+        finally:
+            thirtyboxes._interned_strings.clear()
+            thirtyboxes._interned_strings.update(orig)
+
+
+class LazyEventTestCase(unittest.TestCase):
+    def test_converted_by_another_thread(self):
+        event = thirtyboxes.LazyEvent(id=1)
+        event._raw["summary"] = "lunch"
+        self.assertEqual(event.summary, "lunch")
+        self.assertFalse("summary" in event._raw)
+        # As if another thread converted the field after this one
+        # missed the slot but before it looked in `_raw'.
+        self.assertEqual(event.__getattr__("summary"), "lunch")
+        self.assertRaises(AttributeError, event.__getattr__, "notes")
+
+
+class UserCacheTestCase(unittest.TestCase):
+    def _user(self, id, *emails):
+        return {"id": id, "emails": [{"address": e} for e in emails]}
+
+    def test_keys(self):
+        cache = thirtyboxes.UserCache()
+        user = self._user(1234, "Joe@Example.COM")
+        cache.add(user, " JOE@example.com")
+        self.assertTrue(cache.get(1234) is user)
+        self.assertTrue(cache.get("1234") is user)
+        self.assertTrue(cache.get("joe@example.com ") is user)
+        self.assertEqual(cache.get("jane@example.com"), None)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_ttl(self):
+        cache = thirtyboxes.UserCache(ttl=0.05)
+        cache.add(self._user(1234))
+        self.assertTrue(cache.get(1234) is not None)
+        time.sleep(0.1)
+        self.assertEqual(cache.get(1234), None)
+
+    def test_max_entries(self):
+        cache = thirtyboxes.UserCache(max_entries=3)
+        cache.add(self._user(1, "one@example.com"))
+        cache.add(self._user(2, "two@example.com"))
+        self.assertEqual(cache.get(1), None)
+        self.assertTrue(cache.get("one@example.com") is not None)
+        self.assertTrue(cache.get(2) is not None)
+        self.assertTrue(cache.get("two@example.com") is not None)
+
+
+class FindUsersTestCase(unittest.TestCase):
+    """find_users() against the mock server, which knows the users with
+    ids 1000 to 1999, at joe<id>@example.com.
+    """
+    def setUp(self):
+        self.requests = []
+        self.server = mock_server.MockServer()
+        self.server.responders.update({
+            "user.FindById": self._find_by_id,
+            "user.FindByEmail": self._find_by_email,
+        })
+        self.server.start()
+        self._orig_api_url = thirtyboxes.API_URL
+        thirtyboxes.API_URL = self.server.url
+
+    def tearDown(self):
+        thirtyboxes.API_URL = self._orig_api_url
+        self.server.stop()
+
+    def _user_xml(self, id):
+        if 1000 <= id < 2000:
+            return fixtures.user_xml(id)
+        return fixtures.error_xml(2, "No such user")
+
+    def _find_by_id(self, args):
+        self.requests.append(args["id"])
+        return self._user_xml(int(args["id"]))
+
+    def _find_by_email(self, args):
+        self.requests.append(args["email"])
+        email = args["email"]
+        if email.startswith("joe") and email.endswith("@example.com"):
+            return self._user_xml(int(email[3:-len("@example.com")]))
+        return self._user_xml(0)
+
+    def _check(self, users):
+        self.assertEqual(users[0]["id"], 1234)
+        self.assertTrue(users[1] is users[0])
+        self.assertTrue(isinstance(users[2], thirtyboxes.ThirtyBoxesError))
+        self.assertTrue(users[3] is users[0])
+        self.assertEqual(users[4]["id"], 1500)
+
+    def test_find_users(self):
+        tb = thirtyboxes.ThirtyBoxes("key", "token")
+        users = tb.find_users([1234, "JOE1234@example.com", 42, "1234",
+                               "joe1500@example.com"])
+        self._check(users)
+        self.assertEqual(sorted(self.requests),
+                         ["1234", "42", "joe1500@example.com"])
+
+    def test_find_users_cached(self):
+        tb = thirtyboxes.ThirtyBoxes("key", "token",
+                                     user_cache=thirtyboxes.UserCache())
+        tb.find_user("joe1500@example.com")
+        del self.requests[:]
+        users = tb.find_users([1234, "JOE1234@example.com", 42, "1234",
+                               1500])
+        self._check(users)
+        self.assertEqual(sorted(self.requests), ["1234", "42"])
+
+    def test_async_find_users(self):
+        tb = thirtyboxes.AsyncThirtyBoxes("key", "token")
+        users = tb.find_users([1234, 1234, "nobody@example.com", "1234",
+                               1500]).result()
+        self._check(users)
+        self.assertEqual(sorted(self.requests),
+                         ["1234", "1500", "nobody@example.com"])
+
+
+class SettleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = thirtyboxes._AsyncLoop(1)
+
+    def _failed(self, exc):
+        result = thirtyboxes.AsyncResult(self.loop)
+        try:
+            raise exc
+        except:
+            result._set_exc_info(sys.exc_info())
+        return result
+
+    def test_value(self):
+        result = thirtyboxes.AsyncResult(self.loop)
+        settled = thirtyboxes._settle(result)
+        self.assertFalse(settled.done())
+        result._set_value(42)
+        self.assertEqual(settled.result(), 42)
+
+    def test_exception(self):
+        error = thirtyboxes.ThirtyBoxesError("oops")
+        self.assertTrue(thirtyboxes._settle(self._failed(error)).result()
+                        is error)
+
+    def test_interrupt(self):
+        settled = thirtyboxes._settle(self._failed(KeyboardInterrupt()))
+        self.assertRaises(KeyboardInterrupt, settled.result)
+
+
+class CredentialsTestCase(unittest.TestCase):
+    def test_lock_per_instance(self):
+        api_a = thirtyboxes.RawThirtyBoxes("key-a", "token-a")
+        api_b = thirtyboxes.RawThirtyBoxes("key-b", "token-b")
+        self.assertTrue(api_a._credentials_lock
+                        is not api_b._credentials_lock)
+
+    def test_set_credentials_takes_lock(self):
+        api = thirtyboxes.RawThirtyBoxes("key", "token")
+        api._credentials_lock.acquire()
+        try:
+            t = threading.Thread(target=api.set_credentials,
+                                 args=("key2", "token2"))
+            t.start()
+            t.join(0.1)
+            self.assertTrue(t.isAlive())
+            self.assertEqual(api._credentials, ("key", "token"))
+        finally:
+            api._credentials_lock.release()
+        t.join()
+        api.apiKey = "key3"
+        self.assertEqual(api._credentials, ("key3", "token2"))
+
+
+class AsyncTimeoutTestCase(unittest.TestCase):
+    """Async calls to a server that never answers."""
+    def setUp(self):
+        # Listening without accepting: connects succeed, reads stall.
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(5)
+        self._orig_api_url = thirtyboxes.API_URL
+        thirtyboxes.API_URL = "http://127.0.0.1:%d/"\
+                              % self.server.getsockname()[1]
+
+    def tearDown(self):
+        thirtyboxes.API_URL = self._orig_api_url
+        self.server.close()
+
+    def test_timeout(self):
+        api = thirtyboxes.AsyncRawThirtyBoxes("key", "token",
+                                              max_in_flight=1, timeout=0.3)
+        pending = [api.user_FindById(id=1), api.user_FindById(id=2)]
+        start = time.time()
+        for result in pending:
+            self.assertRaises(thirtyboxes.ThirtyBoxesTimeoutError,
+                              result.result)
+        self.assertTrue(time.time() - start < 2)
+
+    def test_deadline(self):
+        api = thirtyboxes.AsyncRawThirtyBoxes("key", "token")
+        with thirtyboxes.deadline(0.3):
+            result = api.user_FindById(id=1)
+        self.assertRaises(thirtyboxes.ThirtyBoxesTimeoutError, result.result)
+
+
+class DaemonTimeoutTestCase(unittest.TestCase):
+    """Forwarding a command to a daemon that never replies."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, "daemon.sock")
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        self._orig = (thirtyboxes._daemon_socket_path,
+                      thirtyboxes._DAEMON_TIMEOUT)
+        thirtyboxes._daemon_socket_path = lambda: path
+        thirtyboxes._DAEMON_TIMEOUT = 0.2
+
+    def tearDown(self):
+        (thirtyboxes._daemon_socket_path,
+         thirtyboxes._DAEMON_TIMEOUT) = self._orig
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def test_runs_in_process(self):
+        start = time.time()
+        self.assertEqual(
+            thirtyboxes._forward_to_daemon(["thirtyboxes", "ping"]), None)
+        self.assertTrue(time.time() - start < 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -73,38 +73,38 @@ relevant help for details.
 __version_info__ = (0, 6, 0)
 __version__ = '.'.join(map(str, __version_info__))
 
+# Only cheap modules are imported here. Heavier ones (httplib, urllib2,
+# webbrowser, tempfile, hashlib, sqlite3, pprint, ElementTree) are
+# imported where they are first needed, to keep startup fast for
+# short-lived CLI runs.
 import os
 from os.path import expanduser, exists, join
 import sys
-import getopt
-import stat
+import errno
 import logging
-from urllib2 import urlopen, URLError
-import webbrowser
+import urlparse
+import socket
+import zlib
+import time
+import threading
+import asyncore
+from collections import deque, OrderedDict
 import datetime
 import operator
-from pprint import pprint
 from cStringIO import StringIO
 import re
 import warnings
+import bisect
+import math
 
-# Import ElementTree (needed for any by the "raw" interface).
+# Import expat for the fast response parser. ElementTree is used if it
+# isn't available.
 try:
-    import xml.etree.ElementTree as ET # in python >=2.5
+    from xml.parsers import expat
 except ImportError:
-    try:
-        import cElementTree as ET
-    except ImportError:
-        try:
-            import elementtree.ElementTree as ET
-        except ImportError:
-            try:
-                import lxml.etree as ET
-            except ImportError:
-                warnings.warn("could not import ElementTree "
-                              "(http://effbot.org/zone/element-index.htm) "
-                              "required for anything but the 'raw' 30boxes "
-                              "Python API")
+    expat = None
+
+ET = None # ElementTree, see `_etree()'
 
 
 #---- exceptions and globals
@@ -120,9 +120,38 @@ class ThirtyBoxesAPIError(ThirtyBoxesError):
     def __str__(self):
         return "[Error %d] %s" % (self.code, self.msg)
 
+class ThirtyBoxesTimeoutError(ThirtyBoxesError):
+    """An API call did not complete by its deadline (see `deadline()'
+    and the "timeout" argument to `RawThirtyBoxes').
+    """
+
 
 log = logging.getLogger("30boxes")
-API_URL = "http://30boxes.com/api/api.php"
+# Set THIRTYBOXES_API_URL to use another server, e.g. the benchmarks'
+# mock server (bench/mock_server.py).
+API_URL = os.environ.get("THIRTYBOXES_API_URL",
+                         "http://30boxes.com/api/api.php")
+
+# The largest date range the server allows for a single events.Get call.
+MAX_EVENTS_SPAN = datetime.timedelta(days=180)
+
+# Default number of seconds responses are cached, per API method (see
+# ResponseCache). Methods not listed are not cached.
+DEFAULT_CACHE_TTLS = {
+    "user.FindById": 300,
+    "user.FindByEmail": 300,
+    "user.GetAllInfo": 60,
+    "events.Get": 60,
+    "events.Search": 60,
+    "events.TagSearch": 60,
+}
+
+# API methods whose responses are never cached.
+_UNCACHEABLE_METHODS = set(["test.Ping", "user.Authorize", "getKeyForUser"])
+
+# Returned by _datetime_from_fixed_width_str() for strings it can't
+# parse (None is a valid result: the "0000-00-00" date).
+_UNPARSED = object()
 
 
 
@@ -224,14 +253,1263 @@ def events_TagSearch(tag, authorizedUserToken=None, apiKey=None):
 
 
 
+#---- HTTP transport
+
+# The redirects followed by `ConnectionPool.open()' (as by urllib2).
+_REDIRECT_STATUSES = (301, 302, 303, 307)
+_MAX_REDIRECTS = 10
+
+class ConnectionPool(object):
+    """A pool of persistent HTTP/1.1 (keep-alive) connections.
+
+        "max_size" (optional) is the maximum number of idle connections
+            kept open in the pool over all hosts. Default 10.
+        "max_per_host" (optional) is the maximum number of connections
+            to any one host that may be in use at once. Further requests
+            to that host block until a connection is released. Default 4.
+        "idle_timeout" (optional) is the number of seconds an idle
+            connection is kept around before being dropped. Default 60.
+
+    Responses are requested with "Accept-Encoding: gzip, deflate" and
+    decoded transparently (as they are read, for `open()'). A pool may be
+    shared by several `RawThirtyBoxes' instances.
+    """
+    def __init__(self, max_size=10, max_per_host=4, idle_timeout=60.0):
+        self.max_size = max_size
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}     # (scheme, host, port) -> [(conn, last_used), ...]
+        self._num_idle = 0
+        self._in_use = {}   # (scheme, host, port) -> number checked out
+        self._cond = threading.Condition()
+
+    def request(self, url, headers=None, deadline=None):
+        """GET the given URL and return the (decoded) response body."""
+        f = self.open(url, headers, deadline=deadline)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def open(self, url, headers=None, stats=None, deadline=None,
+             on_connect=None):
+        """GET the given URL and return a file-like object for the
+        (decoded) response body.
+
+        The connection is returned to the pool when the body has been
+        read to the end. Call `close()' on the returned object when done
+        with it: if the body was not read completely the connection is
+        closed.
+
+        If a `CallStats' is given as "stats" its connection fields are
+        filled in. If a "deadline" (a `time.time()' value) is given,
+        waiting for a connection, the request and reading the response
+        must all be done by then, else ThirtyBoxesTimeoutError is
+        raised. If given, "on_connect" is called (with no arguments)
+        once a connection has been acquired.
+
+        The returned object's `latency' is the number of seconds from
+        acquiring the connection to receiving the response headers.
+
+        Redirects (301, 302, 303 and 307 responses with a Location) are
+        followed, as by urllib2, up to `_MAX_REDIRECTS' of them.
+        """
+        num_redirects = 0
+        while True:
+            f, response = self._open(url, headers, stats, deadline,
+                                     on_connect)
+            location = response.getheader("location")
+            if response.status in _REDIRECT_STATUSES and location \
+               and num_redirects < _MAX_REDIRECTS:
+                f.close()
+                num_redirects += 1
+                url = urlparse.urljoin(url, location)
+                log.debug("redirected to `%s'", url)
+                continue
+            if response.status != 200:
+                f.close()
+                from urllib2 import HTTPError
+                raise HTTPError(url, response.status, response.reason,
+                                response.msg, None)
+            return f
+
+    def _open(self, url, headers, stats, deadline, on_connect):
+        """Make one GET request for `open()' and return a
+        (<response file object>, <httplib response>) 2-tuple.
+        """
+        scheme, host, port, selector = _split_url(url)
+        req_headers = {"Accept-Encoding": "gzip, deflate"}
+        if headers:
+            req_headers.update(headers)
+        key = (scheme, host, port)
+
+        import httplib
+        conn, reused = self._acquire(key, deadline)
+        if on_connect is not None:
+            on_connect()
+        sent = time.time()
+        try:
+            try:
+                _set_timeout(conn, deadline)
+                response = self._send(conn, selector, req_headers, stats)
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    raise
+                # The server likely dropped an idle keep-alive connection:
+                # retry once on a fresh one (in the time remaining).
+                conn.close()
+                conn, reused = self._new_conn(key), False
+                _set_timeout(conn, deadline)
+                response = self._send(conn, selector, req_headers, stats)
+        except socket.timeout:
+            conn.close()
+            self._release(key, None)
+            if deadline is None:
+                raise
+            raise ThirtyBoxesTimeoutError("`%s' timed out" % url)
+        except:
+            conn.close()
+            self._release(key, None)
+            raise
+
+        if stats is not None:
+            stats.reused = reused
+        f = _PooledResponse(self, key, conn, response, deadline)
+        f.latency = time.time() - sent
+        return f, response
+
+    def close(self):
+        """Close all idle connections."""
+        self._cond.acquire()
+        try:
+            for conns in self._idle.values():
+                for conn, last_used in conns:
+                    conn.close()
+            self._idle.clear()
+            self._num_idle = 0
+        finally:
+            self._cond.release()
+
+    def _send(self, conn, selector, headers, stats=None):
+        if stats is None:
+            conn.request("GET", selector, headers=headers)
+            return conn.getresponse()
+        start = time.time()
+        if conn.sock is None:
+            conn.connect()
+        connected = time.time()
+        conn.request("GET", selector, headers=headers)
+        response = conn.getresponse()
+        stats.connect_time = connected - start
+        stats.ttfb = time.time() - connected
+        return response
+
+    def _new_conn(self, key):
+        import httplib
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port)
+        else:
+            return httplib.HTTPConnection(host, port)
+
+    def _acquire(self, key, deadline=None):
+        """Return a (conn, reused) 2-tuple for the given host key."""
+        self._cond.acquire()
+        try:
+            while self._in_use.get(key, 0) >= self.max_per_host:
+                self._cond.wait(_remaining(deadline))
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+            conns = self._idle.get(key)
+            now = time.time()
+            while conns:
+                conn, last_used = conns.pop()
+                self._num_idle -= 1
+                if now - last_used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+        finally:
+            self._cond.release()
+        return self._new_conn(key), False
+
+    def _release(self, key, conn):
+        """Return a connection to the pool. `conn' is None if the
+        connection was closed.
+        """
+        self._cond.acquire()
+        try:
+            self._in_use[key] -= 1
+            if conn is not None:
+                if self._num_idle >= self.max_size:
+                    self._evict_oldest()
+                if self._num_idle < self.max_size:
+                    self._idle.setdefault(key, []).append((conn, time.time()))
+                    self._num_idle += 1
+                else:
+                    conn.close()
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def _evict_oldest(self):
+        oldest = None
+        for key, conns in self._idle.items():
+            if conns and (oldest is None or conns[0][1] < oldest[1]):
+                oldest = (key, conns[0][1])
+        if oldest is not None:
+            conn, last_used = self._idle[oldest[0]].pop(0)
+            conn.close()
+            self._num_idle -= 1
+
+
+
+class _PooledResponse(object):
+    """A file-like response body read from a `ConnectionPool' connection.
+
+    Gzip and deflate content encodings are decoded as the body is read.
+    """
+    chunk_size = 16384
+    latency = None # seconds from connection to response headers
+
+    def __init__(self, pool, key, conn, response, deadline=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._deadline = deadline
+        self._buf = ''
+        self._eof = False
+        self._decompressor = None
+        self._maybe_raw_deflate = False
+        encoding = (response.getheader("content-encoding") or "").lower()
+        if encoding in ("gzip", "x-gzip"):
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._decompressor = zlib.decompressobj()
+            self._maybe_raw_deflate = True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self._buf]
+            while not self._eof:
+                chunks.append(self._read_chunk())
+            self._buf = ''
+            return ''.join(chunks)
+        while len(self._buf) < size and not self._eof:
+            self._buf += self._read_chunk()
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        self._done(reusable=False)
+
+    def _read_chunk(self):
+        try:
+            sock = self._conn.sock
+            if self._deadline is not None and sock is not None:
+                sock.settimeout(_remaining(self._deadline))
+            data = self._response.read(self.chunk_size)
+        except socket.timeout:
+            self._done(reusable=False)
+            if self._deadline is None:
+                raise
+            raise ThirtyBoxesTimeoutError("reading the response timed out")
+        except:
+            self._done(reusable=False)
+            raise
+        if not data:
+            self._eof = True
+            self._done(reusable=True)
+            if self._decompressor is not None:
+                return self._decompressor.flush()
+            return ''
+        if self._decompressor is None:
+            return data
+        try:
+            decoded = self._decompressor.decompress(data)
+        except zlib.error:
+            if not self._maybe_raw_deflate:
+                raise
+            # Some servers send raw deflate data without the zlib header.
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self._decompressor.decompress(data)
+        self._maybe_raw_deflate = False
+        return decoded
+
+    def _done(self, reusable):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if reusable and not self._response.will_close:
+            self._pool._release(self._key, conn)
+        else:
+            conn.close()
+            self._pool._release(self._key, None)
+
+
+
+#---- response caching
+
+class ResponseCache(object):
+    """An in-memory cache of XML responses with per-method expiry and
+    LRU eviction.
+
+        "ttls" (optional) is a dict mapping an API method name (e.g.
+            "events.Get") to the number of seconds its responses are
+            kept. Methods not listed are not cached. It defaults to
+            DEFAULT_CACHE_TTLS.
+        "max_entries" (optional) is the maximum number of responses
+            kept. Default 1000.
+        "max_bytes" (optional) is the maximum total size of the
+            responses kept. Default 10MB.
+
+    Responses are keyed on the full API request URL, which includes the
+    API key and auth token. Hits, misses and evictions are counted in
+    the "hits", "misses" and "evictions" attributes.
+    """
+    def __init__(self, ttls=None, max_entries=1000, max_bytes=10*1024*1024):
+        if ttls is None:
+            ttls = DEFAULT_CACHE_TTLS
+        self.ttls = dict(ttls)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires, data)
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, method):
+        return method not in _UNCACHEABLE_METHODS \
+               and bool(self.ttls.get(method))
+
+    def get(self, method, key):
+        """Return the cached response for `key', or None."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, data = entry
+            if expires <= time.time():
+                self._num_bytes -= len(data)
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # most recently used
+            self.hits += 1
+            return data
+        finally:
+            self._lock.release()
+
+    def put(self, method, key, data):
+        if not self.is_cacheable(method) or len(data) > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._num_bytes -= len(old[1])
+            self._entries[key] = (time.time() + self.ttls[method], data)
+            self._num_bytes += len(data)
+            while len(self._entries) > self.max_entries \
+                  or self._num_bytes > self.max_bytes:
+                oldest_key, (expires, oldest_data) \
+                    = self._entries.popitem(last=False)
+                self._num_bytes -= len(oldest_data)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._num_bytes = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def num_bytes(self):
+        return self._num_bytes
+
+
+class DiskCache(object):
+    """A persistent, compressed cache of XML responses on disk.
+
+        "dir" (optional) is the cache directory. It defaults to
+            `~/.30boxes/cache'.
+        "ttls" (optional) is a dict mapping an API method name to the
+            number of seconds its responses are kept (see
+            `ResponseCache'). It defaults to DEFAULT_CACHE_TTLS.
+        "max_bytes" (optional) is the maximum total size of the cache
+            files. Default 20MB. The least recently used files are
+            removed to stay under this.
+        "refresh" (optional) is a boolean indicating that cached
+            responses should not be used, though new responses are
+            still cached. Default False.
+
+    Each response is stored zlib-compressed in its own file, along with
+    its expiry time. Files are written atomically (written to a
+    temporary file and renamed into place) so that concurrent processes
+    sharing the cache do not see partial entries. I/O errors are logged
+    and otherwise treated as cache misses.
+    """
+    def __init__(self, dir=None, ttls=None, max_bytes=20*1024*1024,
+                 refresh=False):
+        if dir is None:
+            dir = expanduser(join("~", ".30boxes", "cache"))
+        if ttls is None:
+            ttls = DEFAULT_CACHE_TTLS
+        self.dir = dir
+        self.ttls = dict(ttls)
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.hits = self.misses = self.evictions = 0
+
+    def is_cacheable(self, method):
+        return method not in _UNCACHEABLE_METHODS \
+               and bool(self.ttls.get(method))
+
+    def get(self, method, key):
+        """Return the cached response for `key', or None."""
+        if self.refresh:
+            self.misses += 1
+            return None
+        path = self._path_from_key(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                content = f.read()
+            finally:
+                f.close()
+            expires_str, data = content.split('\n', 1)
+            if float(expires_str) <= time.time():
+                os.remove(path)
+                data = None
+            else:
+                data = zlib.decompress(data)
+                os.utime(path, None)  # mark as recently used
+        except EnvironmentError, ex:
+            if ex.errno != errno.ENOENT:
+                log.debug("could not read cache file `%s': %s", path, ex)
+            data = None
+        except (ValueError, zlib.error), ex:
+            log.debug("corrupt cache file `%s': %s", path, ex)
+            data = None
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, method, key, data):
+        if not self.is_cacheable(method):
+            return
+        content = "%f\n%s" % (time.time() + self.ttls[method],
+                               zlib.compress(data))
+        if len(content) > self.max_bytes:
+            return
+        path = self._path_from_key(key)
+        try:
+            if not exists(self.dir):
+                try:
+                    os.makedirs(self.dir, 0700)
+                except EnvironmentError, ex:
+                    if ex.errno != errno.EEXIST: # made by another thread
+                        raise
+            import tempfile
+            fd, tmp_path = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+            try:
+                try:
+                    os.write(fd, content)
+                finally:
+                    os.close(fd)
+                if sys.platform == "win32" and exists(path):
+                    os.remove(path)  # rename() can't replace on Windows
+                os.rename(tmp_path, path)
+            except:
+                try:
+                    os.remove(tmp_path)
+                except EnvironmentError:
+                    pass
+                raise
+            self._evict()
+        except EnvironmentError, ex:
+            log.debug("could not write cache file `%s': %s", path, ex)
+
+    def clear(self):
+        for path in self._cache_paths():
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                pass
+
+    def _path_from_key(self, key):
+        import hashlib
+        return join(self.dir, hashlib.sha1(key).hexdigest())
+
+    def _cache_paths(self):
+        try:
+            names = os.listdir(self.dir)
+        except EnvironmentError:
+            return []
+        return [join(self.dir, name) for name in names
+                if len(name) == 40 and not name.endswith(".tmp")]
+
+    def _evict(self):
+        """Remove expired or least recently used files until the cache
+        is under `max_bytes'.
+        """
+        entries = []  # (mtime, size, path)
+        total = 0
+        for path in self._cache_paths():
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                continue
+            total -= size
+            self.evictions += 1
+
+
+class _CachingResponse(object):
+    """A file-like wrapper around a response that hands the complete
+    response data to `on_complete' when it has been read to the end.
+    """
+    def __init__(self, f, on_complete):
+        self._f = f
+        self._on_complete = on_complete
+        self._chunks = []
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        if self._chunks is not None:
+            if data:
+                self._chunks.append(data)
+            if not data or size is None or size < 0:
+                chunks, self._chunks = self._chunks, None
+                self._on_complete(''.join(chunks))
+        return data
+
+    def close(self):
+        self._f.close()
+
+
+
+#---- instrumentation
+
+class CallStats(object):
+    """Timings and sizes for one API call, as passed to observers (see
+    `RawThirtyBoxes.add_observer()'). Times are in seconds; fields that
+    don't apply are None.
+
+        "method" is the API method, e.g. "events.Get".
+        "url" is the request URL.
+        "cached" is true if the response came from the response cache.
+        "reused" is true if a pooled keep-alive connection was reused.
+        "hedged" is true if a duplicate request was sent because the
+            response was slow (see `HedgePolicy').
+        "connect_time" is the time spent connecting (0 for a reused
+            connection).
+        "ttfb" is the time from sending the request to receiving the
+            response headers.
+        "transfer_time" is the time spent reading the response body.
+        "bytes" is the size of the (decoded) response body.
+        "parse_time" is the time spent parsing the response, not
+            counting the transfer time (only for `ThirtyBoxes' calls).
+        "num_elements" is the number of XML elements parsed (only for
+            `ThirtyBoxes' calls).
+        "error" is the exception the call failed with, if any.
+        "total_time" is the time the whole call took.
+    """
+    __slots__ = ("method", "url", "cached", "reused", "hedged",
+                 "connect_time",
+                 "ttfb", "transfer_time", "bytes", "parse_time",
+                 "num_elements", "error", "total_time", "start_time")
+
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+        self.cached = False
+        self.reused = None
+        self.hedged = False
+        self.connect_time = None
+        self.ttfb = None
+        self.transfer_time = 0.0
+        self.bytes = 0
+        self.parse_time = None
+        self.num_elements = None
+        self.error = None
+        self.total_time = None
+        self.start_time = time.time()
+
+    def __repr__(self):
+        return "<CallStats %s: %s>" % (self.method, ', '.join(
+            "%s=%r" % (name, getattr(self, name))
+            for name in self.__slots__[2:-1]))
+
+
+class _ObservedResponse(object):
+    """A file-like wrapper around a response that records the transfer
+    time and size in its `CallStats'.
+    """
+    def __init__(self, f, stats):
+        self._f = f
+        self.stats = stats
+
+    def read(self, size=-1):
+        start = time.time()
+        try:
+            data = self._f.read(size)
+        except Exception, ex:
+            self.stats.error = ex
+            raise
+        finally:
+            self.stats.transfer_time += time.time() - start
+        self.stats.bytes += len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+
+class _Histogram(object):
+    """A histogram of durations in log-spaced buckets."""
+    bounds = [0.0001 * 10 ** (i / 4.0) for i in range(25)] # 0.1ms - 100s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Return an upper bound on the given percentile (e.g. 0.99)."""
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+
+class StatsCollector(object):
+    """An observer that aggregates `CallStats' per API method: counters
+    of calls, errors, cache hits, bytes and elements, and histograms of
+    the timings.
+
+        >>> stats = thirtyboxes.StatsCollector()
+        >>> tb.add_observer(stats)
+        >>> tb.events(...)
+        >>> print stats.report()
+    """
+    counters = ("calls", "cached", "hedged", "errors", "bytes",
+                "num_elements")
+    timings = ("total_time", "connect_time", "ttfb", "transfer_time",
+               "parse_time")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            # method -> {counter name -> int, timing name -> _Histogram}
+            self.methods = {}
+        finally:
+            self._lock.release()
+
+    def __call__(self, stats):
+        self._lock.acquire()
+        try:
+            method_stats = self.methods.get(stats.method)
+            if method_stats is None:
+                method_stats = self.methods[stats.method] = dict(
+                    [(name, 0) for name in self.counters]
+                    + [(name, _Histogram()) for name in self.timings])
+            method_stats["calls"] += 1
+            method_stats["errors"] += stats.error is not None
+            method_stats["cached"] += stats.cached
+            method_stats["hedged"] += stats.hedged
+            method_stats["bytes"] += stats.bytes
+            method_stats["num_elements"] += stats.num_elements or 0
+            for name in self.timings:
+                value = getattr(stats, name)
+                if value is not None:
+                    method_stats[name].add(value)
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """Return a summary of the collected stats as a string."""
+        lines = []
+        self._lock.acquire()
+        try:
+            for method, method_stats in sorted(self.methods.items()):
+                lines.append("%s: %d calls (%d cached, %d hedged, "
+                             "%d errors), %d bytes, %d elements" % ((method,)
+                    + tuple(method_stats[name] for name in self.counters)))
+                for name in self.timings:
+                    histogram = method_stats[name]
+                    if not histogram.count:
+                        continue
+                    lines.append("    %-13s avg %8.2fms  p50 %8.2fms  "
+                                 "p99 %8.2fms  max %8.2fms" % (name,
+                        histogram.sum / histogram.count * 1000,
+                        histogram.percentile(0.50) * 1000,
+                        histogram.percentile(0.99) * 1000,
+                        histogram.max * 1000))
+        finally:
+            self._lock.release()
+        return '\n'.join(lines)
+
+
+
+#---- rate limiting
+
+class RateLimiter(object):
+    """A client-side limit on API requests, shared by all the requests
+    of a `RawThirtyBoxes' (or `ThirtyBoxes') instance.
+
+    A token bucket caps the request rate, and the number of concurrent
+    requests is limited by an adaptive "concurrency" limit: this is
+    raised by one for each "concurrency" successful requests made while
+    the limit was reached (additive increase) and cut by the "backoff"
+    factor when a request fails or its latency spikes (multiplicative
+    decrease). Requests block until both allow them, so throughput
+    settles near the highest rate the server sustains.
+
+        >>> limiter = thirtyboxes.RateLimiter(rate=10)
+        >>> tb = thirtyboxes.ThirtyBoxes(limiter=limiter)
+    """
+    # Latencies less than this many seconds above the average are never
+    # spikes (to ignore jitter when latencies are tiny).
+    min_spike = 0.05
+
+    def __init__(self, rate=None, burst=None, concurrency=4,
+                 min_concurrency=1, max_concurrency=32, backoff=0.5,
+                 latency_spike=3.0):
+        """
+            "rate" (optional) is the maximum number of requests per
+                second. By default the rate is not limited.
+            "burst" (optional) is the number of requests that may be
+                made at once before "rate" applies. Default "rate"
+                (i.e. a second's worth).
+            "concurrency" (optional) is the initial limit on concurrent
+                requests. Default 4.
+            "min_concurrency" and "max_concurrency" (optional) bound
+                the concurrency limit. Defaults 1 and 32.
+            "backoff" (optional) is the factor by which the concurrency
+                limit is cut on failure. Default 0.5.
+            "latency_spike" (optional) is the multiple of the average
+                latency (to the response headers) above which a
+                request's latency is treated as a failure. Default 3.
+        """
+        if rate is not None and rate <= 0:
+            raise ThirtyBoxesError("invalid rate: %r" % rate)
+        if not 0 < backoff < 1:
+            raise ThirtyBoxesError("invalid backoff: %r" % backoff)
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self.concurrency = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.backoff = backoff
+        self.latency_spike = latency_spike
+        self.latency = None # moving average of successful latencies
+        self.num_latencies = 0
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._in_flight = 0
+        self._decreased_at = 0.0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self, deadline=None):
+        """Block until a request may be made and return its start time
+        (to pass to `release()').
+
+        If a "deadline" (a `time.time()' value) is given and the request
+        could not be made by then ThirtyBoxesTimeoutError is raised.
+        """
+        self._cond.acquire()
+        try:
+            while self._in_flight >= int(self.concurrency):
+                self._cond.wait(_remaining(deadline))
+            delay = self._take_token()
+            if deadline is not None and time.time() + delay >= deadline:
+                self._tokens += 1
+                raise ThirtyBoxesTimeoutError(
+                    "the rate limit allows no request before the deadline")
+            self._in_flight += 1
+        finally:
+            self._cond.release()
+        if delay > 0:
+            time.sleep(delay)
+        return time.time()
+
+    def release(self, start, latency=None, failed=False):
+        """Record the end of a request started at "start".
+
+            "latency" (optional) is the time the request took to get a
+                response, for a successful request.
+            "failed" (optional) is a boolean indicating that the request
+                failed in a way that suggests the server is overloaded.
+
+        A request that neither failed nor has a latency (e.g. one that
+        failed for some other reason) doesn't change the limit.
+        """
+        self._cond.acquire()
+        try:
+            saturated = self._in_flight >= int(self.concurrency)
+            self._in_flight -= 1
+            if latency is not None and not failed:
+                if self._is_spike(latency):
+                    failed = True
+                else:
+                    self._add_latency(latency)
+                    if saturated:
+                        self.concurrency = min(self.max_concurrency,
+                            self.concurrency + 1.0 / self.concurrency)
+            # Only back off once for the requests already in flight
+            # when the limit was last cut.
+            if failed and start >= self._decreased_at:
+                self.concurrency = max(self.min_concurrency,
+                                       self.concurrency * self.backoff)
+                self._decreased_at = time.time()
+                log.debug("backing off to %d concurrent requests",
+                          int(self.concurrency))
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def _take_token(self):
+        """Take a token from the bucket and return the number of seconds
+        to wait for it. Called with the lock held.
+        """
+        if self.rate is None:
+            return 0
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+    def _is_spike(self, latency):
+        return (self.num_latencies >= 5
+                and latency > self.latency_spike * self.latency
+                and latency > self.latency + self.min_spike)
+
+    def _add_latency(self, latency):
+        self.num_latencies += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += 0.1 * (latency - self.latency)
+
+
+class _LimitedResponse(object):
+    """A file-like wrapper around a response that releases its
+    `RateLimiter' request when closed.
+    """
+    def __init__(self, f, limiter, start, latency):
+        self._f = f
+        self.latency = getattr(f, "latency", None)
+        self._limiter = limiter
+        self._start = start
+        self._latency = latency
+        self._checked = False
+        self._failed = False
+
+    def read(self, size=-1):
+        try:
+            data = self._f.read(size)
+        except Exception, ex:
+            self._failed = _is_overload_error(ex)
+            self._release()
+            raise
+        if not self._checked and data:
+            self._checked = True
+            self._failed = _is_error_response(data)
+        return data
+
+    def close(self):
+        self._f.close()
+        self._release()
+
+    def _release(self):
+        limiter, self._limiter = self._limiter, None
+        if limiter is None:
+            return
+        if self._failed:
+            limiter.release(self._start, failed=True)
+        else:
+            limiter.release(self._start, self._latency)
+
+
+def _is_overload_error(ex):
+    """Return true if the given error opening or reading an API response
+    suggests the server is overloaded.
+    """
+    import httplib
+    code = getattr(ex, "code", None) # urllib2.HTTPError
+    if code is not None:
+        return code == 429 or code >= 500
+    return isinstance(ex, (EnvironmentError, httplib.HTTPException,
+                           ThirtyBoxesTimeoutError))
+
+
+
+#---- deadlines and hedged requests
+
+_local = threading.local() # .deadline: the current thread's deadline
+
+def deadline(seconds):
+    """Return a context manager under which API calls made by this
+    thread must complete within the given number of seconds, else
+    ThirtyBoxesTimeoutError is raised:
+
+        >>> with thirtyboxes.deadline(2.0):
+        ...     user = tb.find_user(id)
+        ...     events = tb.events(start, end)
+
+    The deadline covers all the calls in the block (and, like a
+    client's "timeout", covers waiting for a connection or rate limit,
+    retries and reading the response, but not parsing). Nested
+    deadlines can only shorten it.
+    """
+    return _Deadline(seconds)
+
+class _Deadline(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._outer = None
+
+    def __enter__(self):
+        self._outer = getattr(_local, "deadline", None)
+        end = time.time() + self.seconds
+        if self._outer is not None:
+            end = min(end, self._outer)
+        _local.deadline = end
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.deadline = self._outer
+
+def _call_deadline(timeout):
+    """Return the deadline for an API call starting now, given the
+    client's "timeout" (or None).
+    """
+    end = getattr(_local, "deadline", None)
+    if timeout is not None:
+        call_end = time.time() + timeout
+        if end is None or call_end < end:
+            end = call_end
+    return end
+
+
+class HedgePolicy(object):
+    """When to send a duplicate ("hedged") request for an API call whose
+    response is slow to arrive: whichever response arrives first is
+    used and the other is dropped. This cuts tail latency caused by a
+    slow server or connection at the cost of a few extra requests.
+
+        >>> tb = thirtyboxes.ThirtyBoxes(hedge=thirtyboxes.HedgePolicy())
+
+    Only idempotent reads are hedged, and no more than a "budget"
+    fraction of calls: when the server slows down all calls pass the
+    old latency percentile, and hedging them all would double the load
+    on it.
+    """
+    def __init__(self, percentile=0.95, methods=None, min_samples=20,
+                 window=200, budget=0.1):
+        """
+            "percentile" (optional) is the percentile of recent response
+                latencies for the API method after which a hedged
+                request is sent. Latencies are measured from having a
+                connection (after any wait for the `RateLimiter' or the
+                `ConnectionPool') to the response headers, and the
+                hedge is sent that long after the first request got its
+                connection. Default 0.95, so about one call in 20 is
+                hedged.
+            "methods" (optional) is the set of API methods to hedge.
+                By default all the methods with cacheable responses
+                (see DEFAULT_CACHE_TTLS), which are all reads.
+            "min_samples" (optional) is the number of latencies needed
+                for a method before its calls are hedged. Default 20.
+            "window" (optional) is the number of recent latencies kept
+                per method. Default 200.
+            "budget" (optional) is the largest fraction of calls that
+                may be hedged. Each call (of a hedged method) earns
+                "budget" of a hedge, and up to "budget" * "window"
+                unused hedges are kept for bursts. Default 0.1.
+        """
+        if not 0 < percentile < 1:
+            raise ThirtyBoxesError("invalid percentile: %r" % percentile)
+        self.percentile = percentile
+        if methods is None:
+            methods = DEFAULT_CACHE_TTLS.keys()
+        self.methods = set(methods)
+        self.min_samples = min_samples
+        self.window = window
+        self.budget = budget
+        self._latencies = {} # method -> deque of recent latencies
+        self._hedges = 0.0   # hedges that may be sent, see "budget"
+        self._lock = threading.Lock()
+
+    def delay(self, method):
+        """Return the number of seconds after which to hedge a call of
+        the given API method, or None if it shouldn't be hedged.
+        """
+        if method not in self.methods:
+            return None
+        self._lock.acquire()
+        try:
+            self._hedges = min(self._hedges + self.budget,
+                               max(1.0, self.budget * self.window))
+            latencies = self._latencies.get(method)
+            if latencies is None or len(latencies) < self.min_samples:
+                return None
+            latencies = sorted(latencies)
+        finally:
+            self._lock.release()
+        return latencies[int(self.percentile * (len(latencies) - 1))]
+
+    def allow_hedge(self):
+        """Return true if a hedged request may be sent now, i.e. if that
+        doesn't exceed the "budget". The caller must then send it.
+        """
+        self._lock.acquire()
+        try:
+            if self._hedges < 1:
+                return False
+            self._hedges -= 1
+            return True
+        finally:
+            self._lock.release()
+
+    def add(self, method, latency):
+        """Record a latency (from having a connection to the response
+        headers) for the given API method.
+        """
+        self._lock.acquire()
+        try:
+            latencies = self._latencies.get(method)
+            if latencies is None:
+                latencies = self._latencies[method] \
+                            = deque(maxlen=self.window)
+            latencies.append(latency)
+        finally:
+            self._lock.release()
+
+
+class _HedgedRequest(object):
+    """A request, hedged as per a `HedgePolicy': see `open()'."""
+    def __init__(self, api, method, url, deadline):
+        self.api = api
+        self.method = method
+        self.url = url
+        self.deadline = deadline
+        self._cond = threading.Condition(threading.Lock())
+        self._response = None   # the winning response
+        self._exc_info = None   # the first error
+        self._num_pending = 0
+        self._hedge_decided = False
+        self._done = False
+        self._connected = threading.Event() # the first request's
+
+    def open(self, delay, stats=None):
+        """Start the request and, if there is no response "delay"
+        seconds after it got a connection (and if the policy's budget
+        allows), a duplicate. Return the first response to arrive.
+
+        If one request fails the other's response is waited for. If a
+        `CallStats' is given as "stats" its connection fields are those
+        of the winning request.
+        """
+        self._cond.acquire()
+        try:
+            self._start(stats, primary=True)
+            timer = threading.Thread(target=self._hedge_after,
+                                     args=(delay, stats))
+            timer.daemon = True
+            timer.start()
+            while (self._response is None
+                   and (self._num_pending
+                        or not (self._hedge_decided or self._exc_info))):
+                self._cond.wait()
+            self._done = True
+            if self._response is None:
+                raise self._exc_info[0], self._exc_info[1], \
+                      self._exc_info[2]
+            return self._response
+        finally:
+            self._cond.release()
+
+    def _start(self, stats, primary=False):
+        """Start a request. Called with the lock held."""
+        self._num_pending += 1
+        thread = threading.Thread(target=self._run, args=(stats, primary))
+        thread.daemon = True
+        thread.start()
+
+    def _hedge_after(self, delay, stats):
+        # Don't count waiting for the rate limiter or a connection:
+        # a hedge would only wait there too.
+        self._connected.wait()
+        time.sleep(delay)
+        self._cond.acquire()
+        try:
+            if not self._done and self._response is None \
+               and self._exc_info is None and self.api.hedge.allow_hedge():
+                log.debug("hedging `%s'", self.url)
+                if stats is not None:
+                    stats.hedged = True
+                self._start(stats)
+            self._hedge_decided = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def _run(self, stats, primary=False):
+        attempt_stats = None
+        if stats is not None:
+            attempt_stats = CallStats(self.method, self.url)
+        on_connect = primary and self._connected.set or None
+        f = None
+        try:
+            try:
+                f = self.api._request_once(self.url, attempt_stats,
+                                           self.deadline, on_connect)
+            finally:
+                if primary:
+                    self._connected.set() # in case it failed first
+        except Exception:
+            exc_info = sys.exc_info()
+        else:
+            exc_info = None
+            if f.latency is not None:
+                self.api.hedge.add(self.method, f.latency)
+        self._cond.acquire()
+        try:
+            self._num_pending -= 1
+            if f is not None and self._response is None \
+               and not self._done:
+                self._response, f = f, None
+                if stats is not None:
+                    stats.reused = attempt_stats.reused
+                    stats.connect_time = attempt_stats.connect_time
+                    stats.ttfb = attempt_stats.ttfb
+            elif exc_info is not None and self._exc_info is None:
+                self._exc_info = exc_info
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if f is not None: # the losing response
+            f.close()
+
+
+
 #---- the raw 30boxes.com API
 
 class RawThirtyBoxes(object):
-    def __init__(self, apiKey=None, authorizedUserToken=None):
-        self.apiKey = apiKey
-        self.authorizedUserToken = authorizedUserToken
+    """The 30boxes API calls as methods returning the XML responses.
+
+    An instance may be shared by several threads. The credentials are
+    held as one (apiKey, authorizedUserToken) tuple, which each call
+    reads once without locking: use `set_credentials()' to change both
+    at once. Changes are serialized by the instance's
+    `_credentials_lock', so that setting one credential can't write
+    back a stale copy of the other.
+    """
+    observers = ()
+    _credentials = (None, None) # (apiKey, authorizedUserToken)
+
+    def __init__(self, apiKey=None, authorizedUserToken=None, pool=None,
+                 cache=None, limiter=None, timeout=None, hedge=None):
+        """Create a raw 30boxes API interface.
+
+            "pool" (optional) is a `ConnectionPool' to use for HTTP
+                requests. By default a new pool is created.
+            "cache" (optional) is a `ResponseCache' in which to cache
+                responses. By default responses are not cached.
+            "limiter" (optional) is a `RateLimiter' for the requests
+                made (cached responses aren't limited). By default
+                requests are not limited.
+            "timeout" (optional) is the number of seconds in which each
+                API call must complete (including any retry) else
+                ThirtyBoxesTimeoutError is raised. See also `deadline()'.
+                By default there is no timeout.
+            "hedge" (optional) is a `HedgePolicy' for sending duplicate
+                requests when responses are slow. By default requests
+                are not hedged.
+        """
+        self._credentials_lock = threading.Lock()
+        self._credentials = (apiKey, authorizedUserToken)
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        self.cache = cache
+        self.limiter = limiter
+        self.timeout = timeout
+        self.hedge = hedge
+
+    def set_credentials(self, apiKey, authorizedUserToken):
+        """Change the API key and auth token together, so that no call
+        (from another thread) uses one without the other.
+        """
+        self._credentials_lock.acquire()
+        try:
+            self._credentials = (apiKey, authorizedUserToken)
+        finally:
+            self._credentials_lock.release()
+
+    def _get_apiKey(self):
+        return self._credentials[0]
+    def _set_apiKey(self, apiKey):
+        self._credentials_lock.acquire()
+        try:
+            self._credentials = (apiKey, self._credentials[1])
+        finally:
+            self._credentials_lock.release()
+    apiKey = property(_get_apiKey, _set_apiKey, None, "30boxes API key")
+
+    def _get_authorizedUserToken(self):
+        return self._credentials[1]
+    def _set_authorizedUserToken(self, authorizedUserToken):
+        self._credentials_lock.acquire()
+        try:
+            self._credentials = (self._credentials[0], authorizedUserToken)
+        finally:
+            self._credentials_lock.release()
+    authorizedUserToken = property(_get_authorizedUserToken,
+                                   _set_authorizedUserToken, None,
+                                   "30boxes authorized user token")
 
     def getKeyForUser(self):
+        import webbrowser
         url = self._url_from_method_and_args("getKeyForUser")
         webbrowser.open(url)
 
@@ -252,6 +1530,7 @@ class RawThirtyBoxes(object):
                 applicationLogoUrl=applicationLogoUrl,
                 returnUrl=returnUrl,
                 apiKey=self.apiKey)
+        import webbrowser
         webbrowser.open(url)
 
     def user_GetAllInfo(self):
@@ -259,190 +1538,2583 @@ class RawThirtyBoxes(object):
         
         See user_Authorize for getting an 'authorizedUserToken'. 
         """
+        apiKey, authorizedUserToken = self._credentials
         return self._api_call("user.GetAllInfo",
-                              authorizedUserToken=self.authorizedUserToken,
-                              apiKey=self.apiKey)
+                              authorizedUserToken=authorizedUserToken,
+                              apiKey=apiKey)
 
     def events_Get(self, start=None, end=None):
         """Get all events in the given date range.
 
         See user_Authorize for getting an 'authorizedUserToken'. 
         """
+        apiKey, authorizedUserToken = self._credentials
         return self._api_call("events.Get",
                               start=start,
                               end=end,
-                              authorizedUserToken=self.authorizedUserToken,
-                              apiKey=self.apiKey)
+                              authorizedUserToken=authorizedUserToken,
+                              apiKey=apiKey)
+
+    def events_Search(self, query):
+        """Return all events matching the given query.
+
+        See user_Authorize for getting an 'authorizedUserToken'. 
+        """
+        apiKey, authorizedUserToken = self._credentials
+        return self._api_call("events.Search",
+                              query=query,
+                              authorizedUserToken=authorizedUserToken,
+                              apiKey=apiKey)
+
+    def events_TagSearch(self, tag):
+        """Return all events tagged with the given tag.
+
+        See user_Authorize for getting an 'authorizedUserToken'. 
+        """
+        apiKey, authorizedUserToken = self._credentials
+        return self._api_call("events.TagSearch",
+                              tag=tag,
+                              authorizedUserToken=authorizedUserToken,
+                              apiKey=apiKey)
+
+    def add_observer(self, observer):
+        """Call `observer(stats)' with a `CallStats' after each API call.
+
+        Observers are called in the calling thread so should be quick.
+        A `StatsCollector' is a ready-made observer. (Observers are not
+        supported by the asynchronous API.)
+        """
+        self.observers = list(self.observers) + [observer]
+
+    def remove_observer(self, observer):
+        observers = list(self.observers)
+        observers.remove(observer)
+        self.observers = observers
+
+    def _notify(self, stats):
+        stats.total_time = time.time() - stats.start_time
+        for observer in self.observers:
+            try:
+                observer(stats)
+            except Exception:
+                log.exception("error in observer %r", observer)
+
+    def _api_call(self, method, **args):
+        f = self._api_open(method, **args)
+        try:
+            try:
+                return f.read()
+            finally:
+                f.close()
+        finally:
+            if isinstance(f, _ObservedResponse):
+                self._notify(f.stats)
+
+    def _api_open(self, method, **args):
+        """Make the given API call and return a file-like object for the
+        XML response.
+
+        If there are observers this is an `_ObservedResponse', whose
+        caller must notify them (with `_notify()') when done.
+        """
+        return self._open(method,
+                          self._url_from_method_and_args(method, **args))
+
+    def _open(self, method, url):
+        if not self.observers:
+            return self._open_url(method, url)
+        stats = CallStats(method, url)
+        try:
+            f = self._open_url(method, url, stats)
+        except Exception, ex:
+            stats.error = ex
+            self._notify(stats)
+            raise
+        return _ObservedResponse(f, stats)
+
+    def _open_url(self, method, url, stats=None):
+        cache = self.cache
+        if cache is None or not cache.is_cacheable(method):
+            return self._request(method, url, stats)
+
+        data = cache.get(method, url)
+        if data is not None:
+            log.debug("call `%s' (cached)", url)
+            if stats is not None:
+                stats.cached = True
+            return StringIO(data)
+        def on_complete(data):
+            if not _is_error_response(data):
+                cache.put(method, url, data)
+        return _CachingResponse(self._request(method, url, stats),
+                                on_complete)
+
+    def _request(self, method, url, stats=None):
+        log.debug("call `%s'", url)
+        deadline = _call_deadline(self.timeout)
+        hedge = self.hedge
+        if hedge is None:
+            return self._request_once(url, stats, deadline)
+        delay = hedge.delay(method)
+        if delay is not None:
+            return _HedgedRequest(self, method, url, deadline).open(delay,
+                                                                    stats)
+        f = self._request_once(url, stats, deadline)
+        if f.latency is not None:
+            hedge.add(method, f.latency)
+        return f
+
+    def _request_once(self, url, stats=None, deadline=None,
+                      on_connect=None):
+        limiter = self.limiter
+        if limiter is None:
+            return self.pool.open(url, stats=stats, deadline=deadline,
+                                  on_connect=on_connect)
+        start = limiter.acquire(deadline)
+        try:
+            f = self.pool.open(url, stats=stats, deadline=deadline,
+                               on_connect=on_connect)
+        except Exception, ex:
+            limiter.release(start, failed=_is_overload_error(ex))
+            raise
+        return _LimitedResponse(f, limiter, start, time.time() - start)
+
+    def _url_from_method_and_args(self, method, **args):
+        from urllib import quote
+        url = API_URL + "?method=%s" % method
+        for name, value in sorted(args.items()):
+            if value is not None:
+                url += "&%s=%s" % (quote(str(name)), quote(str(value)))
+        return url
+
+
+
+class _StreamingRawThirtyBoxes(RawThirtyBoxes):
+    """A RawThirtyBoxes whose API methods return an `_APICall' rather
+    than the XML response.
+
+    `ThirtyBoxes' uses this to coalesce identical calls and to parse
+    responses as they are read from the network.
+    """
+    def _api_call(self, method, **args):
+        return _APICall(self, method,
+                        self._url_from_method_and_args(method, **args))
+
+
+class _APICall(object):
+    """An API call to be made by `open()', which returns a file-like
+    object for the XML response.
+    """
+    __slots__ = ("api", "method", "url")
+
+    def __init__(self, api, method, url):
+        self.api = api
+        self.method = method
+        self.url = url
+
+    def open(self):
+        return self.api._open(self.method, self.url)
+
+
+
+#---- the richer, more-Pythonic 30boxes.com module API
+
+class ThirtyBoxes(object):
+    """The 30boxes API with responses parsed into Python values.
+
+    A ThirtyBoxes may be shared by the threads of a thread pool: its
+    requests share the connections of its `ConnectionPool' (make its
+    "max_per_host" the number of threads to not wait for connections),
+    and the cache, event store, indexes, `RateLimiter', `HedgePolicy'
+    and `StatsCollector' it may be given are thread-safe. Change the
+    credentials with `set_credentials()'. (An `AsyncThirtyBoxes' must
+    only be used from one thread.)
+    """
+    store = None
+    store_max_age = None
+    index = None
+    tag_index = None
+    user_cache = None
+    _flights = None # _SingleFlight coalescing calls, if "coalesce"
+
+    def __init__(self, api_key=None, auth_token=None, pool=None, cache=None,
+                 store=None, store_max_age=600, index=None, tag_index=None,
+                 records=False, lazy=False, limiter=None, coalesce=False,
+                 timeout=None, hedge=None, user_cache=None):
+        """Create a 30boxes API interface.
+
+        See `RawThirtyBoxes' for the optional "pool", "cache",
+        "limiter", "timeout" and "hedge" arguments. Use a `RateLimiter'
+        to keep calls fanned out over many threads (e.g. by
+        `events_range()') from overloading the server.
+
+            "store" (optional) is an `EventStore' or `SQLiteEventStore'.
+                If given, events fetched by `events()' are saved in it
+                and `events()' calls for date ranges it holds are
+                answered from it. Events are stored per auth token, so
+                a store may be shared by clients for several accounts.
+            "store_max_age" (optional) is the number of seconds after
+                which a date range in the store must be fetched again.
+                Default 600. Use None to never refetch.
+            "index" (optional) is a `SearchIndex'. If given, all events
+                fetched are added to it (under the auth token used),
+                and `search(..., local=True)' searches it.
+            "tag_index" (optional) is a `TagIndex'. If given, all events
+                fetched are added to it (under the auth token used). It
+                is required for `tag_query()'.
+            "user_cache" (optional) is a `UserCache'. If given,
+                `find_user()' and `find_users()' answer from it when
+                they can and add the users they fetch to it.
+            "records" (optional) is a boolean indicating that events
+                and users should be returned as compact `Event' and
+                `User' records instead of dicts. Default False.
+            "lazy" (optional) is a boolean indicating that events should
+                be returned as `LazyEvent' records, which convert each
+                field only when it is first read. Default False.
+            "coalesce" (optional) is a boolean indicating that identical
+                calls made at the same time from several threads should
+                share one request and parse, and return the *same*
+                value (or raise the same error). Default False.
+                Callers must then not modify returned values.
+        """
+        if api_key is None:
+            api_key = ThirtyBoxes._api_key_from_env()
+        if auth_token is None:
+            auth_token = ThirtyBoxes._auth_token_from_env()
+        self._api = _StreamingRawThirtyBoxes(api_key, auth_token, pool=pool,
+                                             cache=cache, limiter=limiter,
+                                             timeout=timeout, hedge=hedge)
+        self.store = store
+        self.store_max_age = store_max_age
+        self.index = index
+        self.tag_index = tag_index
+        self.user_cache = user_cache
+        self._set_unmarshallers(records, lazy)
+        if coalesce:
+            self._flights = _SingleFlight()
+
+    def _set_unmarshallers(self, records, lazy=False):
+        if records:
+            self._events_unmarshallers = _record_events_unmarshallers
+            self._user_unmarshallers = _record_user_unmarshallers
+        else:
+            self._events_unmarshallers = _events_unmarshallers
+            self._user_unmarshallers = _user_unmarshallers
+        if lazy:
+            self._events_unmarshallers = _lazy_events_unmarshallers
+
+    def _get_api_key_prop(self):
+        return self._api.apiKey
+    def _set_api_key_prop(self, api_key):
+        self._api.apiKey = api_key
+    api_key = property(_get_api_key_prop, _set_api_key_prop, None,
+                       "30boxes API key")
+
+    def _get_auth_token_prop(self):
+        return self._api.authorizedUserToken
+    def _set_auth_token_prop(self, auth_token):
+        self._api.authorizedUserToken = auth_token
+    auth_token = property(_get_auth_token_prop, _set_auth_token_prop, None,
+                          "30boxes authorized user token")
+
+    def set_credentials(self, api_key, auth_token):
+        """Change the API key and auth token together, so that no call
+        (from another thread) uses one without the other.
+        """
+        self._api.set_credentials(api_key, auth_token)
+
+    @staticmethod
+    def _api_key_from_env():
+        """Look for a 30boxes API key.
+
+        First look for the THIRTYBOXES_APIKEY environment variable, then for
+        `~/.30boxes/apikey'.
+        """
+        apikey = None
+        if "THIRTYBOXES_APIKEY" in os.environ:
+            log.debug("using API key from THIRTYBOXES_APIKEY env var")
+            apikey = os.environ["THIRTYBOXES_APIKEY"]
+        else:
+            apikey_path = expanduser(join("~", ".30boxes", "apikey"))
+            if exists(apikey_path):
+                log.debug("using API key from `%s'", apikey_path)
+                apikey = open(apikey_path, 'r').read().strip()
+        return apikey
+
+    @staticmethod
+    def _auth_token_from_env():
+        """Look for a 30boxes authenticated user token (auth token).
+
+        First look for the THIRTYBOXES_AUTHTOKEN environment variable, then for
+        `~/.30boxes/authtoken'.
+        """
+        authtoken = None
+        if "THIRTYBOXES_AUTHTOKEN" in os.environ:
+            log.debug("using auth token from THIRTYBOXES_AUTHTOKEN env var")
+            authtoken = os.environ["THIRTYBOXES_AUTHTOKEN"]
+        else:
+            authtoken_path = expanduser(join("~", ".30boxes", "authtoken"))
+            if exists(authtoken_path):
+                log.debug("using auth token from `%s'", authtoken_path)
+                authtoken = open(authtoken_path, 'r').read().strip()
+        return authtoken
+
+    #XXX Need to walk through a web app example that uses these
+    #    and document how to use that.
+    def get_api_key(self):
+        self._api.getKeyForUser()
+    def authorize_user(self, app_name, app_logo_url=None, return_url=None):
+        self._api.user_Authorize(app_name, app_logo_url, return_url)
+
+    def ping(self):
+        response = self._api.test_Ping()
+        return self._parse("ping", response, _ping_unmarshallers)
+
+    def find_user(self, id):
+        """Return the user with the given id or email address.
+
+        If there is a "user_cache" the user is taken from it if there,
+        else added to it.
+        """
+        user_cache = self.user_cache
+        if user_cache is not None:
+            user = user_cache.get(id)
+            if user is not None:
+                return user
+        try:
+            int(id)
+        except ValueError:
+            response = self._api.user_FindByEmail(id)
+        else:
+            response = self._api.user_FindById(id)
+        user = self._parse("user", response, self._user_unmarshallers)
+        if user_cache is not None:
+            user_cache.add(user, id)
+        return user
+
+    def find_users(self, ids_or_emails, max_workers=8):
+        """Return the users with the given ids and/or email addresses, in
+        the same order.
+
+        Each distinct user is looked up once (see `find_user()'): those
+        not in the "user_cache" (if any) are fetched with up to
+        "max_workers" concurrent requests, those by id first so that a
+        user fetched by id also answers the lookups by its email
+        addresses. A user that could not be found or fetched is returned
+        as the exception that was raised (e.g. a ThirtyBoxesAPIError)
+        rather than failing the batch:
+
+            >>> for email, user in zip(emails, tb.find_users(emails)):
+            ...     if isinstance(user, Exception):
+            ...         print "%s: %s" % (email, user)
+        """
+        ids_or_emails = list(ids_or_emails)
+        keys = [_user_key(id_or_email) for id_or_email in ids_or_emails]
+        user_from_key = {}
+        misses = []
+        user_cache = self.user_cache
+        for key, id_or_email in zip(keys, ids_or_emails):
+            if key in user_from_key:
+                continue
+            user = None
+            if user_cache is not None:
+                user = user_cache.get(id_or_email)
+            user_from_key[key] = user
+            if user is None:
+                misses.append(id_or_email)
+        if misses:
+            log.debug("find users: fetching %d of %d", len(misses),
+                      len(user_from_key))
+            def find_user(id_or_email):
+                try:
+                    return self.find_user(id_or_email)
+                except Exception, ex:
+                    return ex
+            # Fetch by id first: a user fetched by id then also answers
+            # the lookups by its email addresses.
+            ids, emails = [], []
+            for id_or_email in misses:
+                if isinstance(_user_key(id_or_email), (int, long)):
+                    ids.append(id_or_email)
+                else:
+                    emails.append(id_or_email)
+            users = _map_concurrently(find_user, ids, max_workers)
+            for id, user in zip(ids, users):
+                user_from_key[_user_key(id)] = user
+                if isinstance(user, Exception):
+                    continue
+                for email in user.get("emails") or ():
+                    key = _user_key(email.get("address"))
+                    if key in user_from_key and user_from_key[key] is None:
+                        user_from_key[key] = user
+            emails = [email for email in emails
+                      if user_from_key[_user_key(email)] is None]
+            users = _map_concurrently(find_user, emails, max_workers)
+            for email, user in zip(emails, users):
+                user_from_key[_user_key(email)] = user
+        return [user_from_key[key] for key in keys]
+
+    def all_user_info(self):
+        response = self._api.user_GetAllInfo()
+        return self._parse("user", response, self._user_unmarshallers)
+
+    def events(self, start=None, end=None):
+        """Return events that start on or after "start" to on or before
+        "end".
+
+            "start" (optional) is a Python datetime or date instance
+                It defaults to today.
+            "end" (optional" is a Python datetime or date instance.
+                It defaults to "start" + 90 days. If it is more than
+                180 days after "start" the range is fetched in pieces
+                (see `events_range()').
+        """
+        store = self.store
+        if store is None:
+            return self._fetch_events(start, end)
+
+        # Only fetch the parts of the range the store doesn't hold
+        # (fresh) events for, then answer from the store.
+        start = start or datetime.date.today()
+        end = end or start + datetime.timedelta(days=90)
+        owner = self._api.authorizedUserToken
+        gaps = [_inclusive_range(lo, hi) for lo, hi
+                in store.gaps(start, end, self.store_max_age, owner)]
+        if gaps:
+            log.debug("events %s to %s: fetching %s", start, end,
+                      ', '.join("%s to %s" % gap for gap in gaps))
+            event_lists = _map_concurrently(
+                lambda gap: self._fetch_events(*gap), gaps, 4)
+            for (gap_start, gap_end), event_list in zip(gaps, event_lists):
+                deleted = _update_store(store, event_list, gap_start,
+                                        gap_end, owner)
+                if deleted:
+                    self._unindex(deleted, owner)
+        else:
+            log.debug("events %s to %s: answered from store", start, end)
+        return _event_list_from_store(store, start, end, owner)
+
+    def events_range(self, start, end, max_workers=4):
+        """Return events that start on or after "start" to on or before
+        "end", for any size of date range.
+
+        The range is split into windows the server accepts (see
+        MAX_EVENTS_SPAN) which are fetched using up to "max_workers"
+        concurrent requests. The results are merged into one event list:
+        events are unique by 'id' and sorted by 'start', and
+        'listStart'/'listEnd' cover the whole range.
+        """
+        windows = _windows_from_range(start, end, MAX_EVENTS_SPAN)
+        event_lists = _map_concurrently(
+            lambda window: self._events_window(*window),
+            windows, max_workers)
+        return _merge_event_lists(event_lists)
+
+    def _fetch_events(self, start, end):
+        if end:
+            span_start, span_end = _comparable_range(
+                start or datetime.date.today(), end)
+            if span_end - span_start > MAX_EVENTS_SPAN:
+                return self.events_range(span_start, span_end)
+        return self._events_window(start, end)
+
+    def _events_window(self, start, end):
+        start_str = _datetime_str_from_arg(start, "start")
+        end_str = _datetime_str_from_arg(end, "end")
+        index = self._indexer(refetched=True)
+        response = self._api.events_Get(start_str, end_str)
+        return self._parse("events", response, self._events_unmarshallers,
+                           index)
+
+    def search(self, query, local=False, start=None, end=None):
+        """Return all events matching the given query.
+
+        If "local" is true the events are taken from the search index
+        (see the "index" constructor argument) instead of the server,
+        ranked by relevance. Query terms ending in '*' match as a
+        prefix. A local search may be restricted to events starting on
+        or after "start" and/or on or before "end".
+        """
+        if local:
+            if self.index is None:
+                raise ThirtyBoxesError("cannot do a local search: "
+                                       "no search index")
+            owner = self._api.authorizedUserToken
+            return {"events": self.index.search(query, start, end,
+                                                owner=owner),
+                    "search": query,
+                    "userId": self.index.get_user_id(owner)}
+        index = self._indexer()
+        response = self._api.events_Search(query)
+        return self._parse("events", response, self._events_unmarshallers,
+                           index)
+
+    def tag_search(self, tag, local=False):
+        """Return all events tagged with the given tag.
+
+        If "local" is true the events are taken from the store (see
+        the "store" constructor argument) instead of the server.
+        """
+        if local:
+            if self.store is None:
+                raise ThirtyBoxesError("cannot do a local tag search: "
+                                       "no event store")
+            owner = self._api.authorizedUserToken
+            return {"events": self.store.events_with_tag(tag, owner),
+                    "tagSearch": tag,
+                    "userId": self.store.get_user_id(owner)}
+        return self._tag_search(tag, self._api.authorizedUserToken)
+
+    def _tag_search(self, tag, owner):
+        index = self._indexer(owner=owner)
+        response = self._api.events_TagSearch(tag)
+        return self._parse("events", response, self._events_unmarshallers,
+                           index)
+
+    def tag_query(self, query):
+        """Return the events matching the given boolean tag query.
+
+        A query combines tags with '&' (and), '|' (or), '!' (not) and
+        parentheses, e.g. "work & !travel | oncall". '&' binds tighter
+        than '|' and may be omitted between terms.
+
+        The query is evaluated locally on the tag index (see the
+        "tag_index" constructor argument). Tags the index hasn't seen
+        yet fetched by a tag search are fetched with `tag_search()'
+        first.
+        """
+        tag_index = self.tag_index
+        if tag_index is None:
+            raise ThirtyBoxesError("cannot do a tag query: no tag index")
+        tree = _parse_tag_query(query)
+        owner = self._api.authorizedUserToken
+        for tag in _tags_from_tag_query(tree):
+            if not tag_index.is_searched(tag, owner):
+                log.debug("tag query: fetching events with tag '%s'", tag)
+                self._tag_search(tag, owner)
+                tag_index.mark_searched(tag, owner)
+        return {"events": tag_index.query(tree, owner),
+                "tagQuery": query,
+                "userId": tag_index.get_user_id(owner)}
+
+    def iter_events(self, start=None, end=None):
+        """Generate the events of `events(start, end)' one at a time.
+
+        Each event is yielded as soon as it has been parsed and is then
+        dropped from the parse tree, so memory use does not grow with
+        the size of the response. Long ranges are fetched one window at
+        a time (see `events_range()').
+        """
+        if not end:
+            windows = [(start, end)]
+        else:
+            windows = _windows_from_range(start or datetime.date.today(),
+                                          end, MAX_EVENTS_SPAN)
+        seen_ids = set()
+        for window_start, window_end in windows:
+            response = self._api.events_Get(
+                _datetime_str_from_arg(window_start, "start"),
+                _datetime_str_from_arg(window_end, "end"))
+            for event in self._iter_parse(response, self._events_unmarshallers):
+                if len(windows) > 1:
+                    if event["id"] in seen_ids:
+                        continue
+                    seen_ids.add(event["id"])
+                yield event
+
+    def iter_search(self, query):
+        """Generate the events of `search(query)' one at a time.
+
+        See `iter_events()'.
+        """
+        response = self._api.events_Search(query)
+        return self._iter_parse(response, self._events_unmarshallers)
+
+    def iter_tag_search(self, tag):
+        """Generate the events of `tag_search(tag)' one at a time.
+
+        See `iter_events()'.
+        """
+        response = self._api.events_TagSearch(tag)
+        return self._iter_parse(response, self._events_unmarshallers)
+
+    def sync(self, store, start=None, end=None):
+        """Bring the events in the given store up to date for the given
+        date range and return what changed.
+
+            "store" is an `EventStore' (or compatible) holding the
+                events from previous syncs.
+            "start" (optional) is a Python datetime or date instance.
+                It defaults to today.
+            "end" (optional) is a Python datetime or date instance.
+                It defaults to "start" + 90 days.
+
+        Events are compared by 'id' and 'lastUpdate': only new and
+        changed events are written to the store, and stored events
+        starting in the range that the server no longer returns are
+        removed. The events are kept under the current auth token (the
+        store's "owner"). The return value is a dict:
+
+            {"added": [<event>, ...],
+             "changed": [<event>, ...],
+             "deleted": [<id>, ...]}
+        """
+        if not start:
+            start = datetime.date.today()
+        if not end:
+            end = start + datetime.timedelta(days=90)
+        owner = self._api.authorizedUserToken
+        added, changed, seen_ids = [], [], set()
+        for event in self.iter_events(start, end):
+            seen_ids.add(event["id"])
+            if store.get(event["id"], owner) is None:
+                added.append(event)
+            elif store.last_update(event["id"], owner) != event["lastUpdate"]:
+                changed.append(event)
+        deleted = [id for id in store.ids_in_range(start, end, owner)
+                   if id not in seen_ids]
+        if added or changed:
+            store.upsert(added + changed, owner)
+        if deleted:
+            store.delete(deleted, owner)
+        store.add_coverage(start, end, owner)
+        self._index_events(added + changed, owner)
+        self._unindex(deleted, owner)
+        log.debug("sync %s to %s: %d added, %d changed, %d deleted",
+                  start, end, len(added), len(changed), len(deleted))
+        return {"added": added, "changed": changed, "deleted": deleted}
+
+    def add_observer(self, observer):
+        """Call `observer(stats)' with a `CallStats' after each API call.
+        See `RawThirtyBoxes.add_observer()'.
+        """
+        self._api.add_observer(observer)
+
+    def remove_observer(self, observer):
+        self._api.remove_observer(observer)
+
+    def _parse(self, what, call, unmarshallers, then=None):
+        """Make the given `_APICall' and return the parsed response,
+        after passing it to `then()' if given.
+
+        With "coalesce" concurrent identical calls share one call.
+        """
+        flights = self._flights
+        if flights is None:
+            return self._call_and_parse(what, call, unmarshallers, then)
+        return flights.do((call.url, what), lambda:
+            self._call_and_parse(what, call, unmarshallers, then))
+
+    def _call_and_parse(self, what, call, unmarshallers, then=None):
+        response = call.open()
+        if isinstance(response, _ObservedResponse):
+            value = self._observed_parse(what, response, unmarshallers)
+        else:
+            value = _parse_response(what, response, unmarshallers)
+        if then is not None:
+            then(value)
+        return value
+
+    def _observed_parse(self, what, response, unmarshallers):
+        stats = response.stats
+        start = time.time()
+        try:
+            return _parse_response(what, response, unmarshallers, stats)
+        except Exception, ex:
+            stats.error = stats.error or ex
+            raise
+        finally:
+            stats.parse_time = time.time() - start - stats.transfer_time
+            self._api._notify(stats)
+
+    def _indexer(self, refetched=False, owner=None):
+        """Return a function adding the events of a parsed eventList to
+        the indexes for the given owner (by default the current auth
+        token), or None if there are no indexes.
+
+        If "refetched" is true the eventList holds all events from its
+        'listStart' to its 'listEnd' and indexed events in that range
+        that it doesn't hold (deleted on the server) are removed.
+        """
+        if self.index is None and self.tag_index is None:
+            return None
+        if owner is None:
+            owner = self._api.authorizedUserToken
+        return lambda event_list: self._index_event_list(event_list, owner,
+                                                         refetched)
+
+    def _index_event_list(self, event_list, owner, refetched=False):
+        events = event_list["events"]
+        user_id = event_list.get("userId")
+        start, end = event_list.get("listStart"), event_list.get("listEnd")
+        for index in (self.index, self.tag_index):
+            if index is None:
+                continue
+            if refetched and start is not None and end is not None:
+                ids = set(e["id"] for e in events)
+                stale = [id for id in index.ids_in_range(start, end, owner)
+                         if id not in ids]
+                if stale:
+                    index.remove(stale, owner)
+            index.update(events, owner)
+            if user_id is not None:
+                index.set_user_id(user_id, owner)
+
+    def _index_events(self, events, owner):
+        for index in (self.index, self.tag_index):
+            if index is not None:
+                index.update(events, owner)
+
+    def _unindex(self, ids, owner):
+        for index in (self.index, self.tag_index):
+            if index is not None:
+                index.remove(ids, owner)
+
+    def _iter_parse(self, call, unmarshallers):
+        response = call.open()
+        if not isinstance(response, _ObservedResponse):
+            return _iter_events_from_response(response, unmarshallers)
+        return self._observed_iter_parse(response, unmarshallers)
+
+    def _observed_iter_parse(self, response, unmarshallers):
+        stats = response.stats
+        events = _iter_events_from_response(response, unmarshallers, stats)
+        elapsed = 0.0 # not counting the time spent by our caller
+        try:
+            while True:
+                start = time.time()
+                try:
+                    event = events.next()
+                except StopIteration:
+                    break
+                except Exception, ex:
+                    stats.error = stats.error or ex
+                    raise
+                finally:
+                    elapsed += time.time() - start
+                yield event
+        finally:
+            events.close()
+            stats.parse_time = elapsed - stats.transfer_time
+            self._api._notify(stats)
+
+
+
+#---- local event storage
+
+class EventStore(object):
+    """An in-memory store of events (as returned by `ThirtyBoxes'),
+    keyed on their 'id'. See `ThirtyBoxes.sync()' and the "store"
+    argument to `ThirtyBoxes'.
+
+    Besides the events the store records which date ranges it holds
+    (its "coverage") and when each was fetched, and the id of the user
+    whose events they are. All of these are kept per "owner" (the auth
+    token used to fetch the events), so one store can be shared by
+    clients using different credentials without one seeing the events
+    of another. The "owner" arguments default to None, the owner of a
+    store used with a single account. `len()', `in' and iteration cover
+    the events of all owners.
+    """
+    def __init__(self, events=None):
+        self._events = {}    # owner -> {id: event}
+        self._coverage = {}  # owner -> [(start, end, fetched_time), ...]
+        self._user_ids = {}  # owner -> user id
+        self._lock = threading.Lock()
+        if events:
+            self.upsert(events)
+
+    def __len__(self):
+        return sum(len(events) for events in self._events.values())
+
+    def __contains__(self, id):
+        for events in self._events.values():
+            if id in events:
+                return True
+        return False
+
+    def __iter__(self):
+        return iter([e for events in self._events.values()
+                     for e in events.values()])
+
+    def _owner_events(self, owner):
+        return self._events.get(owner, {})
+
+    def get(self, id, owner=None):
+        """Return the event with the given id, or None."""
+        return self._owner_events(owner).get(id)
+
+    def last_update(self, id, owner=None):
+        """Return the 'lastUpdate' of the event with the given id, or
+        None.
+        """
+        event = self._owner_events(owner).get(id)
+        return event and event["lastUpdate"]
+
+    def events_in_range(self, start, end, owner=None):
+        """Return the stored events starting on or after "start" to on
+        or before "end", sorted by 'start'.
+        """
+        events = [e for e in self._owner_events(owner).values()
+                  if _range_contains(start, end, e["start"])]
+        events.sort(key=lambda e: _sortable_datetime(e["start"]))
+        return events
+
+    def ids_in_range(self, start, end, owner=None):
+        return [e["id"] for e in self._owner_events(owner).values()
+                if _range_contains(start, end, e["start"])]
+
+    def events_with_tag(self, tag, owner=None):
+        """Return the stored events with the given tag, sorted by
+        'start'.
+        """
+        events = [e for e in self._owner_events(owner).values()
+                  if tag in (e["tags"] or '').split()]
+        events.sort(key=lambda e: _sortable_datetime(e["start"]))
+        return events
+
+    def add_coverage(self, start, end, owner=None):
+        """Record that all events in the given range have been stored."""
+        start, end = _half_open_range(start, end)
+        self._lock.acquire()
+        try:
+            # Drop older records that this one supersedes.
+            coverage = [(s, e, t) for s, e, t in self._coverage.get(owner, [])
+                        if s < start or e > end]
+            coverage.append((start, end, time.time()))
+            self._coverage[owner] = coverage
+        finally:
+            self._lock.release()
+
+    def gaps(self, start, end, max_age=None, owner=None):
+        """Return the parts of the given range not covered by the store
+        (or covered by events fetched more than "max_age" seconds ago,
+        if given), as a list of half-open datetime (start, end) ranges.
+        """
+        if max_age is None:
+            min_time = 0
+        else:
+            min_time = time.time() - max_age
+        coverage = _IntervalSet([(s, e) for s, e, t
+                                 in self._coverage.get(owner, [])
+                                 if t >= min_time])
+        return coverage.gaps(*_half_open_range(start, end))
+
+    def covers(self, start, end, max_age=None, owner=None):
+        """Return true if all events in the given range are stored (and
+        were fetched no more than "max_age" seconds ago, if given).
+        """
+        return not self.gaps(start, end, max_age, owner)
+
+    def upsert(self, events, owner=None):
+        """Add or replace the given events."""
+        self._lock.acquire()
+        try:
+            owner_events = self._events.setdefault(owner, {})
+            for event in events:
+                owner_events[event["id"]] = event
+        finally:
+            self._lock.release()
+
+    def delete(self, ids, owner=None):
+        self._lock.acquire()
+        try:
+            owner_events = self._owner_events(owner)
+            for id in ids:
+                owner_events.pop(id, None)
+        finally:
+            self._lock.release()
+
+    def get_user_id(self, owner=None):
+        """Return the id of the user whose events are stored for the
+        given owner, or None.
+        """
+        return self._user_ids.get(owner)
+
+    def set_user_id(self, user_id, owner=None):
+        self._user_ids[owner] = user_id
+
+
+class SQLiteEventStore(object):
+    """A persistent store of events in an SQLite database.
+
+    This has the same interface as `EventStore'. Events are indexed on
+    ('owner', 'id') and ('owner', 'start'), and their tags are kept in
+    a separate indexed table. Each `upsert()' or `delete()' is a single
+    transaction. Events are stored as JSON (so opening a database can't
+    run code, as unpickling could).
+
+    Owners are stored as a SHA-1 digest of the auth token, not the token
+    itself, and a new database file is only readable by its creator. A
+    database with another schema version (e.g. written by an older
+    version of this module) is emptied and rebuilt: it only holds
+    copies of events from the server.
+
+        "path" is the database file path, or ":memory:".
+    """
+    # Bump this when changing `_schema'.
+    _schema_version = 3
+    _schema = """
+        CREATE TABLE IF NOT EXISTS events (
+            owner TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT,
+            last_update TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (owner, id)
+        );
+        CREATE INDEX IF NOT EXISTS events_start_time
+            ON events (owner, start_time);
+        CREATE TABLE IF NOT EXISTS tags (
+            owner TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            event_id INTEGER NOT NULL,
+            PRIMARY KEY (owner, tag, event_id)
+        );
+        CREATE INDEX IF NOT EXISTS tags_event_id ON tags (owner, event_id);
+        CREATE TABLE IF NOT EXISTS coverage (
+            owner TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            fetched REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS users (
+            owner TEXT PRIMARY KEY,
+            user_id INTEGER
+        );
+    """
+
+    def __init__(self, path):
+        try:
+            import sqlite3
+        except ImportError:
+            raise ThirtyBoxesError("SQLiteEventStore requires the sqlite3 "
+                                   "module")
+        import json
+        self._json = json
+        self.path = path
+        self._lock = threading.RLock()
+        if path != ":memory:" and not exists(path):
+            # Create it 0600 (SQLite would use the umask): the events may
+            # be private.
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0600))
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._init_schema()
+
+    def _init_schema(self):
+        conn = self._conn
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > self._schema_version:
+            raise ThirtyBoxesError("`%s' has a newer event store schema "
+                                   "(version %d) than this module (%d)"
+                                   % (self.path, version,
+                                      self._schema_version))
+        elif version < self._schema_version:
+            tables = [name for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'sqlite_%'")]
+            if tables:
+                log.info("rebuilding event store `%s' (schema version %d "
+                         "is out of date)", self.path, version)
+            for name in tables:
+                conn.execute('DROP TABLE "%s"' % name)
+        conn.executescript(self._schema)
+        conn.execute("PRAGMA user_version = %d" % self._schema_version)
+        conn.commit()
+
+    def _owner(self, owner):
+        """Return the value of the 'owner' column for the given owner
+        (auth token).
+        """
+        if not owner:
+            return ''
+        import hashlib
+        if isinstance(owner, unicode):
+            owner = owner.encode("utf-8")
+        return hashlib.sha1(owner).hexdigest()
+
+    def close(self):
+        self._conn.close()
+
+    def _query(self, sql, params=()):
+        self._lock.acquire()
+        try:
+            return self._conn.execute(sql, params).fetchall()
+        finally:
+            self._lock.release()
+
+    def _events_from_rows(self, rows):
+        loads = self._json.loads
+        return [_event_from_json_obj(loads(data,
+                                           object_hook=_json_object_hook))
+                for (data,) in rows]
+
+    def _event_json(self, event):
+        return self._json.dumps(_json_obj_from_event(event),
+                                separators=(',', ':'), default=_json_default)
+
+    def __len__(self):
+        return self._query("SELECT count(*) FROM events")[0][0]
+
+    def __contains__(self, id):
+        return bool(self._query("SELECT 1 FROM events WHERE id = ? LIMIT 1",
+                                (id,)))
+
+    def __iter__(self):
+        return iter(self._events_from_rows(
+            self._query("SELECT data FROM events ORDER BY start_time")))
+
+    def get(self, id, owner=None):
+        rows = self._query("SELECT data FROM events "
+                           "WHERE owner = ? AND id = ?",
+                           (self._owner(owner), id))
+        return rows and self._events_from_rows(rows)[0] or None
+
+    def last_update(self, id, owner=None):
+        rows = self._query("SELECT last_update FROM events "
+                           "WHERE owner = ? AND id = ?",
+                           (self._owner(owner), id))
+        return rows and rows[0][0] or None
+
+    def events_in_range(self, start, end, owner=None):
+        return self._events_from_rows(self._query(
+            "SELECT data FROM events WHERE owner = ? AND start_time >= ? "
+            "AND start_time < ? ORDER BY start_time",
+            (self._owner(owner),) + _sql_range(start, end)))
+
+    def ids_in_range(self, start, end, owner=None):
+        return [id for (id,) in self._query(
+            "SELECT id FROM events WHERE owner = ? AND start_time >= ? "
+            "AND start_time < ?",
+            (self._owner(owner),) + _sql_range(start, end))]
+
+    def events_with_tag(self, tag, owner=None):
+        return self._events_from_rows(self._query(
+            "SELECT data FROM events JOIN tags "
+            "ON events.owner = tags.owner AND events.id = tags.event_id "
+            "WHERE tags.owner = ? AND tags.tag = ? ORDER BY start_time",
+            (self._owner(owner), tag)))
+
+    def upsert(self, events, owner=None):
+        owner = self._owner(owner)
+        # The last of any events with the same id wins (as for
+        # `EventStore'): its tags must not be added to the earlier one's.
+        event_from_id = {}
+        for event in events:
+            event_from_id[event["id"]] = event
+        event_rows, tag_rows = [], []
+        for event in event_from_id.values():
+            event_rows.append((
+                owner,
+                event["id"],
+                _sql_datetime(event["start"]),
+                event.get("end") and _sql_datetime(event["end"]),
+                event.get("lastUpdate"),
+                self._event_json(event),
+            ))
+            for tag in set((event.get("tags") or '').split()):
+                tag_rows.append((owner, tag, event["id"]))
+        self._lock.acquire()
+        try:
+            conn = self._conn
+            with conn:
+                conn.executemany("DELETE FROM tags "
+                                 "WHERE owner = ? AND event_id = ?",
+                                 [row[:2] for row in event_rows])
+                conn.executemany("INSERT OR REPLACE INTO events "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", event_rows)
+                conn.executemany("INSERT INTO tags VALUES (?, ?, ?)",
+                                 tag_rows)
+        finally:
+            self._lock.release()
+
+    def delete(self, ids, owner=None):
+        rows = [(self._owner(owner), id) for id in ids]
+        self._lock.acquire()
+        try:
+            conn = self._conn
+            with conn:
+                conn.executemany("DELETE FROM tags "
+                                 "WHERE owner = ? AND event_id = ?", rows)
+                conn.executemany("DELETE FROM events "
+                                 "WHERE owner = ? AND id = ?", rows)
+        finally:
+            self._lock.release()
+
+    def add_coverage(self, start, end, owner=None):
+        owner = self._owner(owner)
+        sql_start, sql_end = _sql_range(start, end)
+        self._lock.acquire()
+        try:
+            with self._conn:
+                self._conn.execute("DELETE FROM coverage WHERE owner = ? "
+                                   "AND start_time >= ? AND end_time <= ?",
+                                   (owner, sql_start, sql_end))
+                self._conn.execute("INSERT INTO coverage VALUES (?, ?, ?, ?)",
+                                   (owner, sql_start, sql_end, time.time()))
+        finally:
+            self._lock.release()
+
+    def gaps(self, start, end, max_age=None, owner=None):
+        if max_age is None:
+            min_time = 0
+        else:
+            min_time = time.time() - max_age
+        rows = self._query("SELECT start_time, end_time FROM coverage "
+                           "WHERE owner = ? AND fetched >= ?",
+                           (self._owner(owner), min_time))
+        coverage = _IntervalSet([(_datetime_from_sql(s), _datetime_from_sql(e))
+                                 for s, e in rows])
+        return coverage.gaps(*_half_open_range(start, end))
+
+    def covers(self, start, end, max_age=None, owner=None):
+        return not self.gaps(start, end, max_age, owner)
+
+    def get_user_id(self, owner=None):
+        rows = self._query("SELECT user_id FROM users WHERE owner = ?",
+                           (self._owner(owner),))
+        return rows and rows[0][0] or None
+
+    def set_user_id(self, user_id, owner=None):
+        self._lock.acquire()
+        try:
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO users "
+                                   "VALUES (?, ?)",
+                                   (self._owner(owner), user_id))
+        finally:
+            self._lock.release()
+
+
+class _PartitionedIndex(object):
+    """Base class for the local event indexes. Like the event stores,
+    the indexes keep a separate partition for each "owner" (the auth
+    token used to fetch the events), so that a client never gets the
+    events of another account. The "owner" arguments default to None,
+    for an index used with a single account.
+    """
+    _partition_class = None # the class of each partition
+
+    def __init__(self, events=None):
+        self._partitions = {}   # owner -> partition
+        self._user_ids = {}     # owner -> user id
+        self._lock = threading.Lock()
+        if events:
+            self.update(events)
+
+    def __len__(self):
+        return sum(len(partition) for partition
+                   in self._partitions.values())
+
+    def _partition(self, owner, create=False):
+        partition = self._partitions.get(owner)
+        if partition is None and create:
+            self._lock.acquire()
+            try:
+                partition = self._partitions.get(owner)
+                if partition is None:
+                    partition = self._partitions[owner] \
+                        = self._partition_class()
+            finally:
+                self._lock.release()
+        return partition
+
+    def update(self, events, owner=None):
+        """Add the given events to the index, replacing earlier
+        versions of them.
+        """
+        self._partition(owner, True).update(events)
+
+    def remove(self, ids, owner=None):
+        partition = self._partition(owner)
+        if partition is not None:
+            partition.remove(ids)
+
+    def ids_in_range(self, start, end, owner=None):
+        """Return the ids of the indexed events starting on or after
+        "start" to on or before "end".
+        """
+        partition = self._partition(owner)
+        if partition is None:
+            return []
+        return partition.ids_in_range(start, end)
+
+    def get_user_id(self, owner=None):
+        """Return the id of the user whose events are indexed for the
+        given owner, or None.
+        """
+        return self._user_ids.get(owner)
+
+    def set_user_id(self, user_id, owner=None):
+        self._user_ids[owner] = user_id
+
+
+class _SearchIndexPartition(object):
+    """The `SearchIndex' of one owner's events."""
+    _field_weights = (("summary", 3.0), ("tags", 2.0), ("notes", 1.0))
+    _word_re = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self):
+        self._postings = {}         # term -> {id: weight}
+        self._terms_from_id = {}    # id -> [term, ...]
+        self._events = {}           # id -> event
+        self._sorted_terms = None   # for prefix queries, built lazily
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._events)
+
+    def update(self, events):
+        self._lock.acquire()
+        try:
+            for event in events:
+                id = event["id"]
+                self._remove(id)
+                weights = self._term_weights_from_event(event)
+                for term, weight in weights.items():
+                    if term not in self._postings:
+                        self._postings[term] = {}
+                        self._sorted_terms = None
+                    self._postings[term][id] = weight
+                self._terms_from_id[id] = weights.keys()
+                self._events[id] = event
+        finally:
+            self._lock.release()
+
+    def remove(self, ids):
+        self._lock.acquire()
+        try:
+            for id in ids:
+                self._remove(id)
+        finally:
+            self._lock.release()
+
+    def ids_in_range(self, start, end):
+        self._lock.acquire()
+        try:
+            return [id for id, event in self._events.items()
+                    if _range_contains(start, end, event["start"])]
+        finally:
+            self._lock.release()
+
+    def search(self, terms, start=None, end=None, limit=None):
+        self._lock.acquire()
+        try:
+            num_events = len(self._events)
+            scores = None
+            for term in terms:
+                if term.endswith('*'):
+                    postings = {}
+                    for t in self._terms_with_prefix(term[:-1]):
+                        for id, weight in self._postings[t].items():
+                            postings[id] = postings.get(id, 0) + weight
+                else:
+                    postings = self._postings.get(term, {})
+                if not postings:
+                    return []
+                idf = math.log(1.0 + float(num_events) / len(postings))
+                if scores is None:
+                    scores = dict((id, weight * idf)
+                                  for id, weight in postings.items())
+                else:
+                    scores = dict((id, score + postings[id] * idf)
+                                  for id, score in scores.items()
+                                  if id in postings)
+            events = self._events
+            hits = [(-score, _sortable_datetime(events[id]["start"]), id)
+                    for id, score in scores.items()
+                    if self._in_range(events[id]["start"], start, end)]
+        finally:
+            self._lock.release()
+        hits.sort()
+        if limit is not None:
+            hits = hits[:limit]
+        return [events[id] for score, start, id in hits]
+
+    def _remove(self, id):
+        for term in self._terms_from_id.pop(id, ()):
+            postings = self._postings[term]
+            del postings[id]
+            if not postings:
+                del self._postings[term]
+                self._sorted_terms = None
+        self._events.pop(id, None)
+
+    def _term_weights_from_event(self, event):
+        weights = {}
+        for field, field_weight in self._field_weights:
+            text = event.get(field)
+            if not text:
+                continue
+            for word in self._word_re.findall(text.lower()):
+                weights[word] = weights.get(word, 0) + field_weight
+        return weights
+
+    def _terms_with_prefix(self, prefix):
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self._postings)
+        terms = self._sorted_terms
+        i = bisect.bisect_left(terms, prefix)
+        while i < len(terms) and terms[i].startswith(prefix):
+            yield terms[i]
+            i += 1
+
+    def _in_range(self, value, start, end):
+        if start and _sortable_datetime(value) < _sortable_datetime(start):
+            return False
+        if end and _sortable_datetime(value) >= _half_open_range(end, end)[1]:
+            return False
+        return True
+
+
+class SearchIndex(_PartitionedIndex):
+    """A local inverted index for full-text search over the 'summary',
+    'notes' and 'tags' of events. See `ThirtyBoxes.search()'.
+
+    Events are added (or replaced, when they change) with `update()'
+    and dropped with `remove()'. `search()' ranks matches by a TF-IDF
+    score, with summary matches weighted above tags above notes. The
+    index is partitioned by owner (see `_PartitionedIndex').
+    """
+    _partition_class = _SearchIndexPartition
+    _query_term_re = re.compile(r"\w+\*?", re.UNICODE)
+
+    def search(self, query, start=None, end=None, limit=None, owner=None):
+        """Return the given owner's events matching all terms of the
+        given query, best match first.
+
+            "query" is a string of search terms. A term ending in '*'
+                matches all words starting with it.
+            "start" and "end" (optional) restrict the results to events
+                starting on or after "start" and on or before "end".
+            "limit" (optional) is the maximum number of events to return.
+            "owner" (optional) is the owner whose events to search.
+        """
+        terms = self._query_term_re.findall(query.lower())
+        partition = self._partition(owner)
+        if not terms or partition is None:
+            return []
+        return partition.search(terms, start, end, limit)
+
+
+class _TagIndexPartition(object):
+    """The `TagIndex' of one owner's events."""
+    def __init__(self):
+        self._tags = {}             # tag -> interned tag
+        self._bits_from_tag = {}    # tag -> bitset of event positions
+        self.searched_tags = set()  # tags fetched with a tag search
+        self._pos_from_id = {}      # event id -> bit position
+        self._events = []           # bit position -> event (or None)
+        self._free_positions = []
+        self._all_bits = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pos_from_id)
+
+    def update(self, events):
+        self._lock.acquire()
+        try:
+            for event in events:
+                id = event["id"]
+                pos = self._pos_from_id.get(id)
+                if pos is None:
+                    if self._free_positions:
+                        pos = self._free_positions.pop()
+                    else:
+                        pos = len(self._events)
+                        self._events.append(None)
+                    self._pos_from_id[id] = pos
+                else:
+                    self._clear_tags(pos)
+                bit = 1 << pos
+                self._events[pos] = event
+                self._all_bits |= bit
+                for tag in (event.get("tags") or '').split():
+                    tag = self._tags.setdefault(tag, tag)
+                    self._bits_from_tag[tag] \
+                        = self._bits_from_tag.get(tag, 0) | bit
+        finally:
+            self._lock.release()
+
+    def remove(self, ids):
+        self._lock.acquire()
+        try:
+            for id in ids:
+                pos = self._pos_from_id.pop(id, None)
+                if pos is None:
+                    continue
+                self._clear_tags(pos)
+                self._events[pos] = None
+                self._all_bits &= ~(1 << pos)
+                self._free_positions.append(pos)
+        finally:
+            self._lock.release()
+
+    def ids_in_range(self, start, end):
+        self._lock.acquire()
+        try:
+            return [event["id"] for event in self._events
+                    if event is not None
+                       and _range_contains(start, end, event["start"])]
+        finally:
+            self._lock.release()
+
+    def query(self, query):
+        self._lock.acquire()
+        try:
+            bits = self._eval(query)
+            # Visit only the set bits. Any arithmetic on the bitset per
+            # bit (shifting it down, or clearing its lowest set bit) is
+            # quadratic in the number of events, so find the '1's in
+            # its binary digits instead, lowest first.
+            digits = bin(bits)[:1:-1]
+            events = []
+            pos = digits.find('1')
+            while pos != -1:
+                events.append(self._events[pos])
+                pos = digits.find('1', pos + 1)
+        finally:
+            self._lock.release()
+        events.sort(key=lambda e: _sortable_datetime(e["start"]))
+        return events
+
+    def _eval(self, node):
+        op = node[0]
+        if op == "tag":
+            return self._bits_from_tag.get(node[1], 0)
+        elif op == "not":
+            return self._all_bits & ~self._eval(node[1])
+        elif op == "and":
+            return self._eval(node[1]) & self._eval(node[2])
+        else: # "or"
+            return self._eval(node[1]) | self._eval(node[2])
+
+    def _clear_tags(self, pos):
+        event = self._events[pos]
+        mask = ~(1 << pos)
+        for tag in (event.get("tags") or '').split():
+            bits = self._bits_from_tag.get(tag, 0) & mask
+            if bits:
+                self._bits_from_tag[tag] = bits
+            else:
+                self._bits_from_tag.pop(tag, None)
+
+
+class TagIndex(_PartitionedIndex):
+    """An index of events by tag using bitsets.
+
+    Each event is given a bit position and each (interned) tag maps to
+    an integer bitset of its events, so boolean tag queries are a few
+    integer operations. See `ThirtyBoxes.tag_query()'. The index is
+    partitioned by owner (see `_PartitionedIndex').
+
+    Indexing some events with a tag (e.g. from a narrow `events()'
+    range) doesn't mean the index has all of them: a tag is only known
+    to be complete once a tag search for it has been indexed and
+    `mark_searched()' called.
+    """
+    _partition_class = _TagIndexPartition
+
+    def is_searched(self, tag, owner=None):
+        """Return true if all of the given owner's events with this tag
+        have been indexed (see `mark_searched()').
+        """
+        partition = self._partition(owner)
+        return partition is not None and tag in partition.searched_tags
+
+    def mark_searched(self, tag, owner=None):
+        """Record that all of the given owner's events with this tag
+        (from a tag search) have been indexed.
+        """
+        self._partition(owner, True).searched_tags.add(tag)
+
+    def query(self, query, owner=None):
+        """Return the given owner's events matching the given tag query
+        (a string or a tree from `_parse_tag_query()'), sorted by
+        'start'.
+        """
+        if isinstance(query, basestring):
+            query = _parse_tag_query(query)
+        partition = self._partition(owner)
+        if partition is None:
+            return []
+        return partition.query(query)
+
+
+class UserCache(object):
+    """An in-memory cache of users (as returned by
+    `ThirtyBoxes.find_user()') that can be looked up by id or by any of
+    their email addresses.
+
+        "ttl" (optional) is the number of seconds users are kept.
+            Default 300.
+        "max_entries" (optional) is the maximum number of ids and email
+            addresses kept. Default 10000. The oldest are dropped first.
+
+    Hits and misses are counted in the "hits" and "misses" attributes.
+    """
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()  # id or lowercase email -> (expires, user)
+        self._lock = threading.Lock()
+
+    def get(self, id_or_email):
+        """Return the cached user with the given id or email address, or
+        None.
+        """
+        key = _user_key(id_or_email)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def add(self, user, id_or_email=None):
+        """Add a user under its id and email addresses, and under
+        "id_or_email" (optional) as it was looked up.
+        """
+        keys = [user.get("id")]
+        for email in user.get("emails") or ():
+            if email.get("address"):
+                keys.append(_user_key(email["address"]))
+        if id_or_email is not None:
+            keys.append(_user_key(id_or_email))
+        entry = (time.time() + self.ttl, user)
+        self._lock.acquire()
+        try:
+            for key in keys:
+                if key is not None:
+                    self._entries.pop(key, None)
+                    self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+def _user_key(id_or_email):
+    """Return the `UserCache' key for a user id or email address."""
+    try:
+        return int(id_or_email)
+    except (TypeError, ValueError):
+        if isinstance(id_or_email, basestring):
+            return id_or_email.strip().lower()
+        return id_or_email
+
+
+_tag_query_token_re = re.compile(r"\s*(?:([&|!()])|([^\s&|!()]+))")
+
+def _parse_tag_query(query):
+    """Parse the given boolean tag query into a tree of tuples:
+    ("tag", <tag>), ("not", <node>), ("and", <node>, <node>) and
+    ("or", <node>, <node>).
+
+        query  := term ('|' term)*
+        term   := factor (['&'] factor)*
+        factor := '!' factor | '(' query ')' | <tag>
+    """
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = _tag_query_token_re.match(query, pos)
+        if not match:
+            raise ThirtyBoxesError("invalid tag query: %r" % query)
+        tokens.append(match.group(1) or ("tag", match.group(2)))
+        pos = match.end()
+    tokens.append(None)  # end marker
+    state = {"pos": 0}
+
+    def peek():
+        return tokens[state["pos"]]
+    def take():
+        token = tokens[state["pos"]]
+        state["pos"] += 1
+        return token
+    def error(msg):
+        return ThirtyBoxesError("invalid tag query: %r: %s" % (query, msg))
+
+    def parse_query():
+        node = parse_term()
+        while peek() == '|':
+            take()
+            node = ("or", node, parse_term())
+        return node
+    def parse_term():
+        node = parse_factor()
+        while peek() not in ('|', ')', None):
+            if peek() == '&':
+                take()
+            node = ("and", node, parse_factor())
+        return node
+    def parse_factor():
+        token = take()
+        if token == '!':
+            return ("not", parse_factor())
+        elif token == '(':
+            node = parse_query()
+            if take() != ')':
+                raise error("missing ')'")
+            return node
+        elif isinstance(token, tuple):
+            return token
+        elif token is None:
+            raise error("unexpected end of query")
+        else:
+            raise error("unexpected '%s'" % token)
+
+    tree = parse_query()
+    if peek() is not None:
+        raise error("unexpected '%s'" % peek())
+    return tree
+
+def _tags_from_tag_query(tree):
+    if tree[0] == "tag":
+        return [tree[1]]
+    tags = []
+    for child in tree[1:]:
+        tags += _tags_from_tag_query(child)
+    return tags
+
+
+def _event_list_from_store(store, start, end, owner=None):
+    """Return an eventList response for the given range from the given
+    owner's events in the given event store.
+    """
+    return {
+        "events": store.events_in_range(start, end, owner),
+        "userId": store.get_user_id(owner),
+        "listStart": start,
+        "listEnd": end,
+    }
+
+def _update_store(store, event_list, start, end, owner=None):
+    """Replace the given owner's events in the given range in the given
+    store with those in the given eventList response. Returns the ids
+    of the events that were deleted.
+    """
+    events = event_list["events"]
+    ids = set(e["id"] for e in events)
+    deleted = [id for id in store.ids_in_range(start, end, owner)
+               if id not in ids]
+    store.upsert(events, owner)
+    store.delete(deleted, owner)
+    store.add_coverage(start, end, owner)
+    if event_list.get("userId") is not None:
+        store.set_user_id(event_list["userId"], owner)
+    return deleted
+
+
+
+#---- compact event and user records
+
+class _Record(object):
+    """Base class for compact, dict-compatible records.
+
+    Fields are stored in `__slots__' rather than a per-instance dict.
+    A field that was never set is missing (as from a dict).
+    """
+    __slots__ = ()
+    # Fields with few distinct values, whose strings are shared.
+    _interned_fields = frozenset()
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self.__slots__ and hasattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def values(self):
+        return [getattr(self, name) for name in self.keys()]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (_Record, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    # Mutable and compared by value, so (like a dict) not hashable.
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            if name in self._interned_fields:
+                value = _intern(value)
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+            ', '.join("%s=%r" % item for item in self.items()))
+
+
+class Event(_Record):
+    """A 30boxes event. Use `ThirtyBoxes(..., records=True)' to get these
+    instead of dicts.
+    """
+    __slots__ = ("id", "summary", "notes", "start", "end", "allDayEvent",
+                 "repeatType", "repeatEndDate", "repeatSkipDates",
+                 "repeatICal", "reminder", "externalUID", "lastUpdate",
+                 "tags", "privacy", "invitation")
+    _interned_fields = frozenset(["repeatType", "privacy", "reminder"])
+
+
+class LazyEvent(Event):
+    """An `Event' that keeps the raw text of each field and converts it
+    (e.g. parses a date) only when the field is first read. Use
+    `ThirtyBoxes(..., lazy=True)' to get these.
+
+    Note that a malformed field is only reported when it is read.
+    """
+    __slots__ = ("_raw",)  # field name -> raw value
+
+    def __init__(self, **fields):
+        self._raw = {}
+        Event.__init__(self, **fields)
+
+    def __getattr__(self, name):
+        # Only called for fields not yet converted (or missing).
+        if name == "_raw":
+            raise AttributeError(name)
+        try:
+            value = self._raw[name]
+        except KeyError:
+            # Another thread may have just converted it.
+            return Event.__getattribute__(self, name)
+        convert = _lazy_event_converters.get(name)
+        if convert is not None:
+            value = convert(value)
+        setattr(self, name, value)
+        self._raw.pop(name, None)
+        return value
+
+    def __contains__(self, name):
+        return name in self._raw or Event.__contains__(self, name)
+
+    def keys(self):
+        raw = self._raw
+        return [name for name in Event.__slots__
+                if name in raw or hasattr(self, name)]
+
+    def __setstate__(self, state):
+        self._raw = {}
+        Event.__setstate__(self, state)
+
+
+class User(_Record):
+    """A 30boxes user. Use `ThirtyBoxes(..., records=True)' to get these
+    instead of dicts.
+    """
+    __slots__ = ("id", "facebookId", "firstName", "lastName", "status",
+                 "dateFormat", "bio", "timeZone", "avatar", "createDate",
+                 "startDay", "use24HourClock", "personalSite", "feeds",
+                 "emails", "IM", "buddies")
+
+
+_interned_strings = {}
+# Bounds `_interned_strings', which is never emptied. The interned
+# fields have few distinct values, so this is only reached with odd
+# data: later strings then just aren't shared.
+_MAX_INTERNED_STRINGS = 1000
+
+def _intern(s):
+    """Return a shared copy of the given (str or unicode) string."""
+    if s is None:
+        return s
+    try:
+        return _interned_strings[s]
+    except KeyError:
+        if len(_interned_strings) >= _MAX_INTERNED_STRINGS:
+            return s
+        return _interned_strings.setdefault(s, s)
+
+
+
+#---- the asynchronous 30boxes.com module API
+
+class AsyncResult(object):
+    """The pending result of an asynchronous 30boxes API call.
+
+    Calling `result()' drives the owning client's event loop until this
+    call has completed, then returns its value (or raises its error).
+    Other pending calls on the same client make progress meanwhile.
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._done = False
+        self._value = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            self._loop.run(until=self)
+            if not self._done:
+                raise ThirtyBoxesError("asynchronous call did not complete")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+    def add_done_callback(self, callback):
+        """Call `callback(result)' when this call has completed."""
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _then(self, func):
+        """Return a new AsyncResult for `func' applied to this result."""
+        chained = AsyncResult(self._loop)
+        def on_done(result):
+            try:
+                value = func(result.result())
+            except:
+                chained._set_exc_info(sys.exc_info())
+            else:
+                chained._set_value(value)
+        self.add_done_callback(on_done)
+        return chained
+
+    def _set_value(self, value):
+        self._value = value
+        self._finish()
+
+    def _set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class _AsyncLoop(object):
+    """An asyncore socket map plus a queue of requests waiting for one
+    of at most `max_in_flight' request slots.
+    """
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self._map = {}
+        self._queue = deque()
+        self._num_in_flight = 0
+
+    def submit(self, url, deadline=None):
+        """Queue a request for the given URL and return an AsyncResult
+        for its response. If a "deadline" (a `time.time()' value) is
+        given the request fails with ThirtyBoxesTimeoutError if it is
+        not done by then (including time spent queued).
+        """
+        result = AsyncResult(self)
+        self._queue.append((url, result, deadline))
+        self._start_queued()
+        return result
+
+    def run(self, until=None):
+        """Run until all requests are done (or until `until' is done)."""
+        while self._num_in_flight or self._queue:
+            if until is not None and until.done():
+                break
+            if not self._map:
+                break
+            asyncore.loop(timeout=0.1, map=self._map, count=1)
+            self._expire()
+
+    def _expire(self):
+        """Fail the requests whose deadline has passed."""
+        now = time.time()
+        for request in self._map.values():
+            if request.deadline is not None and now >= request.deadline:
+                request.handle_timeout()
+        if any(deadline is not None and now >= deadline
+               for url, result, deadline in self._queue):
+            queue, self._queue = self._queue, deque()
+            for url, result, deadline in queue:
+                if deadline is not None and now >= deadline:
+                    result._set_exc_info(_timeout_exc_info(url))
+                else:
+                    self._queue.append((url, result, deadline))
+
+    def _start_queued(self):
+        while self._queue and self._num_in_flight < self.max_in_flight:
+            url, result, deadline = self._queue.popleft()
+            if deadline is not None and time.time() >= deadline:
+                result._set_exc_info(_timeout_exc_info(url))
+                continue
+            self._num_in_flight += 1
+            try:
+                _AsyncHTTPRequest(url, result, self, deadline)
+            except:
+                self._num_in_flight -= 1
+                result._set_exc_info(sys.exc_info())
+
+    def _request_done(self):
+        self._num_in_flight -= 1
+        self._start_queued()
+
+
+def _timeout_exc_info(url):
+    try:
+        raise ThirtyBoxesTimeoutError("`%s' timed out" % url)
+    except ThirtyBoxesTimeoutError:
+        return sys.exc_info()
+
+
+class _AsyncHTTPRequest(asyncore.dispatcher):
+    """A single non-blocking HTTP GET request."""
+    def __init__(self, url, result, loop, deadline=None):
+        asyncore.dispatcher.__init__(self, map=loop._map)
+        scheme, host, port, selector = _split_url(url)
+        if scheme != "http":
+            raise ThirtyBoxesError("asynchronous interface only supports "
+                                   "'http' URLs: %r" % url)
+        self._url = url
+        self._result = result
+        self._loop = loop
+        self.deadline = deadline
+        self._finished = False
+        self._outbuf = ("GET %s HTTP/1.0\r\n"
+                        "Host: %s\r\n"
+                        "Accept-Encoding: gzip, deflate\r\n"
+                        "Connection: close\r\n\r\n" % (selector, host))
+        self._inbuf = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self._outbuf)
+
+    def handle_write(self):
+        sent = self.send(self._outbuf)
+        self._outbuf = self._outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self._inbuf.append(data)
+
+    def handle_close(self):
+        self.close()
+        try:
+            body = self._body_from_response(''.join(self._inbuf))
+        except:
+            self._finish(exc_info=sys.exc_info())
+        else:
+            self._finish(value=body)
+
+    def handle_error(self):
+        exc_info = sys.exc_info()
+        self.close()
+        self._finish(exc_info=exc_info)
+
+    def handle_timeout(self):
+        self.close()
+        self._finish(exc_info=_timeout_exc_info(self._url))
+
+    def _body_from_response(self, raw):
+        from urllib2 import HTTPError, URLError
+        head, sep, body = raw.partition("\r\n\r\n")
+        if not sep:
+            raise URLError("incomplete HTTP response from `%s'" % self._url)
+        lines = head.split("\r\n")
+        try:
+            version, status, reason = (lines[0].split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise URLError("bad HTTP status line from `%s': %r"
+                           % (self._url, lines[0]))
+        headers = {}
+        for line in lines[1:]:
+            name, colon, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if status != 200:
+            raise HTTPError(self._url, status, reason, headers, None)
+        encoding = headers.get("content-encoding", "").lower()
+        return _decode_content(body, encoding)
+
+    def _finish(self, value=None, exc_info=None):
+        if self._finished:
+            return
+        self._finished = True
+        self._loop._request_done()
+        if exc_info is not None:
+            self._result._set_exc_info(exc_info)
+        else:
+            self._result._set_value(value)
+
 
-    def events_Search(self, query):
-        """Return all events matching the given query.
+class AsyncRawThirtyBoxes(RawThirtyBoxes):
+    """An asynchronous version of `RawThirtyBoxes'.
 
-        See user_Authorize for getting an 'authorizedUserToken'. 
-        """
-        return self._api_call("events.Search",
-                              query=query,
-                              authorizedUserToken=self.authorizedUserToken,
-                              apiKey=self.apiKey)
+    Each API method immediately returns an `AsyncResult' for the XML
+    response. Requests are made with non-blocking sockets, at most
+    "max_in_flight" (default 100) at a time. Call `run()' to complete
+    all pending requests, or `result()' on any one of them.
 
-    def events_TagSearch(self, tag):
-        """Return all events tagged with the given tag.
+    As for `RawThirtyBoxes', a call that isn't done within "timeout"
+    seconds (if given) or by the end of the calling thread's
+    `deadline()' block when it was made fails with
+    ThirtyBoxesTimeoutError, so a stalled connection can't hold up the
+    other calls. The deadline covers time spent queued for one of the
+    "max_in_flight" slots.
+    """
+    def __init__(self, apiKey=None, authorizedUserToken=None,
+                 max_in_flight=100, timeout=None):
+        self._credentials_lock = threading.Lock()
+        self._credentials = (apiKey, authorizedUserToken)
+        self.timeout = timeout
+        self._loop = _AsyncLoop(max_in_flight)
 
-        See user_Authorize for getting an 'authorizedUserToken'. 
-        """
-        return self._api_call("events.TagSearch",
-                              tag=tag,
-                              authorizedUserToken=self.authorizedUserToken,
-                              apiKey=self.apiKey)
+    def run(self):
+        self._loop.run()
 
     def _api_call(self, method, **args):
         url = self._url_from_method_and_args(method, **args)
-        log.debug("call `%s'", url)
-        f = urlopen(url)
-        xml_response = f.read()
-        return xml_response
+        log.debug("call `%s' (async)", url)
+        return self._loop.submit(url, _call_deadline(self.timeout))
 
-    def _url_from_method_and_args(self, method, **args):
-        from urllib import quote
-        url = API_URL + "?method=%s" % method
-        for name, value in args.items():
-            if value is not None:
-                url += "&%s=%s" % (quote(str(name)), quote(str(value)))
-        return url
 
+class AsyncThirtyBoxes(ThirtyBoxes):
+    """An asynchronous version of `ThirtyBoxes'.
 
+    Each API method immediately returns an `AsyncResult' for the parsed
+    response (parsed the same way as by `ThirtyBoxes'). Issue many calls,
+    then collect them:
 
-#---- the richer, more-Pythonic 30boxes.com module API
+        >>> tb = thirtyboxes.AsyncThirtyBoxes(max_in_flight=50)
+        >>> pending = [tb.find_user(id) for id in ids]
+        >>> users = [p.result() for p in pending]
 
-class ThirtyBoxes(object):
-    def __init__(self, api_key=None, auth_token=None):
+    "timeout" is as for `AsyncRawThirtyBoxes'.
+    """
+    def __init__(self, api_key=None, auth_token=None, max_in_flight=100,
+                 records=False, lazy=False, timeout=None):
         if api_key is None:
             api_key = ThirtyBoxes._api_key_from_env()
         if auth_token is None:
             auth_token = ThirtyBoxes._auth_token_from_env()
-        self._api = RawThirtyBoxes(api_key, auth_token)
-
-    def _get_api_key_prop(self):
-        return self._api.api_key
-    def _set_api_key_prop(self, api_key):
-        self._api.apiKey = api_key
-    api_key = property(_get_api_key_prop, _set_api_key_prop, None,
-                       "30boxes API key")
+        self._api = AsyncRawThirtyBoxes(api_key, auth_token,
+                                        max_in_flight=max_in_flight,
+                                        timeout=timeout)
+        self._set_unmarshallers(records, lazy)
 
-    def _get_auth_token_prop(self):
-        return self._api.auth_token
-    def _set_auth_token_prop(self, auth_token):
-        self._api.authorizedUserToken = auth_token
-    auth_token = property(_get_auth_token_prop, _set_auth_token_prop, None,
-                          "30boxes authorized user token")
+    def run(self):
+        """Run until all pending calls have completed."""
+        self._api.run()
 
-    @staticmethod
-    def _api_key_from_env():
-        """Look for a 30boxes API key.
+    def events_range(self, start, end, max_workers=None):
+        """Asynchronous `ThirtyBoxes.events_range()'.
 
-        First look for the THIRTYBOXES_APIKEY environment variable, then for
-        `~/.30boxes/apikey'.
+        All windows are requested at once (subject to "max_in_flight");
+        "max_workers" is ignored.
         """
-        apikey = None
-        if "THIRTYBOXES_APIKEY" in os.environ:
-            log.debug("using API key from THIRTYBOXES_APIKEY env var")
-            apikey = os.environ["THIRTYBOXES_APIKEY"]
-        else:
-            apikey_path = expanduser(join("~", ".30boxes", "apikey"))
-            if exists(apikey_path):
-                log.debug("using API key from `%s'", apikey_path)
-                apikey = open(apikey_path, 'r').read().strip()
-        return apikey
-
-    @staticmethod
-    def _auth_token_from_env():
-        """Look for a 30boxes authenticated user token (auth token).
-
-        First look for the THIRTYBOXES_AUTHTOKEN environment variable, then for
-        `~/.30boxes/authtoken'.
+        windows = _windows_from_range(start, end, MAX_EVENTS_SPAN)
+        pending = [self._events_window(*window) for window in windows]
+        return _gather(self._api._loop, pending)._then(_merge_event_lists)
+
+    def find_users(self, ids_or_emails, max_workers=None):
+        """Asynchronous `ThirtyBoxes.find_users()'.
+
+        Returns an `AsyncResult' for the list of users, in the same
+        order, with each user that could not be found or fetched
+        replaced by the exception that was raised. Each distinct user is
+        requested once and all are requested at once (subject to
+        "max_in_flight"); "max_workers" is ignored.
         """
-        authtoken = None
-        if "THIRTYBOXES_AUTHTOKEN" in os.environ:
-            log.debug("using auth token from THIRTYBOXES_AUTHTOKEN env var")
-            authtoken = os.environ["THIRTYBOXES_AUTHTOKEN"]
+        ids_or_emails = list(ids_or_emails)
+        keys = [_user_key(id_or_email) for id_or_email in ids_or_emails]
+        pending_from_key = {}
+        for key, id_or_email in zip(keys, ids_or_emails):
+            if key not in pending_from_key:
+                pending_from_key[key] = _settle(self.find_user(id_or_email))
+        pending = [pending_from_key[key] for key in keys]
+        return _gather(self._api._loop, pending)
+
+    def _parse(self, what, response, unmarshallers, then=None):
+        def parse(r):
+            value = _parse_response(what, r, unmarshallers)
+            if then is not None:
+                then(value)
+            return value
+        return response._then(parse)
+
+    def _iter_parse(self, response, unmarshallers):
+        # The iter_*() generators are inherently blocking: wait for each
+        # response in turn.
+        return _iter_events_from_response(response.result(), unmarshallers)
+
+
+def _gather(loop, pending):
+    """Return an AsyncResult for the list of values of the given
+    AsyncResults (in order). It fails with the first error.
+    """
+    gathered = AsyncResult(loop)
+    remaining = [len(pending)]
+    def on_done(result):
+        if gathered.done():
+            return
+        if result._exc_info is not None:
+            gathered._set_exc_info(result._exc_info)
+            return
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            gathered._set_value([r.result() for r in pending])
+    if not pending:
+        gathered._set_value([])
+    for result in pending:
+        result.add_done_callback(on_done)
+    return gathered
+
+def _settle(result):
+    """Return an AsyncResult for the value of the given AsyncResult or,
+    if it fails, the exception it raised.
+    """
+    settled = AsyncResult(result._loop)
+    def on_done(result):
+        exc_info = result._exc_info
+        if exc_info is None:
+            settled._set_value(result._value)
+        elif isinstance(exc_info[1], Exception):
+            settled._set_value(exc_info[1])
         else:
-            authtoken_path = expanduser(join("~", ".30boxes", "authtoken"))
-            if exists(authtoken_path):
-                log.debug("using auth token from `%s'", authtoken_path)
-                authtoken = open(authtoken_path, 'r').read().strip()
-        return authtoken
-
-    #XXX Need to walk through a web app example that uses these
-    #    and document how to use that.
-    def get_api_key(self):
-        self._api.getKeyForUser()
-    def authorize_user(self, app_name, app_logo_url=None, return_url=None):
-        self._api.user_Authorize(app_name, app_logo_url, return_url)
+            settled._set_exc_info(exc_info)
+    result.add_done_callback(on_done)
+    return settled
 
-    def ping(self):
-        response = self._api.test_Ping()
-        return _parse_response("ping", response, _ping_unmarshallers)
-
-    def find_user(self, id):
-        try:
-            int(id)
-        except ValueError:
-            response = self._api.user_FindByEmail(id)
-        else:
-            response = self._api.user_FindById(id)
-        return _parse_response("user", response, _user_unmarshallers)
 
-    def all_user_info(self):
-        response = self._api.user_GetAllInfo()
-        return _parse_response("user", response, _user_unmarshallers)
 
-    def events(self, start=None, end=None):
-        """Return events that start on or after "start" to on or before
-        "end".
+#---- internal support stuff
 
-            "start" (optional) is a Python datetime or date instance
-                It defaults to today.
-            "end" (optional" is a Python datetime or date instance.
-                It defaults to "start" + 90 days and cannot be more than
-                180 days after "start".
-        """
-        if start:
-            if isinstance(start, datetime.datetime):
-                start_str = start.strftime("%Y-%m-%d %H:%M:%S")
-            elif isinstance(start, datetime.date):
-                start_str = start.strftime("%Y-%m-%d")
-            else:
-                raise ThirtyBoxesError("invalid 'start' argument: must be "
-                                       "datetime.datetime or datetime.date: "
-                                       "%r" % start)
-        else:
-            start_str = None
-        if end:
-            if isinstance(end, datetime.datetime):
-                end_str = end.strftime("%Y-%m-%d %H:%M:%S")
-            elif isinstance(end, datetime.date):
-                end_str = end.strftime("%Y-%m-%d")
-            else:
-                raise ThirtyBoxesError("invalid 'end' argument: must be "
-                                       "datetime.datetime or datetime.date: "
-                                       "%r" % end)
-        else:
-            end_str = None
+def _remaining(deadline):
+    """Return the number of seconds left until the given deadline (or
+    None for no deadline). Raise ThirtyBoxesTimeoutError if it has
+    passed.
+    """
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise ThirtyBoxesTimeoutError("deadline exceeded")
+    return remaining
+
+def _set_timeout(conn, deadline):
+    """Set the timeout of the given HTTP connection's socket for the
+    time remaining until the deadline.
+    """
+    if deadline is None:
+        timeout = socket.getdefaulttimeout()
+    else:
+        timeout = _remaining(deadline)
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+
+def _split_url(url):
+    """Return a (scheme, host, port, selector) 4-tuple for the given URL."""
+    scheme, netloc, path, query = urlparse.urlsplit(url)[:4]
+    if ':' in netloc:
+        host, port = netloc.rsplit(':', 1)
+        port = int(port)
+    else:
+        host = netloc
+        port = (scheme == "https") and 443 or 80
+    selector = path or "/"
+    if query:
+        selector += "?" + query
+    return scheme, host, port, selector
+
+def _datetime_str_from_arg(value, name):
+    """Return the 30boxes API string for the given datetime or date
+    argument, or None if not given.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    else:
+        raise ThirtyBoxesError("invalid '%s' argument: must be "
+                               "datetime.datetime or datetime.date: "
+                               "%r" % (name, value))
 
-        response = self._api.events_Get(start_str, end_str)
-        return _parse_response("events", response, _events_unmarshallers)
+def _sortable_datetime(value):
+    """Return the given datetime or date as a datetime, so that a mix of
+    the two can be compared.
+    """
+    if isinstance(value, datetime.datetime) \
+       or not isinstance(value, datetime.date):
+        return value
+    return datetime.datetime(value.year, value.month, value.day)
+
+def _comparable_range(start, end):
+    """Return the (start, end) dates or datetimes converted to the same
+    type (datetime if they differ).
+    """
+    if type(start) is not type(end):
+        return _sortable_datetime(start), _sortable_datetime(end)
+    return start, end
 
-    def search(self, query):
-        response = self._api.events_Search(query)
-        return _parse_response("events", response, _events_unmarshallers)
+def _half_open_range(start, end):
+    """Return the range of datetimes [start, end) equivalent to the given
+    inclusive date range. A date "end" includes the whole day.
+    """
+    if isinstance(end, datetime.datetime):
+        end += datetime.timedelta(microseconds=1)
+    else:
+        end = _sortable_datetime(end + datetime.timedelta(days=1))
+    return _sortable_datetime(start), end
 
-    def tag_search(self, tag):
-        response = self._api.events_TagSearch(tag)
-        return _parse_response("events", response, _events_unmarshallers)
+def _range_contains(start, end, value):
+    """Return true if the given datetime or date is on or after "start"
+    and on or before "end". A date "end" includes the whole day.
+    """
+    lo, hi = _half_open_range(start, end)
+    return lo <= _sortable_datetime(value) < hi
 
+def _inclusive_range(lo, hi):
+    """Return the inclusive (start, end) range, suitable for the
+    `events()' arguments, equivalent to the half-open datetime range
+    [lo, hi). Whole days are returned as dates.
+    """
+    midnight = datetime.time(0)
+    if lo.time() == midnight and hi.time() == midnight:
+        return lo.date(), (hi - datetime.timedelta(days=1)).date()
+    return lo, hi - datetime.timedelta(microseconds=1)
+
+class _IntervalSet(object):
+    """A set of values stored as sorted, disjoint half-open intervals
+    [start, end).
+    """
+    def __init__(self, intervals=()):
+        self._starts = []
+        self._ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    def __iter__(self):
+        return iter(zip(self._starts, self._ends))
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        # Merge with all intervals that overlap or touch [start, end).
+        i = bisect.bisect_left(self._ends, start)
+        j = bisect.bisect_right(self._starts, end)
+        if i < j:
+            start = min(start, self._starts[i])
+            end = max(end, self._ends[j-1])
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+
+    def gaps(self, start, end):
+        """Return the parts of [start, end) not in this set, as a list
+        of (start, end) intervals.
+        """
+        gaps = []
+        i = bisect.bisect_right(self._ends, start)
+        while start < end:
+            if i >= len(self._starts) or self._starts[i] >= end:
+                gaps.append((start, end))
+                break
+            if self._starts[i] > start:
+                gaps.append((start, self._starts[i]))
+            start = self._ends[i]
+            i += 1
+        return gaps
+
+    def covers(self, start, end):
+        return not self.gaps(start, end)
+
+def _sql_datetime(value):
+    """Return the given datetime or date as a sortable string."""
+    return _sortable_datetime(value).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def _datetime_from_sql(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+
+def _json_obj_from_event(event):
+    """Return the given event (a dict or `Event') as a JSON-able dict.
+    See `_json_default()' for its date(time) fields.
+    """
+    if isinstance(event, Event):
+        return {"record": "Event", "fields": dict(event.items())}
+    return {"record": None, "fields": event}
+
+def _event_from_json_obj(obj):
+    fields = dict((str(name), value)
+                  for name, value in obj["fields"].items())
+    if obj["record"] == "Event":
+        return Event(**fields)
+    return fields
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.strftime("%Y-%m-%d %H:%M:%S.%f")}
+    elif isinstance(value, datetime.date):
+        return {"__date__": value.strftime("%Y-%m-%d")}
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+def _json_object_hook(obj):
+    if "__datetime__" in obj:
+        return datetime.datetime.strptime(obj["__datetime__"],
+                                          "%Y-%m-%d %H:%M:%S.%f")
+    elif "__date__" in obj:
+        return datetime.datetime.strptime(obj["__date__"],
+                                          "%Y-%m-%d").date()
+    return obj
+
+def _sql_range(start, end):
+    lo, hi = _half_open_range(start, end)
+    return _sql_datetime(lo), _sql_datetime(hi)
+
+def _windows_from_range(start, end, max_span):
+    """Split the given date range into a list of (start, end) windows
+    each no longer than `max_span'. Adjacent windows share an endpoint.
+    """
+    start, end = _comparable_range(start, end)
+    windows = []
+    while end - start > max_span:
+        windows.append((start, start + max_span))
+        start += max_span
+    windows.append((start, end))
+    return windows
+
+def _merge_event_lists(event_lists):
+    """Merge the given eventList responses into one. Events are unique
+    by 'id' and 'start' (the occurrences of a repeating event share an
+    id) and sorted by 'start', with any events without one last.
+    """
+    merged = {"events": []}
+    seen = set()
+    for event_list in event_lists:
+        for key, value in event_list.items():
+            if key == "events":
+                for event in value:
+                    occurrence = (event["id"],
+                                  _sortable_datetime(event.get("start")))
+                    if occurrence not in seen:
+                        seen.add(occurrence)
+                        merged["events"].append(event)
+            elif key == "listStart" and merged.get(key) is not None:
+                merged[key] = min(merged[key], value,
+                                  key=_sortable_datetime)
+            elif key == "listEnd" and merged.get(key) is not None:
+                merged[key] = max(merged[key], value,
+                                  key=_sortable_datetime)
+            else:
+                merged.setdefault(key, value)
+    merged["events"].sort(key=_event_sort_key)
+    return merged
+
+def _event_sort_key(event):
+    start = event.get("start")
+    return (start is None, _sortable_datetime(start))
+
+def _map_concurrently(func, items, max_workers):
+    """Return `[func(item) for item in items]', calling `func' from up
+    to `max_workers' threads. The first error (in item order) is
+    re-raised.
+    """
+    items = list(items)
+    if max_workers is None or max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    todo = deque(enumerate(items))
+    def worker():
+        while True:
+            try:
+                i, item = todo.popleft()
+            except IndexError:
+                return
+            try:
+                results[i] = func(item)
+            except:
+                errors[i] = sys.exc_info()
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for exc_info in errors:
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+class _Memo(object):
+    """A bounded memo keeping roughly the `size' most recently used
+    entries.
+
+    This approximates LRU with two generations of plain dicts: when the
+    current generation is full it becomes the old one, and hits in the
+    old generation are moved back to the current one.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._current = {}
+        self._old = {}
 
+    def __getitem__(self, key):
+        try:
+            return self._current[key]
+        except KeyError:
+            value = self._old[key]
+            self.add(key, value)
+            return value
+
+    def add(self, key, value):
+        current = self._current
+        if len(current) >= self.size:
+            self._old = current
+            current = self._current = {}
+        current[key] = value
+
+    def clear(self):
+        self._current = {}
+        self._old = {}
+
+_datetime_memo = _Memo(1024)
+
+class _SingleFlight(object):
+    """Coalesces concurrent calls with the same key: while `do(key, func)'
+    is calling `func()' other `do()' calls with that key wait for it and
+    return its value (or raise its error) instead of calling `func()'.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {} # key -> _Flight in progress
 
+    def do(self, key, func):
+        while True:
+            self._lock.acquire()
+            try:
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = _Flight()
+                    break
+            finally:
+                self._lock.release()
+            flight.done.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], \
+                      flight.exc_info[2]
+            if not flight.interrupted:
+                return flight.value
+            # The call was interrupted (e.g. by KeyboardInterrupt in its
+            # thread) rather than failing: make it again.
 
-#---- internal support stuff
+        try:
+            flight.value = func()
+        except Exception:
+            flight.exc_info = sys.exc_info()
+            raise
+        except:
+            flight.interrupted = True
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._flights[key]
+            finally:
+                self._lock.release()
+            flight.done.set()
+        return flight.value
+
+class _Flight(object):
+    __slots__ = ("done", "value", "exc_info", "interrupted")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+        self.interrupted = False
+
+def _datetime_from_fixed_width_str(s):
+    """Parse 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' by slicing.
+
+    Returns _UNPARSED if the string doesn't have that layout or isn't
+    a valid date(time).
+    """
+    try:
+        n = len(s)
+        if n == 10 and s[4] == '-' and s[7] == '-':
+            if s == "0000-00-00":
+                return None
+            return datetime.date(int(s[:4]), int(s[5:7]), int(s[8:]))
+        elif n == 19 and s[4] == '-' and s[7] == '-' and s[10] == ' ' \
+             and s[13] == ':' and s[16] == ':':
+            return datetime.datetime(int(s[:4]), int(s[5:7]), int(s[8:10]),
+                                     int(s[11:13]), int(s[14:16]),
+                                     int(s[17:]))
+    except (TypeError, ValueError):
+        pass
+    return _UNPARSED
 
 def _datetime_from_datetime_str(datetime_str, purpose=None):
     """Return a datetime.datetime or datetime.date object representing
@@ -452,6 +4124,42 @@ def _datetime_from_datetime_str(datetime_str, purpose=None):
         YYYY-MM-DD              datetime.date()
         YYYY-MM-DD HH:MM:SS     datetime.datetime()
         0000-00-00              None (i.e. not applicable)
+
+    Results are memoized: many events share the same dates.
+    """
+    try:
+        return _datetime_memo[datetime_str]
+    except (KeyError, TypeError):
+        pass
+    value = _datetime_from_fixed_width_str(datetime_str)
+    if value is _UNPARSED:
+        value = _parse_datetime_str(datetime_str, purpose)
+    _datetime_memo.add(datetime_str, value)
+    return value
+
+def _datetimes_from_datetime_strs(datetime_strs, purpose=None):
+    """Return a list of the datetime.datetime or datetime.date objects
+    for each of the given date(time) strings.
+
+    See `_datetime_from_datetime_str()'.
+    """
+    memo = _datetime_memo
+    fixed_width = _datetime_from_fixed_width_str
+    values = []
+    for datetime_str in datetime_strs:
+        try:
+            value = memo[datetime_str]
+        except (KeyError, TypeError):
+            value = fixed_width(datetime_str)
+            if value is _UNPARSED:
+                value = _parse_datetime_str(datetime_str, purpose)
+            memo.add(datetime_str, value)
+        values.append(value)
+    return values
+
+def _parse_datetime_str(datetime_str, purpose=None):
+    """The general (slow) implementation of
+    `_datetime_from_datetime_str()', which also produces its errors.
     """
     try:
         if datetime_str == "0000-00-00":
@@ -474,6 +4182,59 @@ def _datetime_from_datetime_str(datetime_str, purpose=None):
                                "'YYYY-MM-DD HH:MM:SS')"
                                % (datetime_str, purpose_str, ex))
 
+def _decode_content(body, encoding):
+    """Decode an HTTP response body per its Content-Encoding."""
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib header.
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+def _is_error_response(xml_response):
+    """Return true if the given XML response is an API error."""
+    return 'stat="fail"' in xml_response[:512]
+
+# Each unmarshaller takes an ElementTree element whose children have
+# already been unmarshalled (each child's `text' is its value). For use by
+# the compiled expat-based parser (see `_CompiledUnmarshaller') each also
+# has either a `convert_text' attribute -- for leaf elements, a function
+# of the element text -- or a `build' attribute -- a function of the
+# element's attributes, text and children as [tag, value, tail] lists.
+
+def _leaf(convert_text):
+    """Return an unmarshaller for a leaf element whose value is
+    `convert_text(<element text>)'.
+    """
+    unmarshal = lambda elem: convert_text(elem.text)
+    unmarshal.convert_text = convert_text
+    return unmarshal
+
+def _datetime_leaf(purpose):
+    return _leaf(lambda text: _datetime_from_datetime_str(text, purpose))
+
+def _identity(text):
+    return text
+
+_text = _leaf(_identity)
+
+def _undecoded(text):
+    return text
+
+# A leaf whose value is its text *as it comes from expat* (i.e. UTF-8
+# encoded), for values decoded later by `_decoded()'.
+_undecoded_text = _leaf(_undecoded)
+
+def _decoded(text):
+    if isinstance(text, str):
+        return _fixtext(text)
+    return text
+_int = _leaf(int)
+_bool = _leaf(lambda text: operator.truth(int(text)))
+
 def _unmarshal_rsp(elem):
     if elem.get("stat") == "fail":
         raise ThirtyBoxesAPIError(**elem[0].text)
@@ -483,85 +4244,130 @@ def _unmarshal_rsp(elem):
     else:
         return dict([(elem[i].tag, elem[i].text) for i in range(len(elem))])
 
+def _build_rsp(attrs, text, children):
+    if attrs.get("stat") == "fail":
+        raise ThirtyBoxesAPIError(**children[0][1])
+    assert attrs.get("stat") == "ok"
+    if len(children) == 1:
+        return children[0][1]
+    else:
+        return dict([(child[0], child[1]) for child in children])
+_unmarshal_rsp.build = _build_rsp
+
 def _unmarshal_err(elem):
     return {
         "code": int(elem.get("code")),
         "msg":  elem.get("msg"),
     }
+_unmarshal_err.build = lambda attrs, text, children: {
+    "code": int(attrs.get("code")),
+    "msg":  attrs.get("msg"),
+}
 
-def _unmarshal_user_elem(elem):
-    user = {}
-    for child in elem:
-        if child.tag == "feed":
+def _unmarshal_dict(elem):
+    """Unmarshal an element to a dict of its children's values."""
+    return dict([(elem[i].tag, elem[i].text) for i in range(len(elem))])
+_unmarshal_dict.build = lambda attrs, text, children: dict(
+    [(child[0], child[1]) for child in children])
+
+def _user_from_children(children, user=None):
+    """Return a user dict from the given (tag, value) children of a
+    <user> or <buddy> element.
+    """
+    if user is None:
+        user = {}
+    for tag, value in children:
+        if tag == "feed":
             if "feeds" not in user:
                 user["feeds"] = []
-            user["feeds"].append(child.text)
-        elif child.tag == "email":
+            user["feeds"].append(value)
+        elif tag == "email":
             if "emails" not in user:
                 user["emails"] = []
-            user["emails"].append(child.text)
-        elif child.tag == "IM":
+            user["emails"].append(value)
+        elif tag == "IM":
             if "IM" not in user:
                 user["IM"] = {}
-            user["IM"][child.text["type"]] = child.text["username"]
-        elif child.tag == "buddy":
+            user["IM"][value["type"]] = value["username"]
+        elif tag == "buddy":
             if "buddies" not in user:
                 user["buddies"] = []
-            user["buddies"].append(child.text)
+            user["buddies"].append(value)
         else:
-            user[child.tag] = child.text
+            user[tag] = value
     return user
 
-def _unmarshal_eventList(elem):
+def _unmarshal_user_elem(elem, user=None):
+    return _user_from_children([(child.tag, child.text) for child in elem],
+                               user)
+_unmarshal_user_elem.build = lambda attrs, text, children: \
+    _user_from_children([(child[0], child[1]) for child in children])
+
+def _event_list_from_children(children):
     event_list = {
         "events": [],
     }
-    for child in elem:
-        if child.tag == "event":
-            event_list["events"].append(child.text)
+    for tag, value in children:
+        if tag == "event":
+            event_list["events"].append(value)
         else:
-            event_list[child.tag] = child.text
+            event_list[tag] = value
     return event_list
 
+def _unmarshal_eventList(elem):
+    return _event_list_from_children([(child.tag, child.text)
+                                      for child in elem])
+_unmarshal_eventList.build = lambda attrs, text, children: \
+    _event_list_from_children([(child[0], child[1]) for child in children])
+
 def _unmarshal_notes(elem):
     notes = elem.text
     for child in elem:
         assert child.tag == "br"
         if child.tag == "br":
-            notes += child.text or ''
+            notes = (notes or '') + child.text + (child.tail or '')
+    return notes
+
+def _build_notes(attrs, text, children):
+    notes = text
+    for tag, value, tail in children:
+        assert tag == "br"
+        if tag == "br":
+            notes = (notes or '') + value + (tail or '')
     return notes
+_unmarshal_notes.build = _build_notes
 
 _events_unmarshallers = {
     "rsp": _unmarshal_rsp,
     "err": _unmarshal_err,
 
-    "lastUpdate": lambda x: x.text, 
-    "repeatSkipDates": lambda x: x.text,
-    "reminder": lambda x: x.text, 
-    "externalUID": lambda x: x.text,
-    "repeatICal": lambda x: x.text, 
+    "lastUpdate": _text,
+    "repeatSkipDates": _text,
+    "reminder": _text,
+    "externalUID": _text,
+    "repeatICal": _text,
     "eventList": _unmarshal_eventList,
-    "event": lambda x: dict([(x[i].tag, x[i].text) for i in range(len(x))]),
+    "event": _unmarshal_dict,
     #XXX Not sure about bounds of <invitation> yet. Ask on forum.
-    "invitation": lambda x: dict([(x[i].tag, x[i].text) for i in range(len(x))]),
-
-    "userId": lambda x: int(x.text),
-    "search": lambda x: x.text,
-    "tagSearch": lambda x: x.text,
-    "listStart": lambda x: _datetime_from_datetime_str(x.text, "'listStart' tag"),
-    "listEnd": lambda x: _datetime_from_datetime_str(x.text, "'listEnd' tag"),
-    "id": lambda x: int(x.text),
-    "summary": lambda x: x.text,
+    "invitation": _unmarshal_dict,
+
+    "userId": _int,
+    "search": _text,
+    "tagSearch": _text,
+    "listStart": _datetime_leaf("'listStart' tag"),
+    "listEnd": _datetime_leaf("'listEnd' tag"),
+    "id": _int,
+    "summary": _text,
     "notes": _unmarshal_notes,
-    "br": lambda x: '\n' + (x.tail or ''), # <br/> in <notes> content -> '\n'
-    "start": lambda x: _datetime_from_datetime_str(x.text, "event 'start' tag"),
-    "end": lambda x: _datetime_from_datetime_str(x.text, "event 'end' tag"),
-    "allDayEvent": lambda x: operator.truth(int(x.text)),
-    "repeatType": lambda x: x.text,
-    "repeatEndDate": lambda x: _datetime_from_datetime_str(x.text, "event 'repeatEndDate' tag"),
-    "tags": lambda x: x.text,
-    "privacy": lambda x: x.text,
-    "isInvitation": lambda x: operator.truth(int(x.text)),
+    "br": _leaf(lambda text: '\n'), # <br/> in <notes> content -> '\n'
+    "start": _datetime_leaf("event 'start' tag"),
+    "end": _datetime_leaf("event 'end' tag"),
+    "allDayEvent": _bool,
+    "repeatType": _text,
+    "repeatEndDate": _datetime_leaf("event 'repeatEndDate' tag"),
+    "tags": _text,
+    "privacy": _text,
+    "isInvitation": _bool,
 }
 
 _user_unmarshallers = {
@@ -569,53 +4375,427 @@ _user_unmarshallers = {
     "err": _unmarshal_err,
 
     "user": _unmarshal_user_elem,
-    "feed": lambda x: dict([(x[i].tag, x[i].text) for i in range(len(x))]),
-    "email": lambda x: dict([(x[i].tag, x[i].text) for i in range(len(x))]),
-    "IM": lambda x: dict([(x[i].tag, x[i].text) for i in range(len(x))]),
+    "feed": _unmarshal_dict,
+    "email": _unmarshal_dict,
+    "IM": _unmarshal_dict,
     "buddy": _unmarshal_user_elem,
 
-    "id": lambda x: int(x.text),
-    "facebookId": lambda x: int(x.text), 
-    "status": lambda x: x.text, 
-    "dateFormat": lambda x: x.text,
-    "bio": lambda x: x.text,    
-    "timeZone": lambda x: x.text, 
-    "firstName": lambda x: x.text,
-    "lastName": lambda x: x.text,
-    "avatar": lambda x: x.text,
-    "createDate": lambda x: datetime.date(*map(int, x.text.split('-'))),
-    "startDay": lambda x: int(x.text),
-    "use24HourClock": lambda x: operator.truth(int(x.text)),
-    "personalSite": lambda x: x.text,
-    "name": lambda x: x.text,
-    "url": lambda x: x.text,
-    "type": lambda x: x.text,
-    "username": lambda x: x.text,
-    "address": lambda x: x.text,
-    "primary": lambda x: operator.truth(int(x.text)),
+    "id": _int,
+    "facebookId": _int,
+    "status": _text,
+    "dateFormat": _text,
+    "bio": _text,
+    "timeZone": _text,
+    "firstName": _text,
+    "lastName": _text,
+    "avatar": _text,
+    "createDate": _leaf(lambda text: datetime.date(*map(int, text.split('-')))),
+    "startDay": _int,
+    "use24HourClock": _bool,
+    "personalSite": _text,
+    "name": _text,
+    "url": _text,
+    "type": _text,
+    "username": _text,
+    "address": _text,
+    "primary": _bool,
 }
 
 _ping_unmarshallers = {
     "rsp": _unmarshal_rsp,
     "err": _unmarshal_err,
-    "ping": lambda x: x.text,
-    "msg": lambda x: x.text,
+    "ping": _text,
+    "msg": _text,
 }
 
-def _parse_response(what, response, unmarshallers):
+def _file_from_response(response):
+    """Return a file-like object for the given XML response, which is
+    either a string or a file-like object.
+    """
     if log.isEnabledFor(logging.DEBUG):
+        if not isinstance(response, basestring):
+            response = response.read()
         log.debug("response:\n%s", _indent(response))
-    file = StringIO(response)
-    parser = ET.iterparse(file)
-    for action, elem in parser:
-        unmarshaller = unmarshallers.get(elem.tag)
-        if unmarshaller:
-            data = unmarshaller(elem)
-            elem.clear()
-            elem.text = data
+    if isinstance(response, basestring):
+        return StringIO(response)
+    return response
+
+def _close_response(response):
+    if not isinstance(response, basestring):
+        response.close()
+
+def _event_record_from_children(children):
+    event = Event()
+    interned_fields = Event._interned_fields
+    for tag, value in children:
+        if tag in interned_fields:
+            setattr(event, tag, _intern(value))
+        else:
+            setattr(event, tag, value)
+    return event
+
+def _unmarshal_event_record(elem):
+    return _event_record_from_children([(child.tag, child.text)
+                                        for child in elem])
+_unmarshal_event_record.build = lambda attrs, text, children: \
+    _event_record_from_children([(child[0], child[1]) for child in children])
+
+def _unmarshal_user_record(elem):
+    return _unmarshal_user_elem(elem, User())
+_unmarshal_user_record.build = lambda attrs, text, children: \
+    _user_from_children([(child[0], child[1]) for child in children], User())
+
+_record_events_unmarshallers = dict(_events_unmarshallers,
+    event=_unmarshal_event_record,
+)
+
+def _lazy_converters():
+    """Return a dict of the converters for each `LazyEvent' field: text
+    decoding plus the leaf elements' `convert_text' functions, notes
+    assembly and interning.
+    """
+    converters = {}
+    for name in Event.__slots__:
+        unmarshal = _events_unmarshallers[name]
+        convert = getattr(unmarshal, "convert_text", None)
+        if convert is None:
+            continue
+        if convert is _identity:
+            convert = _decoded
+        else:
+            convert = lambda text, convert=convert: convert(_decoded(text))
+        if name in Event._interned_fields:
+            convert = lambda text, convert=convert: _intern(convert(text))
+        converters[name] = convert
+    converters["notes"] = lambda raw: _build_notes(None, *raw)
+    return converters
+
+_lazy_event_converters = _lazy_converters()
+
+def _lazy_event_from_raw(raw):
+    event = LazyEvent.__new__(LazyEvent)
+    event._raw = raw
+    return event
+
+def _unmarshal_lazy_event(elem):
+    return _lazy_event_from_raw(dict([(child.tag, child.text)
+                                      for child in elem]))
+_unmarshal_lazy_event.build = lambda attrs, text, children: \
+    _lazy_event_from_raw(dict([(child[0], child[1]) for child in children]))
+
+def _unmarshal_lazy_notes(elem):
+    return (elem.text, [(child.tag, child.text, child.tail)
+                        for child in elem])
+_unmarshal_lazy_notes.build = lambda attrs, text, children: (text, children)
+
+# Leave the text of <event> fields unconverted for `LazyEvent'.
+_lazy_events_unmarshallers = dict(_events_unmarshallers,
+    event=_unmarshal_lazy_event,
+    notes=_unmarshal_lazy_notes,
+    **dict((name, _undecoded_text) for name in _lazy_event_converters
+           if name != "notes")
+)
+
+_record_user_unmarshallers = dict(_user_unmarshallers,
+    user=_unmarshal_user_record,
+    buddy=_unmarshal_user_record,
+)
+
+def _parse_response(what, response, unmarshallers, stats=None):
+    """Parse and unmarshal the given XML response (a string or a
+    file-like object, which is closed).
+
+    If a `CallStats' is given as "stats" its `num_elements' is set.
+    """
+    if expat is None:
+        return _etree_parse_response(what, response, unmarshallers, stats)
+    try:
+        compiled = _compiled_unmarshaller(what, unmarshallers)
+        return compiled.parse(_file_from_response(response), stats)
+    finally:
+        _close_response(response)
+
+def _iter_events_from_response(response, unmarshallers, stats=None):
+    """Generate the unmarshalled <event>s in the given events response
+    as each </event> is parsed.
+
+    The other elements of the response are unmarshalled as usual (and
+    API errors raised) but not returned.
+    """
+    if expat is None:
+        for event in _etree_iter_events_from_response(response,
+                                                      unmarshallers, stats):
+            yield event
+        return
+    try:
+        compiled = _compiled_unmarshaller("events", unmarshallers)
+        for event in compiled.iterparse(_file_from_response(response),
+                                        "event", stats):
+            yield event
+    finally:
+        _close_response(response)
+
+
+class _CompiledUnmarshaller(object):
+    """A streaming expat-based parser for API responses, specialised for
+    one table of unmarshallers.
+
+    This gives the same results as unmarshalling with ElementTree but
+    builds no element tree: each leaf element's text is converted
+    directly by its unmarshaller's `convert_text', and each other
+    element's value is built from its children's values by its
+    unmarshaller's `build'.
+    """
+    chunk_size = 16384
+
+    def __init__(self, what, unmarshallers):
+        self.what = what
+        self._converters = {}  # tag -> convert_text(text), None for `_text'
+        self._builders = {}    # tag -> build(attrs, text, children)
+        for tag, unmarshal in unmarshallers.items():
+            convert_text = getattr(unmarshal, "convert_text", None)
+            if convert_text is _identity:
+                self._converters[tag] = None
+            elif convert_text is _undecoded:
+                self._converters[tag] = _undecoded
+            elif convert_text is not None:
+                self._converters[tag] = convert_text
+            else:
+                self._builders[tag] = getattr(unmarshal, "build", None) \
+                    or _build_with_element(tag, unmarshal)
+
+    def parse(self, file, stats=None):
+        """Parse the given file-like object and return the value of the
+        root element.
+
+        If a `CallStats' is given as "stats" its `num_elements' is set.
+        """
+        for value in self._parse(file, None, stats):
+            return value
+
+    def iterparse(self, file, item_tag, stats=None):
+        """Parse the given file-like object, generating the value of each
+        `item_tag' element as soon as it has been parsed. These values
+        are not added to their parent's.
+        """
+        return self._parse(file, item_tag, stats)
+
+    def _parse(self, file, item_tag, stats=None):
+        what = self.what
+        converters = self._converters
+        builders = self._builders
+        fixtext = _fixtext
+        # Each frame is [tag, attrs, text parts, children], where each
+        # child is [tag, value, tail parts].
+        stack = [[None, None, [], []]]
+        items = []
+        not_leaf = object()
+        undecoded = _undecoded
+        names = {}
+
+        def start(tag, attrs):
+            try:
+                tag = names[tag]
+            except KeyError:
+                tag = names[tag] = fixtext(tag)
+            stack.append([tag, attrs, [], []])
+
+        def end(tag):
+            tag, attrs, text_parts, children = stack.pop()
+            convert_text = converters.get(tag, not_leaf)
+            if convert_text is undecoded:
+                value = text_parts and ''.join(text_parts) or None
+                stack[-1][3].append([tag, value, None])
+                return
+            if text_parts:
+                text = fixtext(''.join(text_parts))
+            else:
+                text = None
+            if convert_text is None:
+                value = text
+            elif convert_text is not not_leaf:
+                value = convert_text(text)
+            else:
+                build = builders.get(tag)
+                if build is None:
+                    raise ThirtyBoxesError("unknown %s tag: %r" % (what, tag))
+                if attrs:
+                    attrs = dict((fixtext(k), fixtext(v))
+                                 for k, v in attrs.items())
+                for child in children:
+                    if child[2] is not None:
+                        child[2] = fixtext(''.join(child[2]))
+                value = build(attrs, text, children)
+            if tag == item_tag:
+                items.append(value)
+            else:
+                stack[-1][3].append([tag, value, None])
+
+        def char_data(data):
+            frame = stack[-1]
+            children = frame[3]
+            if children:
+                child = children[-1]
+                if child[2] is None:
+                    child[2] = [data]
+                else:
+                    child[2].append(data)
+            else:
+                frame[2].append(data)
+
+        parser = expat.ParserCreate()
+        parser.returns_unicode = False  # UTF-8 encoded str
+        parser.buffer_text = True
+        if stats is None:
+            parser.StartElementHandler = start
         else:
-            raise ThirtyBoxesError("unknown %s tag: %r" % (what, elem.tag))
-    return parser.root.text
+            stats.num_elements = 0
+            def counting_start(tag, attrs):
+                stats.num_elements += 1
+                start(tag, attrs)
+            parser.StartElementHandler = counting_start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = char_data
+        read = file.read
+        chunk_size = self.chunk_size
+        while True:
+            data = read(chunk_size)
+            try:
+                parser.Parse(data, not data)
+            except expat.ExpatError, ex:
+                raise _parse_error_from_expat_error(ex)
+            if items:
+                for item in items:
+                    yield item
+                del items[:]
+            if not data:
+                break
+        if item_tag is None:
+            yield stack[0][3][0][1]
+
+
+_compiled_unmarshallers = {}
+
+def _compiled_unmarshaller(what, unmarshallers):
+    """Return the (cached) `_CompiledUnmarshaller' for the given table."""
+    key = (what, id(unmarshallers))
+    try:
+        return _compiled_unmarshallers[key][1]
+    except KeyError:
+        compiled = _CompiledUnmarshaller(what, unmarshallers)
+        # Keep a reference to the table so its id can't be reused.
+        _compiled_unmarshallers[key] = (unmarshallers, compiled)
+        return compiled
+
+def _build_with_element(tag, unmarshal):
+    """Return a `build' function for an unmarshaller that has none,
+    which calls it on an equivalent ElementTree element.
+    """
+    def build(attrs, text, children):
+        ET = _etree()
+        elem = ET.Element(tag, attrs)
+        elem.text = text
+        for child_tag, value, tail in children:
+            child = ET.SubElement(elem, child_tag)
+            child.text = value
+            child.tail = tail
+        return unmarshal(elem)
+    return build
+
+_non_ascii_re = re.compile(r"[\x80-\xff]")
+
+def _fixtext(text):
+    """Return the given UTF-8 string from expat as ElementTree would:
+    as a str if it is ASCII and otherwise as unicode.
+    """
+    if _non_ascii_re.search(text):
+        return text.decode("utf-8")
+    return text
+
+def _etree():
+    """Return the ElementTree module, importing it on first use. It is
+    only needed if expat isn't available and for custom unmarshallers.
+    """
+    global ET
+    if ET is None:
+        try:
+            import xml.etree.ElementTree as ET # in python >=2.5
+        except ImportError:
+            try:
+                import cElementTree as ET
+            except ImportError:
+                try:
+                    import elementtree.ElementTree as ET
+                except ImportError:
+                    try:
+                        import lxml.etree as ET
+                    except ImportError:
+                        raise ThirtyBoxesError("could not import ElementTree "
+                            "(http://effbot.org/zone/element-index.htm)")
+    return ET
+
+def _parse_error_from_expat_error(ex):
+    ParseError = getattr(_etree(), "ParseError", SyntaxError)
+    err = ParseError(str(ex))
+    err.code = ex.code
+    err.position = (ex.lineno, ex.offset)
+    return err
+
+def _etree_parse_response(what, response, unmarshallers, stats=None):
+    """The ElementTree implementation of `_parse_response()'."""
+    try:
+        parser = _etree().iterparse(_file_from_response(response))
+        if stats is not None:
+            stats.num_elements = 0
+        for action, elem in parser:
+            if stats is not None:
+                stats.num_elements += 1
+            unmarshaller = unmarshallers.get(elem.tag)
+            if unmarshaller:
+                data = unmarshaller(elem)
+                # The tail (text following this element) may not have
+                # been parsed yet, so don't clear it.
+                tail = elem.tail
+                elem.clear()
+                elem.text = data
+                elem.tail = tail
+            else:
+                raise ThirtyBoxesError("unknown %s tag: %r" % (what, elem.tag))
+        return parser.root.text
+    finally:
+        _close_response(response)
+
+def _etree_iter_events_from_response(response, unmarshallers, stats=None):
+    """The ElementTree implementation of `_iter_events_from_response()'."""
+    try:
+        file = _file_from_response(response)
+        parents = []
+        if stats is not None:
+            stats.num_elements = 0
+        for action, elem in _etree().iterparse(file, events=("start", "end")):
+            if action == "start":
+                parents.append(elem)
+                if stats is not None:
+                    stats.num_elements += 1
+                continue
+            parents.pop()
+            unmarshaller = unmarshallers.get(elem.tag)
+            if unmarshaller is None:
+                raise ThirtyBoxesError("unknown events tag: %r" % elem.tag)
+            if elem.tag == "event":
+                event = unmarshaller(elem)
+                parents[-1].remove(elem)
+                yield event
+            elif elem.tag == "eventList":
+                pass  # its events have all been yielded
+            else:
+                data = unmarshaller(elem)
+                tail = elem.tail
+                elem.clear()
+                elem.text = data
+                elem.tail = tail
+    finally:
+        _close_response(response)
 
 
 # Recipe: indent (0.2.1) in /Users/trentm/tm/recipes/cookbook
@@ -665,10 +4845,245 @@ an authorization token.""" % (first_opt, authtoken_path))
 
 
 
+#---- the command-line interface daemon
+
+# CLI subcommands that the daemon runs (those that call the API without
+# opening a browser).
+_DAEMON_SUBCMDS = ("ping", "user", "alluserinfo", "events", "search",
+                   "tagsearch")
+# Environment variables passed along with each forwarded command.
+_DAEMON_ENV_VARS = ("THIRTYBOXES_APIKEY", "THIRTYBOXES_AUTHTOKEN")
+# Seconds to wait on the daemon (which may be busy with another
+# client's command) before running a command in-process instead.
+_DAEMON_TIMEOUT = 30.0
+
+def _daemon_socket_path():
+    return expanduser(join("~", ".30boxes", "daemon.sock"))
+
+def _subcmd_from_argv(argv):
+    """Return the subcommand in the given CLI argv, or None if there is
+    none or help or the version is requested.
+    """
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == "--":
+            return next(args, None)
+        elif arg.startswith("--"):
+            if arg in ("--help", "--version"):
+                return None
+            elif arg in ("--api-key", "--auth-token"):
+                next(args, None)
+        elif arg.startswith("-") and len(arg) > 1:
+            for i, char in enumerate(arg[1:]):
+                if char == "h":
+                    return None
+                elif char in "ka": # takes a value
+                    if i == len(arg) - 2:
+                        next(args, None)
+                    break
+        else:
+            return arg
+    return None
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+def _forward_to_daemon(argv):
+    """Run the given CLI command in the running `thirtyboxes daemon', if
+    any, and write its output.
+
+    Returns the command's exit status, or None if it should be run
+    in-process instead (no daemon is running, the command is not one
+    the daemon runs, the daemon uses another API_URL, or it doesn't
+    reply within `_DAEMON_TIMEOUT' seconds). The daemon only runs
+    read-only commands, so running one again in-process is safe.
+    """
+    if not hasattr(socket, "AF_UNIX") \
+       or _subcmd_from_argv(argv) not in _DAEMON_SUBCMDS:
+        return None
+    import marshal
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(_DAEMON_TIMEOUT)
+    try:
+        try:
+            sock.connect(_daemon_socket_path())
+        except socket.timeout:
+            log.debug("daemon isn't accepting: running in-process")
+            return None
+        except socket.error:
+            return None # the daemon isn't running
+        env = dict((name, os.environ[name]) for name in _DAEMON_ENV_VARS
+                   if name in os.environ)
+        request = {"argv": list(argv), "env": env, "api_url": API_URL}
+        try:
+            sock.sendall(marshal.dumps(request))
+            sock.shutdown(socket.SHUT_WR)
+            reply = marshal.loads(_recv_all(sock))
+            if reply is None:
+                log.debug("daemon uses another API URL: running "
+                          "in-process")
+                return None
+            retval, stdout, stderr = reply
+        except (socket.error, EOFError, ValueError, TypeError), ex:
+            log.debug("daemon failed (%s): running in-process", ex)
+            return None
+    finally:
+        sock.close()
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return retval
+
+
+class _Capture(object):
+    """A stand-in for sys.stdout/sys.stderr that collects the output."""
+    def __init__(self):
+        self._chunks = []
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode("utf-8")
+        self._chunks.append(s)
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+    def flush(self):
+        pass
+    def getvalue(self):
+        return ''.join(self._chunks)
+
+
+class _CLIDaemon(object):
+    """A server on a Unix socket that runs the CLI commands forwarded to
+    it by `_forward_to_daemon()' in this (warm) process.
+
+    Commands are run one at a time, by design: running a command
+    swaps `sys.stdout', `sys.stderr', the logging handlers' streams and
+    the credential environment variables for the whole process, so two
+    commands can't safely run at once. (A client kept waiting more than
+    `_DAEMON_TIMEOUT' seconds runs its command itself.) The umask is
+    only changed while the socket is created, before serving.
+
+    Commands from a client using another API_URL (e.g.
+    THIRTYBOXES_API_URL set differently) are refused, with a None
+    reply, so that they aren't sent to the wrong server.
+    """
+    def __init__(self, path, run):
+        """
+            "path" is the path of the Unix socket to listen on.
+            "run" is a function that runs a CLI argv and returns its
+                exit status.
+        """
+        self.path = path
+        self.run = run
+
+    def serve_forever(self):
+        import SocketServer
+        import marshal
+        daemon = self
+
+        class Handler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                # Don't let a stalled client block the other clients.
+                self.request.settimeout(_DAEMON_TIMEOUT)
+                data = _recv_all(self.request)
+                if not data:
+                    return # e.g. another daemon checking for this one
+                request = marshal.loads(data)
+                if request.get("api_url") != API_URL:
+                    reply = None
+                else:
+                    reply = daemon._run_request(request["argv"],
+                                                request["env"])
+                self.request.sendall(marshal.dumps(reply))
+
+        self._remove_stale_socket()
+        dir = os.path.dirname(self.path)
+        if not exists(dir):
+            os.makedirs(dir, 0700)
+        # Create the socket accessible only by this user: a chmod after
+        # bind() would leave a window when others could connect.
+        old_umask = os.umask(0177)
+        try:
+            server = SocketServer.UnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(old_umask)
+        try:
+            log.info("listening on `%s'", self.path)
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.path)
+
+    def _remove_stale_socket(self):
+        if not exists(self.path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                os.remove(self.path) # left behind by a dead daemon
+            else:
+                raise ThirtyBoxesError("a daemon is already listening on "
+                                       "`%s'" % self.path)
+        finally:
+            sock.close()
+
+    def _run_request(self, argv, env):
+        """Run the given CLI argv with the given environment variables
+        and return a (retval, stdout, stderr) tuple.
+        """
+        stdout, stderr = _Capture(), _Capture()
+        saved_streams = sys.stdout, sys.stderr
+        saved_env = dict((name, os.environ.get(name))
+                         for name in _DAEMON_ENV_VARS)
+        handlers = [h for h in logging.root.handlers
+                    if getattr(h, "stream", None) is sys.stderr]
+        for name in _DAEMON_ENV_VARS:
+            _set_environ(name, env.get(name))
+        sys.stdout, sys.stderr = stdout, stderr
+        for handler in handlers:
+            handler.stream = stderr
+        try:
+            try:
+                retval = self.run(argv)
+            except SystemExit, ex:
+                if ex.code is None or isinstance(ex.code, int):
+                    retval = ex.code or 0
+                else:
+                    stderr.write("%s\n" % ex.code)
+                    retval = 1
+        finally:
+            sys.stdout, sys.stderr = saved_streams
+            for handler in handlers:
+                handler.stream = saved_streams[1]
+            for name, value in saved_env.items():
+                _set_environ(name, value)
+        return (retval or 0, stdout.getvalue(), stderr.getvalue())
+
+def _set_environ(name, value):
+    if value is None:
+        os.environ.pop(name, None)
+    else:
+        os.environ[name] = value
+
+
+
 #---- the command-line interface
 
 if __name__ == "__main__":
+    # Let a running `thirtyboxes daemon' run the command, before paying
+    # for cmdln and the rest of the CLI setup.
+    retval = _forward_to_daemon(sys.argv)
+    if retval is not None:
+        sys.exit(retval)
+
     import cmdln # for cmdln iface you need cmdln.py from http://trentm.com/projects/cmdln/
+    from pprint import pprint
 
     class Shell(cmdln.Cmdln):
         """30boxes.com calendar API
@@ -683,13 +5098,72 @@ if __name__ == "__main__":
         """
         name = "thirtyboxes"
         _api = None # lazily assigned ThirtyBoxes() instance
+        # In `thirtyboxes daemon', the ThirtyBoxes instances kept for
+        # reuse by each command: (api key, auth token, use cache,
+        # refresh) -> ThirtyBoxes.
+        _warm_apis = None
+        _stats = None # StatsCollector for `--stats'
 
         def _get_api(self):
             if self._api is None:
-                self._api = ThirtyBoxes(self.options.api_key,
-                                        self.options.auth_token)
+                self._api = self._new_api()
+                if self.options.stats:
+                    self._stats = StatsCollector()
+                    self._api.add_observer(self._stats)
             return self._api
 
+        def _new_api(self):
+            key = (self.options.api_key
+                       or os.environ.get("THIRTYBOXES_APIKEY"),
+                   self.options.auth_token
+                       or os.environ.get("THIRTYBOXES_AUTHTOKEN"),
+                   self.options.use_cache, self.options.refresh)
+            if self._warm_apis is not None and key in self._warm_apis:
+                return self._warm_apis[key]
+            if self.options.use_cache:
+                cache = DiskCache(refresh=self.options.refresh)
+            else:
+                cache = None
+            api = ThirtyBoxes(self.options.api_key,
+                              self.options.auth_token,
+                              cache=cache)
+            if self._warm_apis is not None:
+                self._warm_apis[key] = api
+            return api
+
+        def _report_stats(self):
+            """Print the `--stats' report (if any) to stderr."""
+            if self._stats is None:
+                return
+            self._api.remove_observer(self._stats)
+            report = self._stats.report()
+            if report:
+                sys.stderr.write("--- API call stats\n%s\n" % report)
+
+        def do_daemon(self, subcmd, opts):
+            """run a resident daemon that runs other thirtyboxes commands
+
+            ${cmd_usage}
+            ${cmd_option_list}
+            While the daemon is running, the ping, user, alluserinfo,
+            events, search and tagsearch commands are forwarded to it
+            over the Unix socket `~/.30boxes/daemon.sock'. It runs them
+            one at a time, reusing its API connections, response cache
+            and credentials, which saves the startup costs of each
+            command. When no daemon is running commands run as usual.
+
+            Restart the daemon after changing `~/.30boxes/apikey' or
+            `~/.30boxes/authtoken'.
+            """
+            if not hasattr(socket, "AF_UNIX"):
+                raise ThirtyBoxesError("the daemon requires Unix sockets")
+            Shell._warm_apis = {}
+            try:
+                _CLIDaemon(_daemon_socket_path(), _run_in_daemon) \
+                    .serve_forever()
+            except KeyboardInterrupt:
+                pass
+
         def do_getapikey(self, subcmd, opts):
             """get a 30boxes API key necessary for using the rest of the API
 
@@ -719,17 +5193,33 @@ if __name__ == "__main__":
             else:
                 print "%(ping)s: %(msg)s" % response
 
-        def do_user(self, subcmd, opts, email_or_id):
-            """get public info for the given user
+        def do_user(self, subcmd, opts, *emails_or_ids):
+            """get public info for the given user(s)
 
             ${cmd_usage}
             ${cmd_option_list}
 
             This is a mingling of user.FindByEmail and user.FindById
-            from the 30boxes.com API.
+            from the 30boxes.com API. Several users are fetched
+            concurrently.
             """
+            if not emails_or_ids:
+                raise ThirtyBoxesError("no users given")
             api = self._get_api()
-            response = api.find_user(email_or_id)
+            if len(emails_or_ids) == 1:
+                self._print_user(api.find_user(emails_or_ids[0]))
+                return
+            retval = None
+            for email_or_id, user in zip(emails_or_ids,
+                                         api.find_users(emails_or_ids)):
+                if isinstance(user, Exception):
+                    log.error("%s: %s", email_or_id, user)
+                    retval = 1
+                else:
+                    self._print_user(user)
+            return retval
+
+        def _print_user(self, response):
             if self.options.output_format == "raw":
                 pprint(response)
             elif self.options.output_format == "short":
@@ -856,7 +5346,7 @@ if __name__ == "__main__":
             ${cmd_option_list}
             Returns events starting on or after START (defaults to
             today) and starting before END (defaults to START + 90
-            days). END cannot be more than 120 days after START.
+            days). Ranges longer than 180 days are fetched in pieces.
 
             Start and end dates must be formatted as 'YYYY-MM-DD' and
             time/dates as 'YYYY-MM-DD HH:MM:SS' (the same as mysql).
@@ -1023,20 +5513,17 @@ if __name__ == "__main__":
                 self.fmtFromLevel = {}
             else:
                 self.fmtFromLevel = fmtFromLevel
+            # A formatter per level format (rather than swapping `_fmt'
+            # while formatting), so that this is thread-safe.
+            self._fmtrFromLevel = dict(
+                (level, logging.Formatter(levelFmt, datefmt))
+                for level, levelFmt in self.fmtFromLevel.items())
         def format(self, record):
             record.levelname = record.levelname.lower()
-            if record.levelno in self.fmtFromLevel:
-                #XXX This is a non-threadsafe HACK. Really the base Formatter
-                #    class should provide a hook accessor for the _fmt
-                #    attribute. *Could* add a lock guard here (overkill?).
-                _saved_fmt = self._fmt
-                self._fmt = self.fmtFromLevel[record.levelno]
-                try:
-                    return logging.Formatter.format(self, record)
-                finally:
-                    self._fmt = _saved_fmt
-            else:
+            fmtr = self._fmtrFromLevel.get(record.levelno)
+            if fmtr is None:
                 return logging.Formatter.format(self, record)
+            return fmtr.format(record)
 
     def _setup_logging():
         hdlr = logging.StreamHandler()
@@ -1050,10 +5537,7 @@ if __name__ == "__main__":
 
 
 
-    _setup_logging() # defined in recipe:pretty_logging
-
-    try:
-        shell = Shell()
+    def _optparser_from_shell(shell):
         optparser = cmdln.CmdlnOptionParser(shell,
             version=Shell.name+" "+__version__)
         optparser.add_option("-v", "--verbose", action="callback",
@@ -1072,24 +5556,49 @@ if __name__ == "__main__":
             help="specify your API key")
         optparser.add_option("-a", "--auth-token", 
             help="specify your authorized user token")
+        optparser.add_option("--no-cache", action="store_false",
+            dest="use_cache",
+            help="don't use the response cache in `~/.30boxes/cache'")
+        optparser.add_option("--refresh", action="store_true",
+            help="ignore cached responses (but cache new ones)")
+        optparser.add_option("--stats", action="store_true",
+            help="print timings and sizes of the API calls made to stderr")
         optparser.set_defaults(api_key=None, auth_token=None,
-                               output_format="long")
-        retval = shell.main(sys.argv, optparser=optparser)
-    except KeyboardInterrupt:
-        sys.exit(1)
-    except:
-        exc_info = sys.exc_info()
-        if hasattr(exc_info[0], "__name__"):
-            log.error("%s", exc_info[1])
-        else:  # string exception
-            log.error(exc_info[0])
-        if log.isEnabledFor(logging.DEBUG):
-            import traceback
-            print
-            traceback.print_exception(*exc_info)
-        sys.exit(1)
-    else:
-        sys.exit(retval)
+                               output_format="long", use_cache=True,
+                               refresh=False, stats=False)
+        return optparser
+
+    def _run(argv):
+        """Run the CLI with the given argv and return the exit status."""
+        try:
+            shell = Shell()
+            try:
+                retval = shell.main(argv,
+                                    optparser=_optparser_from_shell(shell))
+            finally:
+                shell._report_stats()
+        except KeyboardInterrupt:
+            return 1
+        except:
+            exc_info = sys.exc_info()
+            if hasattr(exc_info[0], "__name__"):
+                log.error("%s", exc_info[1])
+            else:  # string exception
+                log.error(exc_info[0])
+            if log.isEnabledFor(logging.DEBUG):
+                import traceback
+                print
+                traceback.print_exception(*exc_info)
+            return 1
+        else:
+            return retval
+
+    def _run_in_daemon(argv):
+        log.setLevel(logging.INFO) # undo the last command's -v or -q
+        return _run(argv)
+
+    _setup_logging() # defined in recipe:pretty_logging
+    sys.exit(_run(sys.argv))
 
 
 # if __name__ == "__main__":